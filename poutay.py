@@ -99,6 +99,32 @@ class StartAppCommand(CommandBase):
         print(f"App created at {app_dir}")
 
 
+class DbCompactCommand(CommandBase):
+    name = "dbcompact"
+    help = "Drop deleted rows from a pudb database and merge its partitions."
+
+    @classmethod
+    def add_arguments(cls, parser: argparse.ArgumentParser) -> None:
+        parser.add_argument("database", help="Connection string, db://user:pass@/path/to/db")
+        parser.add_argument(
+            "--monthly", action="store_true", help="Merge daily partitions into monthly ones"
+        )
+        parser.add_argument(
+            "--model", action="append", dest="models", help="Only compact this model"
+        )
+
+    def run(self, args: argparse.Namespace) -> None:
+        from poutay.pudb.compact import compact_database
+        from poutay.pudb.orm import create_base_model
+
+        # logs in and replays an interrupted transaction first
+        base = create_base_model(args.database)
+        report = compact_database(
+            base._db_root, base._password, monthly=args.monthly, models=args.models
+        )
+        print(report)
+
+
 class CreateSvgColorsCommand(CommandBase):
     name = "createsvgcolors"
     help = "Build colored SVG resources."
@@ -135,6 +161,7 @@ COMMANDS = [
     BuildCommand,
     StartProjectCommand,
     StartAppCommand,
+    DbCompactCommand,
     CreateSvgColorsCommand,
     DesignerCommand,
 ]
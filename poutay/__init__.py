@@ -18,6 +18,7 @@ RunCommand = _cli.RunCommand
 BuildCommand = _cli.BuildCommand
 StartProjectCommand = _cli.StartProjectCommand
 StartAppCommand = _cli.StartAppCommand
+DbCompactCommand = _cli.DbCompactCommand
 CreateSvgColorsCommand = _cli.CreateSvgColorsCommand
 DesignerCommand = _cli.DesignerCommand
 build_parser = _cli.build_parser
@@ -28,6 +29,7 @@ __all__ = [
     "BuildCommand",
     "StartProjectCommand",
     "StartAppCommand",
+    "DbCompactCommand",
     "CreateSvgColorsCommand",
     "DesignerCommand",
     "build_parser",
@@ -26,3 +26,17 @@ QSS_PATH = str(BASE_DIR / "assets" / "style.qss")
 
 # Entry point
 START = None  # e.g., "module:main"
+
+# pudb
+PUDB_CACHE_BYTES = 64 * 1024 * 1024  # memory for decoded partitions, estimated
+PUDB_INDEX_BYTES = 256 * 1024 * 1024  # memory for partition indexes per database, estimated
+PUDB_SCAN_WORKERS = None  # partitions decoded ahead of a scan; None uses every core
+PUDB_SERIALIZER = None  # "json", "orjson" or "msgpack"; None picks the fastest installed
+PUDB_COMPRESSION = "zlib"  # None, "zlib" or "zstd" (needs zstandard)
+PUDB_COMPRESS_MIN_BYTES = 512  # smaller frames are stored uncompressed
+PUDB_ASYNC_WORKERS = 4  # threads running asave(), aall() and other async calls
+PUDB_WRITE_BEHIND = False  # queue saves and write them from a background thread
+PUDB_FLUSH_INTERVAL = 0.5  # seconds between write-behind flushes
+PUDB_FLUSH_ROWS = 1000  # flush early once this many records are queued
+PUDB_SESSION_PER_ACTION = False  # run each UIMain action inside BaseModel.session()
+PUDB_INDEX_SNAPSHOTS = True  # keep field indexes in Y/M/D/<Model>.idx next to the partitions
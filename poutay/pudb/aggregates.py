@@ -0,0 +1,149 @@
+"""Aggregate functions for :meth:`QuerySet.aggregate` and ``annotate``.
+
+Every aggregate folds the values of one field over the matching records in
+a single pass: ``initial()`` starts a state, ``step()`` adds a value and
+``final()`` turns the state into the result.  Over whole partitions most of
+them can instead be answered from the manifest's per-partition statistics
+via ``from_stats()``, without decrypting anything.
+
+Values that are ``None`` are skipped, like SQL ``NULL``.  ``Min`` and
+``Max`` order values the way the sorted index does, so mixed types never
+raise.
+"""
+from .field_index import sort_key
+
+# from_stats() result when the statistics cannot answer an aggregate
+UNKNOWN = object()
+
+
+class Aggregate:
+    function = ""
+
+    def __init__(self, field=None):
+        self.field = field
+
+    @property
+    def default_alias(self):
+        return f"{self.field}__{self.function.lower()}"
+
+    def initial(self):
+        return None
+
+    def step(self, state, value):
+        raise NotImplementedError
+
+    def final(self, state):
+        return state
+
+    def from_stats(self, stats):
+        """Answer from a list of manifest partition stats, or ``UNKNOWN``."""
+        return UNKNOWN
+
+    def _totals(self, stats):
+        """``(count, sum)`` of the field over ``stats``, ``None`` if unknown."""
+        count, total = 0, 0
+        for partition in stats:
+            totals = partition.get("totals")
+            if totals is None:
+                return None
+            field_count, field_sum = totals.get(self.field, (0, 0))
+            if field_sum is None:
+                return None
+            count += field_count
+            total += field_sum
+        return count, total
+
+    def __repr__(self):
+        return f"{self.function}({self.field!r})"
+
+
+class Count(Aggregate):
+    """Count rows, or the rows where ``field`` is not ``None``."""
+
+    function = "Count"
+
+    @property
+    def default_alias(self):
+        return f"{self.field}__count" if self.field else "count"
+
+    def initial(self):
+        return 0
+
+    def step(self, state, value):
+        if self.field is None or value is not None:
+            return state + 1
+        return state
+
+    def from_stats(self, stats):
+        if self.field is None:
+            return sum(partition["rows"] for partition in stats)
+        counts = 0
+        for partition in stats:
+            totals = partition.get("totals")
+            if totals is None:
+                return UNKNOWN
+            counts += totals.get(self.field, (0, 0))[0]
+        return counts
+
+
+class Sum(Aggregate):
+    function = "Sum"
+
+    def step(self, state, value):
+        if value is None:
+            return state
+        return value if state is None else state + value
+
+    def from_stats(self, stats):
+        totals = self._totals(stats)
+        if totals is None:
+            return UNKNOWN
+        count, total = totals
+        return total if count else None
+
+
+class Avg(Aggregate):
+    function = "Avg"
+
+    def initial(self):
+        return 0, 0
+
+    def step(self, state, value):
+        if value is None:
+            return state
+        return state[0] + 1, state[1] + value
+
+    def final(self, state):
+        count, total = state
+        return total / count if count else None
+
+    def from_stats(self, stats):
+        totals = self._totals(stats)
+        return UNKNOWN if totals is None else self.final(totals)
+
+
+class Min(Aggregate):
+    function = "Min"
+    _pick = staticmethod(min)
+
+    def step(self, state, value):
+        if value is None:
+            return state
+        if state is None:
+            return value
+        return self._pick(state, value, key=sort_key)
+
+    def from_stats(self, stats):
+        # zone maps hold the smallest and largest non-null value per partition
+        bound = 0 if self._pick is min else 1
+        state = None
+        for partition in stats:
+            zone = partition["zones"].get(self.field)
+            if zone is not None:
+                state = self.step(state, zone[bound])
+        return state
+
+
+class Max(Min):
+    function = "Max"
+    _pick = staticmethod(max)
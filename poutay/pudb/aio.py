@@ -0,0 +1,91 @@
+"""Run pudb calls on a thread pool from asyncio code.
+
+Decrypting partitions and reading files block the calling thread, which in
+a Qt slot means a frozen window.  The ``a*`` methods of models and
+querysets (``asave``, ``aall``, ``afirst``, ``async for``) hand the work to
+the pool of :func:`executor` and await it, so the event loop (asyncio's own
+or a qasync-style Qt loop) keeps running.
+
+A call made inside ``atomic()`` or ``session()`` runs in the same unit of
+work and identity map as the code awaiting it.  Cancelling the awaiting task
+abandons the result; ``async for`` checks between chunks of rows, so a
+cancelled scan stops after the chunk being read.
+
+The pool size is the ``PUDB_ASYNC_WORKERS`` setting.
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from poutay.conf import settings
+
+from . import session, transaction
+
+_lock = threading.Lock()
+_pool = None
+
+
+def executor():
+    global _pool
+    with _lock:
+        if _pool is None:
+            workers = getattr(settings, "PUDB_ASYNC_WORKERS", 4)
+            _pool = ThreadPoolExecutor(workers, thread_name_prefix="pudb-async")
+        return _pool
+
+
+def _carried(func, args, kwargs):
+    """Bind ``func`` to the caller's unit of work and identity map."""
+    uow = transaction.current()
+    identity = session.current()
+
+    def call():
+        # the worker joins the caller's blocks instead of opening its own
+        if uow is not None:
+            transaction._local.uow, transaction._local.depth = uow, 1
+        if identity is not None:
+            session._local.identity, session._local.depth = identity, 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if uow is not None:
+                transaction._local.uow = None
+            if identity is not None:
+                session._local.identity = None
+    return call
+
+
+def submit(func, *args, **kwargs):
+    """Start ``func`` on the pool; returns a ``concurrent.futures.Future``."""
+    return executor().submit(_carried(func, args, kwargs))
+
+
+async def run(func, *args, **kwargs):
+    """Await ``func(*args, **kwargs)`` run on the pool."""
+    return await asyncio.wrap_future(submit(func, *args, **kwargs))
+
+
+async def iterate(rows, chunk_size):
+    """Yield from the blocking iterator ``rows``, ``chunk_size`` at a time.
+
+    ``rows`` is closed when the loop ends, breaks or is cancelled; a chunk
+    still being read finishes first.
+    """
+    pending = None
+    try:
+        while True:
+            pending = submit(lambda: list(islice(rows, chunk_size)))
+            chunk = await asyncio.wrap_future(pending)
+            pending = None
+            if not chunk:
+                return
+            for row in chunk:
+                yield row
+    finally:
+        close = getattr(rows, "close", None)
+        if close is not None:
+            if pending is not None and not pending.done():
+                pending.add_done_callback(lambda _: close())
+            else:
+                close()
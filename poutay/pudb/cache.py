@@ -0,0 +1,139 @@
+"""Process-wide LRU cache of decoded ``.pu`` partitions.
+
+Decrypting and parsing a partition is the expensive part of every read, and
+a screen typically runs several queries over the same days.  Entries are
+keyed by path and validated against the file's inode, size and mtime, so a
+write from any process invalidates them; a partition that only grew is
+extended with its new frames instead of being decoded again.
+
+The budget is ``PUDB_CACHE_BYTES`` from the settings.  Entries are charged
+what their decoded records take in memory, as estimated by
+:func:`estimate_bytes`, which is many times the size of the compressed,
+encrypted file.
+"""
+import sys
+import threading
+from collections import OrderedDict
+
+from poutay.conf import settings
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+_SAMPLE = 64
+
+
+def _values(record):
+    # partition logs and snapshots store lists rather than dicts
+    return record.values() if isinstance(record, dict) else record
+
+
+def estimate_bytes(records):
+    """Estimate the memory held by decoded ``records``.
+
+    Measures the dicts and values of up to ``_SAMPLE`` records spread over
+    the list and scales that to all of them; keys are left out, as the
+    decoders share them between records.
+    """
+    if not records:
+        return 0
+    sample = records[::max(1, len(records) // _SAMPLE)]
+    measured = sum(
+        sys.getsizeof(record) + sum(map(sys.getsizeof, _values(record)))
+        for record in sample
+    )
+    return sys.getsizeof(records) + measured * len(records) // len(sample)
+
+
+class PartitionCache:
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is None:
+            self._max_bytes = getattr(settings, "PUDB_CACHE_BYTES", DEFAULT_MAX_BYTES)
+        return self._max_bytes
+
+    def configure(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    def get(self, path, signature=None):
+        """Return ``(signature, records, end)`` cached for ``path``, if any.
+
+        Counts a hit when the entry's signature is ``signature`` (or any,
+        when none is given) and a miss otherwise.
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                self.misses += 1
+                return None
+            if signature is None or entry[0] == signature:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._entries.move_to_end(path)
+            return entry[:3]
+
+    def put(self, path, signature, records, end, cost):
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.size -= old[3]
+            if cost > self.max_bytes:
+                return
+            self._entries[path] = (signature, records, end, cost)
+            self.size += cost
+            self._evict()
+
+    def extend(self, path, offset, signature, records, end, cost):
+        """Add a frame appended at ``offset`` to a cached partition.
+
+        ``cost`` is what the new records take.  Only applies when the entry
+        ends exactly where the frame starts; otherwise it is left for the
+        next read to validate.
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[2] != offset:
+                return
+            entry[1].extend(records)
+            self.size += cost
+            self._entries[path] = (signature, entry[1], end, entry[3] + cost)
+            self._entries.move_to_end(path)
+            self._evict()
+
+    def invalidate(self, path):
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.size -= old[3]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+        }
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            _, old = self._entries.popitem(last=False)
+            self.size -= old[3]
+
+
+partition_cache = PartitionCache()
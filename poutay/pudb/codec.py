@@ -0,0 +1,103 @@
+"""Serialization and compression of the records in a frame.
+
+Frames of version 2 segments encrypt ``[serializer][compressor] payload``:
+two id bytes naming how the payload was produced, so every frame decodes on
+its own whatever the settings were when it was written.
+
+Serializers are ``json`` (always available), ``orjson`` and ``msgpack``;
+compressors are ``zlib`` and ``zstd`` (the ``zstandard`` package).  The ones
+used for writing come from ``PUDB_SERIALIZER`` (``None`` picks the fastest
+installed) and ``PUDB_COMPRESSION``; payloads smaller than
+``PUDB_COMPRESS_MIN_BYTES`` are stored uncompressed.  Records a serializer
+cannot represent (integers beyond 64 bits, say) are written as JSON.
+"""
+import json
+import zlib
+
+from poutay.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class MissingCodecError(ImportError):
+    """A frame needs a serializer or compressor that is not installed."""
+
+
+def _json_dumps(records):
+    return json.dumps(records, separators=(",", ":")).encode()
+
+
+# id -> (name, dumps, loads); ids are stored in files and never reused
+SERIALIZERS = {0: ("json", _json_dumps, json.loads)}
+if orjson is not None:
+    SERIALIZERS[1] = ("orjson", orjson.dumps, orjson.loads)
+if msgpack is not None:
+    SERIALIZERS[2] = ("msgpack", msgpack.packb, msgpack.unpackb)
+
+COMPRESSORS = {0: ("none", None, None), 1: ("zlib", zlib.compress, zlib.decompress)}
+if zstandard is not None:
+    COMPRESSORS[2] = (
+        "zstd", zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+    )
+
+_SERIALIZER_IDS = {"json": 0, "orjson": 1, "msgpack": 2}
+_COMPRESSOR_IDS = {None: 0, "none": 0, "zlib": 1, "zstd": 2}
+
+
+def _pick(table, ids, name, kind):
+    if ids[name] not in table:
+        raise MissingCodecError(f"pudb {kind} '{name}' is not installed")
+    return ids[name]
+
+
+def serializer_id():
+    name = getattr(settings, "PUDB_SERIALIZER", None)
+    if name is None:
+        return 1 if 1 in SERIALIZERS else 0
+    return _pick(SERIALIZERS, _SERIALIZER_IDS, name, "serializer")
+
+
+def compressor_id():
+    name = getattr(settings, "PUDB_COMPRESSION", None)
+    return _pick(COMPRESSORS, _COMPRESSOR_IDS, name, "compressor")
+
+
+def encode(records):
+    """Return the plaintext of a frame holding ``records``."""
+    sid = serializer_id()
+    try:
+        payload = SERIALIZERS[sid][1](records)
+    except (TypeError, OverflowError):
+        sid, payload = 0, _json_dumps(records)
+    cid = compressor_id()
+    if cid and len(payload) >= getattr(settings, "PUDB_COMPRESS_MIN_BYTES", 512):
+        payload = COMPRESSORS[cid][1](payload)
+    else:
+        cid = 0
+    return bytes((sid, cid)) + payload
+
+
+def decode(plaintext):
+    """Return the records of a frame from its ``encode()`` plaintext."""
+    sid, cid = plaintext[0], plaintext[1]
+    if sid not in SERIALIZERS:
+        raise MissingCodecError(f"pudb frame needs serializer #{sid}, which is not installed")
+    if cid not in COMPRESSORS:
+        raise MissingCodecError(f"pudb frame needs compressor #{cid}, which is not installed")
+    payload = memoryview(plaintext)[2:]
+    if cid:
+        payload = COMPRESSORS[cid][2](payload)
+    elif sid == 0:
+        payload = bytes(payload)
+    return SERIALIZERS[sid][2](payload)
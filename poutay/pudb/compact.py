@@ -0,0 +1,304 @@
+"""Offline compaction of a pudb database.
+
+Updates and deletes append new versions and tombstones to the partition a
+record lives in, so partitions accumulate rows nobody can read any more and
+frames that each cost a decryption.  :func:`compact_database` rewrites every
+such partition, and those in an older file format, as a single frame
+holding only its live records (the newest copy of an id wins, so ids saved
+on several days by older versions end up in one place), and with
+``monthly=True`` merges the daily partitions of a month into one
+``Y/M/00/<Model>.pu`` file.  Records of a merged month remember their day in
+``__date__``, which :meth:`QuerySet.between` still filters on.
+
+Every partition is rewritten atomically and one at a time, so compaction can
+be interrupted and simply run again: partitions already compacted are
+skipped.  A monthly merge is recorded in ``_pudb/compact.journal`` between
+writing the merged file and removing the daily ones, and an interrupted
+merge is finished first on the next run.
+
+The manifest and locator are brought up to date for every file touched and
+rewritten as one entry per partition at the end.  Compaction should not run
+while other processes write to the database.
+"""
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from . import storage
+from .encryption import get_fernet_key
+from .index_snapshot import IndexSnapshot, snapshot_path
+from .locator import Locator
+from .manifest import Manifest
+from .partition_log import LOG_DIR
+
+JOURNAL = "compact.journal"
+
+
+class CompactReport:
+    """What :func:`compact_database` did, and what it saved."""
+
+    def __init__(self):
+        self.partitions = 0
+        self.rewritten = 0
+        self.months_merged = 0
+        self.rows_dropped = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+        self.scan_before = 0.0
+        self.scan_after = 0.0
+        self.elapsed = 0.0
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_before - self.bytes_after
+
+    def __str__(self):
+        return "\n".join([
+            f"Partitions checked:   {self.partitions}",
+            f"Partitions rewritten: {self.rewritten}",
+            f"Months merged:        {self.months_merged}",
+            f"Rows dropped:         {self.rows_dropped}",
+            f"Bytes:                {self.bytes_before} -> {self.bytes_after} "
+            f"({self.bytes_saved} saved)",
+            f"Scan time:            {self.scan_before:.3f}s -> {self.scan_after:.3f}s",
+            f"Elapsed:              {self.elapsed:.3f}s",
+        ])
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _partition_path(db_root, model_name, date_str):
+    y, m, d = date_str.split("-")
+    return os.path.join(db_root, y, m, d, f"{model_name}.pu")
+
+
+def _valid_date(date_str):
+    if storage.is_monthly(date_str):
+        date_str = date_str[:8] + "01"
+    try:
+        datetime.strptime(date_str, "%Y-%m-%d")
+    except ValueError:
+        return False
+    return True
+
+
+def _newest(records, seen):
+    """Return the live records of a partition whose id is not in ``seen``.
+
+    Only the last copy of an id is kept, revision or not: files written
+    before versions existed may hold an id more than once.  Ids of this
+    partition, tombstoned ones included, are added to ``seen``.
+    """
+    last = {record.get("id"): row for row, record in enumerate(records)}
+    live = [
+        record for row, record in enumerate(records)
+        if record.get("id") is None
+        or last[record["id"]] == row and record["id"] not in seen and not record.get(storage.DELETED)
+    ]
+    seen.update(record_id for record_id in last if record_id is not None)
+    return live
+
+
+def find_partitions(db_root):
+    """Return ``{model name: [partition, ...]}`` for the ``.pu`` files found.
+
+    Leftovers of an interrupted monthly merge are removed on the way.
+    """
+    found = defaultdict(list)
+    for root, dirs, files in os.walk(db_root):
+        if root == db_root and LOG_DIR in dirs:
+            dirs.remove(LOG_DIR)
+        date_str = "-".join(os.path.relpath(root, db_root).split(os.sep))
+        if not _valid_date(date_str):
+            continue
+        for filename in files:
+            if filename.endswith(".pu.merge"):
+                # written before its journal entry was: the month starts over
+                os.remove(os.path.join(root, filename))
+            elif filename.endswith(".pu"):
+                found[filename[:-len(".pu")]].append(date_str)
+    return {name: sorted(dates) for name, dates in found.items()}
+
+
+class _ModelCompactor:
+    def __init__(self, db_root, model_name, fernet, report):
+        self.db_root = db_root
+        self.model_name = model_name
+        self.fernet = fernet
+        self.report = report
+        self.manifest = Manifest.for_model(db_root, model_name, fernet)
+        self.locator = Locator.for_model(db_root, model_name, fernet)
+        self.journal = os.path.join(db_root, LOG_DIR, JOURNAL)
+
+    def path(self, date_str):
+        return _partition_path(self.db_root, self.model_name, date_str)
+
+    def remove(self, date_str):
+        """Delete a partition with its snapshot, lock files and, once
+        empty, its directories."""
+        path = self.path(date_str)
+        snapshot = snapshot_path(path)
+        for leftover in (path, f"{path}.lock", snapshot, f"{snapshot}.lock"):
+            try:
+                os.remove(leftover)
+            except FileNotFoundError:
+                pass
+        storage.partition_cache.invalidate(path)
+        directory = os.path.dirname(path)
+        while os.path.abspath(directory) != os.path.abspath(self.db_root):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def snapshot_fields(self, date_str):
+        """Return the fields the index snapshot of a partition covers."""
+        snapshot = IndexSnapshot(date_str, self.path(date_str), self.fernet, ())
+        if not snapshot.exists():
+            return frozenset()
+        snapshot.load()
+        return snapshot.covered or frozenset()
+
+    def describe_snapshot(self, date_str, fields, records):
+        """Rebuild the snapshot of a partition just rewritten as one frame."""
+        path = self.path(date_str)
+        if not fields or not os.path.exists(path):
+            return
+        snapshot = IndexSnapshot(date_str, path, self.fernet, sorted(fields))
+        snapshot.rewrite([(len(storage.MAGIC), records)])
+
+    def refresh(self, date_str):
+        self.manifest.refresh(date_str, self.path(date_str))
+        self.locator.refresh(date_str, self.path(date_str))
+
+    def read(self, date_str):
+        """Return ``(frames, records, seconds)`` for one partition."""
+        started = time.perf_counter()
+        frames = list(storage.iter_frames(self.path(date_str), self.fernet))
+        seconds = time.perf_counter() - started
+        return frames, [record for _, _, frame in frames for record in frame], seconds
+
+    def compact_partition(self, date_str, seen):
+        """Rewrite one partition with only its live records.
+
+        ``seen`` holds the ids found in newer partitions, whose copies here
+        are older versions; the ids of this partition are added to it.
+        """
+        path = self.path(date_str)
+        before = _size(path)
+        self.report.bytes_before += before
+        frames, records, seconds = self.read(date_str)
+        live = _newest(records, seen)
+        current = storage.segment_version(path) == storage.VERSIONS[storage.MAGIC]
+        if len(frames) <= 1 and current and len(live) == len(records):
+            # a single current-format frame without dead rows: nothing to gain
+            self.report.bytes_after += before
+            return
+        live = [{k: v for k, v in record.items() if k != storage.REVISION} for record in live]
+        if live:
+            fields = self.snapshot_fields(date_str)
+            storage.write_records(path, self.fernet, live)
+            self.describe_snapshot(date_str, fields, live)
+        else:
+            self.remove(date_str)
+        self.refresh(date_str)
+        self.report.rewritten += 1
+        self.report.rows_dropped += len(records) - len(live)
+        self.report.bytes_after += _size(path)
+        self.report.scan_before += seconds
+        self.report.scan_after += self.read(date_str)[2]
+
+    def merge_month(self, month, days):
+        """Merge the daily partitions ``days`` of ``month`` into ``month-00``."""
+        monthly = f"{month}-00"
+        merged = []
+        for date_str in [monthly] + days:
+            for record in storage.live_records(self.read(date_str)[1]):
+                record = {k: v for k, v in record.items() if k != storage.REVISION}
+                record.setdefault(storage.DATE, date_str)
+                merged.append(record)
+        # newest day first, like a scan over the daily partitions
+        merged.sort(key=lambda record: record[storage.DATE], reverse=True)
+
+        bytes_before = sum(_size(self.path(d)) for d in days + [monthly])
+        fields = frozenset().union(*(self.snapshot_fields(d) for d in [monthly] + days))
+        merge_path = f"{self.path(monthly)}.merge"
+        os.makedirs(os.path.dirname(merge_path), exist_ok=True)
+        storage.write_records(merge_path, self.fernet, merged)
+        storage.write_records(self.journal, self.fernet, [
+            {"model": self.model_name, "partition": monthly, "days": days}
+        ])
+        self.finish_merge(monthly, days)
+        self.describe_snapshot(monthly, fields, merged)
+        self.report.months_merged += 1
+        self.report.bytes_after -= bytes_before - _size(self.path(monthly))
+
+    def finish_merge(self, monthly, days):
+        """Move a written merge into place and drop the daily partitions."""
+        path = self.path(monthly)
+        merge_path = f"{path}.merge"
+        if os.path.exists(merge_path):
+            os.replace(merge_path, path)
+            storage.partition_cache.invalidate(path)
+        for date_str in days:
+            self.remove(date_str)
+            self.refresh(date_str)
+        self.refresh(monthly)
+        os.remove(self.journal)
+
+    def run(self, dates, monthly):
+        seen = set()
+        # newest first, so the newest copy of an id is the one kept; a
+        # merged month counts as older than the days left beside it
+        for date_str in sorted(dates, reverse=True):
+            self.refresh(date_str)
+            self.compact_partition(date_str, seen)
+            self.report.partitions += 1
+        if monthly:
+            months = defaultdict(list)
+            for date_str in dates:
+                if not storage.is_monthly(date_str) and os.path.exists(self.path(date_str)):
+                    months[date_str[:7]].append(date_str)
+            for month, days in sorted(months.items()):
+                self.merge_month(month, days)
+        self.manifest.compact()
+        self.locator.compact()
+
+
+def _resume(db_root, fernet, report):
+    """Finish a monthly merge an earlier run was interrupted in."""
+    journal = os.path.join(db_root, LOG_DIR, JOURNAL)
+    if not os.path.exists(journal):
+        return
+    for entry in storage.read_records(journal, fernet):
+        compactor = _ModelCompactor(db_root, entry["model"], fernet, report)
+        compactor.finish_merge(entry["partition"], entry["days"])
+        report.months_merged += 1
+
+
+def compact_database(db_root, password, monthly=False, models=None):
+    """Compact the partitions of ``models`` (all by default) under ``db_root``.
+
+    Drops superseded versions, tombstones and copies of an id that a newer
+    partition holds too, rewrites every partition as a single frame and, with ``monthly``, merges daily partitions into monthly
+    ones.  Returns a :class:`CompactReport`.
+    """
+    started = time.perf_counter()
+    fernet = get_fernet_key(password)
+    report = CompactReport()
+    _resume(db_root, fernet, report)
+
+    found = find_partitions(db_root)
+    if models:
+        found = {name: dates for name, dates in found.items() if name in models}
+    for model_name, dates in sorted(found.items()):
+        _ModelCompactor(db_root, model_name, fernet, report).run(dates, monthly)
+    report.elapsed = time.perf_counter() - started
+    return report
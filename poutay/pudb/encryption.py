@@ -1,7 +1,9 @@
 from cryptography.fernet import Fernet
 import base64
 import hashlib
+from functools import lru_cache
 
+@lru_cache(maxsize=None)
 def get_fernet_key(password: str) -> Fernet:
     hashed = hashlib.sha256(password.encode()).digest()
     key = base64.urlsafe_b64encode(hashed)
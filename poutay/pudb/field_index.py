@@ -0,0 +1,267 @@
+"""In-memory field indexes of the partitions of a database.
+
+Every indexed partition has a :class:`PartitionIndex`: its records in file
+order, whose positions are the row ids, and per field a dict mapping the
+interned ``str()`` of each value to an ``array`` of the row ids holding it.
+Fields declared with ``Field(index="sorted")`` also keep their keys in
+order, next to an ``array`` of row ids.  Rows of superseded versions and
+tombstones are collected in ``dead``.
+
+Indexes belong to the :class:`IndexStore` of their database, so models of
+the same name in two databases never see each other's rows.  A store keeps
+the most recently used partitions within ``PUDB_INDEX_BYTES``; each is
+charged ``nbytes``, an estimate of the memory its records and postings
+take.  An evicted partition is indexed again (or answered from its
+snapshot) by the next lookup.
+"""
+import os
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from operator import itemgetter
+
+from poutay.conf import settings
+
+from . import storage
+from .cache import estimate_bytes
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# what a distinct value adds to a field's postings besides its row ids:
+# an empty array and a dict slot
+_KEY_BYTES = sys.getsizeof(array("I")) + 72
+# a row of a sorted field: its key tuple, a list slot and a row id
+_SORTED_ROW_BYTES = sys.getsizeof((0, 0)) + 8 + 4
+
+
+def sort_key(value):
+    """Order values of mixed JSON types: None, numbers, strings, the rest."""
+    if value is None:
+        return (0,)
+    if isinstance(value, (bool, int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, str(value))
+
+
+class SortedIndex:
+    """Sorted keys of one field of a partition, for range lookups and ordering.
+
+    Rows with equal keys keep their insertion order.
+    """
+
+    __slots__ = ("keys", "rows")
+
+    def __init__(self):
+        self.keys = []
+        self.rows = array("I")
+
+    def insert_many(self, pairs):
+        """Add ``(value, row)`` pairs."""
+        new = sorted(((sort_key(value), row) for value, row in pairs), key=itemgetter(0))
+        if not new:
+            return
+        if not self.keys or new[0][0] >= self.keys[-1]:
+            self.keys.extend(key for key, _ in new)
+            self.rows.extend(row for _, row in new)
+            return
+        if len(new) == 1:
+            key, row = new[0]
+            pos = bisect_right(self.keys, key)
+            self.keys.insert(pos, key)
+            self.rows.insert(pos, row)
+            return
+        merged = sorted(list(zip(self.keys, self.rows)) + new, key=itemgetter(0))
+        self.keys = [key for key, _ in merged]
+        self.rows = array("I", (row for _, row in merged))
+
+    def range(self, lower=None, upper=None):
+        """Return the rows whose key lies between the given bounds.
+
+        ``lower``/``upper`` are ``(value, inclusive)`` pairs.  Only values of
+        the same kind as the bound are returned, so ``gt=3`` never yields
+        strings or ``None``.
+        """
+        keys = self.keys
+        bound = lower or upper
+        rank = sort_key(bound[0])[0]
+        if lower:
+            key = sort_key(lower[0])
+            start = bisect_left(keys, key) if lower[1] else bisect_right(keys, key)
+        else:
+            start = bisect_left(keys, (rank,))
+        if upper:
+            key = sort_key(upper[0])
+            stop = bisect_right(keys, key) if upper[1] else bisect_left(keys, key)
+        else:
+            stop = bisect_left(keys, (rank + 1,))
+        return self.rows[start:stop]
+
+    def ordered(self, reverse=False):
+        """Yield ``(key, row)`` in key order; ties stay in insertion order."""
+        keys, rows = self.keys, self.rows
+        if not reverse:
+            yield from zip(keys, rows)
+            return
+        stop = len(keys)
+        while stop:
+            start = bisect_left(keys, keys[stop - 1], 0, stop)
+            yield from zip(keys[start:stop], rows[start:stop])
+            stop = start
+
+
+class PartitionIndex:
+    __slots__ = ("records", "postings", "sorted", "dead", "inode", "end", "size", "nbytes")
+
+    def __init__(self, fields, sorted_fields=(), inode=None):
+        self.records = []
+        self.postings = {field: {} for field in fields}
+        self.sorted = {field: SortedIndex() for field in sorted_fields}
+        self.dead = set()
+        self.inode = inode
+        # where the indexed frames end (None for a legacy blob), and the
+        # file bytes they cover
+        self.end = None
+        self.size = 0
+        # estimated memory held, what the store charges
+        self.nbytes = 0
+
+    def _rows(self, field, value):
+        return self.postings[field].get(str(value), ())
+
+    def add(self, records):
+        """Index ``records`` appended after the ones already indexed."""
+        first = len(self.records)
+        self.records.extend(records)
+        postings = self.postings
+        nbytes = estimate_bytes(records)
+        for row, record in enumerate(records, first):
+            if storage.REVISION in record:
+                # earlier versions of this id in the partition are superseded
+                self.dead.update(self._rows("id", record.get("id")))
+                if record.get(storage.DELETED):
+                    self.dead.add(row)
+            for field, value in record.items():
+                values = postings.get(field)
+                if values is None:
+                    continue
+                key = sys.intern(value if type(value) is str else str(value))
+                rows = values.get(key)
+                if rows is None:
+                    rows = values[key] = array("I")
+                    nbytes += _KEY_BYTES if key is value else _KEY_BYTES + sys.getsizeof(key)
+                rows.append(row)
+                nbytes += rows.itemsize
+        for field, index in self.sorted.items():
+            index.insert_many((record.get(field), row) for row, record in enumerate(records, first))
+            nbytes += len(records) * _SORTED_ROW_BYTES
+        self.nbytes += nbytes
+
+    def _live(self, rows):
+        records = self.records
+        return [records[row] for row in sorted(set(rows) - self.dead)]
+
+    def lookup(self, field, values):
+        """Return the live records whose ``field`` has one of ``values``."""
+        rows = set()
+        for value in values:
+            rows.update(self._rows(field, value))
+        return self._live(rows)
+
+    def range(self, field, lower=None, upper=None):
+        """Return the live records of a sorted field's range, in file order."""
+        return self._live(self.sorted[field].range(lower, upper))
+
+    def ordered(self, field, reverse=False):
+        """Yield ``(key, record)`` of the live records in key order."""
+        records, dead = self.records, self.dead
+        for key, row in self.sorted[field].ordered(reverse):
+            if row not in dead:
+                yield key, records[row]
+
+    def live(self):
+        """Return the live records in file order; not to be modified."""
+        if not self.dead:
+            return self.records
+        dead = self.dead
+        return [record for row, record in enumerate(self.records) if row not in dead]
+
+
+class IndexStore:
+    """The partition indexes of one database, least recently used evicted."""
+
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is None:
+            self._max_bytes = getattr(settings, "PUDB_INDEX_BYTES", DEFAULT_MAX_BYTES)
+        return self._max_bytes
+
+    def configure(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, model_name, date_str):
+        with self._lock:
+            key = (model_name, date_str)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, model_name, date_str, index):
+        """Store ``index``, or account for how much it grew."""
+        with self._lock:
+            key = (model_name, date_str)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if index.nbytes > self.max_bytes:
+                return
+            self._entries[key] = (index, index.nbytes)
+            self.size += index.nbytes
+            self._evict()
+
+    def drop(self, model_name, date_str):
+        with self._lock:
+            old = self._entries.pop((model_name, date_str), None)
+            if old is not None:
+                self.size -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self.size, "max_bytes": self.max_bytes}
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            _, old = self._entries.popitem(last=False)
+            self.size -= old[1]
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def store_for(db_root):
+    """Return the :class:`IndexStore` of the database at ``db_root``."""
+    key = os.path.abspath(db_root)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = IndexStore()
+        return _stores[key]
@@ -0,0 +1,173 @@
+"""Persisted field indexes of a partition.
+
+``Y/M/D/<Model>.idx`` sits next to ``<Model>.pu`` and maps, per field, the
+``str()`` of every value to the ``[frame offset, position]`` of the rows
+holding it.  A process that has not indexed a partition yet answers an
+``exact`` or ``in`` lookup from it by decrypting only the frames with hits,
+instead of the whole partition.
+
+A snapshot is a :class:`~.partition_log.PartitionLog` of a single
+partition, so it is replayed, extended and rewritten like the manifest and
+the locator.  The payload of every entry is ::
+
+    {"postings": {field: {value: [[offset, position], ...]}}, "revisions": n}
+
+Snapshots are only written on the write path: the first frame of a
+partition starts one, every frame appended by ``save`` extends it, and
+compaction describes the partitions it rewrites from the records it
+already holds.  A lookup only uses a snapshot that covers the whole
+partition file; otherwise it indexes the partition, so reads never decrypt
+a partition just to describe it.
+
+Partitions holding updated versions or tombstones are not answered from
+the snapshot (``revisions`` counts them), because telling which rows are
+live needs every version of a record.
+
+A snapshot answers the first lookup of a partition in a process; after
+that the partition is worth indexing in memory, which later lookups do.
+An :class:`IndexSnapshot` only remembers what its file covers: the
+postings are read for the lookup they answer and let go, so memory stays
+with the indexes of :mod:`.field_index` and their budget.
+"""
+import os
+
+from . import storage
+from .partition_log import PartitionLog
+
+
+def snapshot_path(partition_path):
+    return f"{os.path.splitext(partition_path)[0]}.idx"
+
+
+class IndexSnapshot(PartitionLog):
+    def __init__(self, date_str, partition_path, fernet, fields):
+        super().__init__(snapshot_path(partition_path), fernet)
+        self.date_str = date_str
+        self.partition_path = partition_path
+        self.fields = tuple(fields)
+        # fields every counted entry has postings for, None before the first
+        self.covered = None
+        self.revisions = 0
+        # set once a lookup was answered from the snapshot
+        self.answered = False
+
+    def clear(self):
+        self.covered = None
+        self.revisions = 0
+
+    def describe(self, frames):
+        postings = {field: {} for field in self.fields}
+        revisions = 0
+        for offset, records in frames:
+            for position, record in enumerate(records):
+                if storage.REVISION in record:
+                    revisions += 1
+                for field, values in postings.items():
+                    if field in record:
+                        values.setdefault(str(record[field]), []).append([offset, position])
+        return {"postings": postings, "revisions": revisions}
+
+    def apply_payload(self, date_str, replace, end, payload):
+        fields = frozenset(payload["postings"])
+        if replace or self.covered is None:
+            self.covered, self.revisions = fields, 0
+        else:
+            self.covered &= fields
+        self.revisions += payload["revisions"]
+
+    def payload(self, date_str):
+        covered = self.covered or ()
+        postings = _Postings(self.path, self.fernet, covered)
+        postings.load()
+        return {
+            "postings": {field: postings.postings.get(field, {}) for field in covered},
+            "revisions": self.revisions,
+        }
+
+    def record_append(self, date_str, path, offset, end, records):
+        """Describe a frame this process just appended.
+
+        The first frame of a partition starts its snapshot; a snapshot that
+        fell behind is caught up here rather than by a lookup.
+        """
+        if not self.exists():
+            if offset != len(storage.MAGIC):
+                return
+            self.create()
+        super().record_append(date_str, path, offset, end, records)
+        if not self.is_current(date_str, path):
+            self.refresh(date_str, path)
+
+    def rewrite(self, frames):
+        """Describe the partition from the ``(offset, records)`` frames it
+        was just rewritten with, without reading it back."""
+        st = os.stat(self.partition_path)
+        entry = [self.date_str, st.st_ino, None, st.st_size, self.describe(frames)]
+        storage.write_records(self.path, self.fernet, [entry])
+        self.load()
+
+    def can_answer(self, field):
+        """Whether a lookup on ``field`` can be answered from the snapshot."""
+        if not self.exists():
+            return False
+        self.load()
+        return (
+            self.date_str in self.coverage
+            and self.is_current(self.date_str, self.partition_path)
+            and not self.revisions
+            and field in (self.covered or ())
+        )
+
+    def lookup(self, field, values):
+        """Return the records whose ``field`` has one of ``values``.
+
+        Only the frames holding hits are decrypted; rows come in file order.
+        Returns ``None`` when a frame cannot be read any more.
+        """
+        self.answered = True
+        postings = _Postings(self.path, self.fernet, (field,), {str(value) for value in values})
+        postings.load()
+        if postings.coverage != self.coverage:
+            # rewritten since can_answer()
+            return None
+        hits = sorted({
+            (offset, position)
+            for rows in postings.postings.get(field, {}).values()
+            for offset, position in rows
+        })
+        records = []
+        frame_offset, frame = None, None
+        for offset, position in hits:
+            if offset != frame_offset:
+                frame_offset = offset
+                frame = storage.read_frame(self.partition_path, self.fernet, offset)
+                if frame is None:
+                    return None
+            if position < len(frame):
+                records.append(frame[position])
+        return records
+
+
+class _Postings(PartitionLog):
+    """Replays a snapshot keeping the postings of ``fields``, limited to
+    ``keys`` when given."""
+
+    def __init__(self, path, fernet, fields, keys=None):
+        super().__init__(path, fernet)
+        self.fields = frozenset(fields)
+        self.keys = keys
+        self.postings = {}
+
+    def clear(self):
+        self.postings = {}
+
+    def apply_payload(self, date_str, replace, end, payload):
+        if replace:
+            self.postings = {}
+        for field, values in payload["postings"].items():
+            if field not in self.fields:
+                continue
+            mine = self.postings.setdefault(field, {})
+            for key, rows in values.items():
+                if self.keys is None or key in self.keys:
+                    mine.setdefault(key, []).extend(rows)
@@ -0,0 +1,47 @@
+"""Persistent primary-key locator for pudb models.
+
+``<db_root>/_pudb/<Model>.loc`` maps record ids to the partition and frame
+offset they were written at, so fetching a record by id decrypts exactly one
+frame.  The payload of every log entry is ``[[id, offset], ...]``.
+"""
+from .partition_log import PartitionLog
+
+
+class Locator(PartitionLog):
+    suffix = ".loc"
+
+    def __init__(self, path, fernet):
+        super().__init__(path, fernet)
+        self.ids = {}
+        # partition -> {id: offset} of the ids it holds, so replacing or
+        # describing a partition never walks every id of the model
+        self.partitions = {}
+
+    def clear(self):
+        self.ids = {}
+        self.partitions = {}
+
+    def payload(self, date_str):
+        return [[record_id, offset] for record_id, offset in self.partitions.get(date_str, {}).items()]
+
+    def describe(self, frames):
+        return [[record.get("id"), offset] for offset, records in frames for record in records]
+
+    def apply_payload(self, date_str, replace, end, payload):
+        ids = self.ids
+        if replace:
+            for record_id in self.partitions.pop(date_str, {}):
+                del ids[record_id]
+        located = self.partitions.setdefault(date_str, {})
+        for record_id, offset in payload:
+            home = ids.get(record_id)
+            if home is not None and home[0] != date_str:
+                del self.partitions[home[0]][record_id]
+            ids[record_id] = (date_str, offset)
+            located[record_id] = offset
+        if not located:
+            del self.partitions[date_str]
+
+    def locate(self, record_id):
+        self.load()
+        return self.ids.get(record_id)
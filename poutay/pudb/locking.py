@@ -0,0 +1,67 @@
+"""Advisory file locks shared between processes.
+
+Every file pudb writes has a ``<file>.lock`` companion that is locked with
+``fcntl.flock``: shared while a reader copies the file, exclusive while a
+writer appends to or replaces it.  Locking the companion rather than the
+file itself keeps the lock valid across the rename that replaces a file.
+
+Readers therefore never wait for each other, and a writer only waits for
+the files it touches.  A thread already holding a lock on a path may lock
+it again without blocking on itself, as long as it does not ask for an
+exclusive lock inside a shared one.  Where ``fcntl`` is not available
+(Windows) locking is a no-op.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_local = threading.local()
+
+
+def _held():
+    held = getattr(_local, "held", None)
+    if held is None:
+        held = _local.held = {}
+    return held
+
+
+@contextmanager
+def locked(path, exclusive=True):
+    """Hold a shared or ``exclusive`` lock on ``path`` for the block.
+
+    A shared lock on a file that does not exist is not taken, so readers
+    never leave lock files behind for partitions that were never written.
+    """
+    path = os.path.abspath(path)
+    held = _held()
+    mode = held.get(path)
+    if mode is not None:
+        if exclusive and not mode[1]:
+            raise RuntimeError(f"cannot upgrade the shared lock on {path}")
+        mode[0] += 1
+        try:
+            yield
+        finally:
+            mode[0] -= 1
+        return
+    if fcntl is None or not exclusive and not os.path.exists(path):
+        yield
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        held[path] = [1, exclusive]
+        try:
+            yield
+        finally:
+            del held[path]
+    finally:
+        # closing the descriptor releases the lock
+        os.close(fd)
@@ -0,0 +1,170 @@
+"""Filter lookups compiled into row predicates.
+
+A queryset's filters are turned into one function over decoded records
+before any partition is read: every ``field__op`` key is split once, lookup
+values are converted once (``str()`` for ``exact``, lower-casing for
+``icontains``, a set for ``in``) and the per-row work is a dict lookup and a
+comparison.
+
+Supported lookups are ``exact`` (the default), ``contains``, ``icontains``,
+``startswith``, ``gt``, ``gte``, ``lt``, ``lte``, ``in``, ``range`` and
+``isnull``.  :class:`Q` combines them with ``|``, ``&`` and ``~``::
+
+    Order.objects().filter(Q(customer="Ali") | Q(amount__gte=100))
+"""
+import operator
+
+LOOKUPS = (
+    "exact", "contains", "icontains", "startswith",
+    "gt", "gte", "lt", "lte", "in", "range", "isnull",
+)
+
+_COMPARISONS = {"gt": operator.gt, "gte": operator.ge, "lt": operator.lt, "lte": operator.le}
+
+
+def split_lookup(key):
+    """Return ``(field, op)`` for a ``field__op`` filter key."""
+    field, _, op = key.partition("__")
+    return field, op or "exact"
+
+
+class Q:
+    """A combinable filter condition."""
+
+    AND = "AND"
+    OR = "OR"
+
+    def __init__(self, *children, connector=AND, negated=False, **filters):
+        self.children = list(children) + sorted(filters.items())
+        self.connector = connector
+        self.negated = negated
+
+    def _combine(self, other, connector):
+        if not isinstance(other, Q):
+            raise TypeError(f"Cannot combine Q with {type(other).__name__}")
+        return Q(self, other, connector=connector)
+
+    def __or__(self, other):
+        return self._combine(other, self.OR)
+
+    def __and__(self, other):
+        return self._combine(other, self.AND)
+
+    def __invert__(self):
+        return Q(self, negated=True)
+
+    def __repr__(self):
+        prefix = "~" if self.negated else ""
+        return f"{prefix}Q({self.connector}: {self.children!r})"
+
+
+def _text(value):
+    return value if type(value) is str else str(value)
+
+
+def _compile_lookup(key, value):
+    field, op = split_lookup(key)
+    if op not in LOOKUPS:
+        raise ValueError(f"Unsupported lookup '{op}' in filter '{key}'")
+
+    if op == "exact":
+        # values compare by their str() form, as they did before compiling
+        target = str(value)
+        if type(value) is str:
+            return lambda item: (v := item.get(field)) == target or (
+                type(v) is not str and str(v) == target
+            )
+        return lambda item: str(item.get(field)) == target
+    if op == "contains":
+        target = str(value)
+        return lambda item: target in _text(item.get(field))
+    if op == "icontains":
+        target = str(value).lower()
+        return lambda item: target in _text(item.get(field)).lower()
+    if op == "startswith":
+        target = str(value)
+        return lambda item: _text(item.get(field)).startswith(target)
+    if op == "isnull":
+        wanted = bool(value)
+        return lambda item: (item.get(field) is None) is wanted
+    if op == "in":
+        try:
+            members = frozenset(value)
+        except TypeError:
+            members = list(value)
+
+        def predicate(item):
+            try:
+                return item.get(field) in members
+            except TypeError:
+                return False
+        return predicate
+
+    if op == "range":
+        low, high = value
+
+        def predicate(item):
+            try:
+                return low <= item.get(field) <= high
+            except TypeError:
+                return False
+        return predicate
+
+    compare = _COMPARISONS[op]
+
+    def predicate(item):
+        # None and values of another type never match a range lookup
+        try:
+            return compare(item.get(field), value)
+        except TypeError:
+            return False
+    return predicate
+
+
+def _both(first, second):
+    return lambda item: first(item) and second(item)
+
+
+def _either(first, second):
+    return lambda item: first(item) or second(item)
+
+
+def _all(predicates):
+    if not predicates:
+        return lambda item: True
+    # nested two-way closures short-circuit without a generator per row
+    predicate = predicates[-1]
+    for other in reversed(predicates[:-1]):
+        predicate = _both(other, predicate)
+    return predicate
+
+
+def _any(predicates):
+    predicate = predicates[-1]
+    for other in reversed(predicates[:-1]):
+        predicate = _either(other, predicate)
+    return predicate
+
+
+def _compile_q(q):
+    predicates = [
+        _compile_q(child) if isinstance(child, Q) else _compile_lookup(*child)
+        for child in q.children
+    ]
+    if q.connector == Q.OR and predicates:
+        predicate = _any(predicates)
+    else:
+        predicate = _all(predicates)
+    if q.negated:
+        return lambda item: not predicate(item)
+    return predicate
+
+
+def compile_filters(filters, *conditions):
+    """Compile keyword ``filters`` and ``Q`` conditions into one predicate.
+
+    All of them have to hold for a record to match.
+    """
+    predicates = [_compile_lookup(key, value) for key, value in filters.items()]
+    predicates += [_compile_q(q) for q in conditions]
+    return _all(predicates)
@@ -0,0 +1,173 @@
+"""Per-model partition manifest with zone maps.
+
+``<db_root>/_pudb/<Model>.manifest`` lists the partitions of a model with
+their row count, byte size and, per field, the smallest and largest non-null
+value (a zone map) and the count and sum of its non-null values.  Queries
+use it instead of walking ``_db_root`` and skip partitions whose zone maps
+prove that no row can match a filter; unfiltered counts and aggregates are
+answered from it directly.
+
+The payload of every log entry is ::
+
+    {"rows": n, "zones": {field: [lo, hi]}, "totals": {field: [count, sum]},
+     "revisions": n}
+
+for the frames it describes.  ``revisions`` counts updated versions and
+tombstones; rows, totals and zones include them, so a partition with
+revisions has to be read to be counted exactly.  A field's sum is ``null`` once a value that
+is not a number was seen.  Entries written before totals existed leave the
+partition's totals unknown until it is described again.
+"""
+from . import storage
+from .lookups import split_lookup
+from .partition_log import PartitionLog
+from .field_index import sort_key
+
+
+def zone_maps(records, zones=None):
+    """Widen ``zones`` with the non-null field values of ``records``."""
+    zones = {} if zones is None else zones
+    for record in records:
+        for field, value in record.items():
+            if value is None:
+                continue
+            zone = zones.get(field)
+            if zone is None:
+                zones[field] = [value, value]
+                continue
+            key = sort_key(value)
+            if key < sort_key(zone[0]):
+                zone[0] = value
+            elif key > sort_key(zone[1]):
+                zone[1] = value
+    return zones
+
+
+def field_totals(records, totals=None):
+    """Add the non-null values of ``records`` to per-field ``[count, sum]``."""
+    totals = {} if totals is None else totals
+    for record in records:
+        for field, value in record.items():
+            if value is None:
+                continue
+            total = totals.get(field)
+            if total is None:
+                total = totals[field] = [0, 0]
+            total[0] += 1
+            if total[1] is not None:
+                total[1] = total[1] + value if type(value) in (int, float) else None
+    return totals
+
+
+def _outside(zone, op, value):
+    """Whether no value inside ``zone`` can satisfy ``field__op=value``."""
+    lo, hi, key = sort_key(zone[0]), sort_key(zone[1]), sort_key(value)
+    # only zones of a single kind of number or string can be compared with
+    # the lookup value; exact compares str() forms and None is left out of
+    # the zone, so "None" is never pruned
+    if lo[0] != hi[0] or lo[0] not in (1, 2) or key[0] != lo[0]:
+        return False
+    if op == "exact":
+        return value != "None" and (key < lo or key > hi)
+    if op == "gt":
+        return hi <= key
+    if op == "gte":
+        return hi < key
+    if op == "lt":
+        return lo >= key
+    if op == "lte":
+        return lo > key
+    return False
+
+
+class Manifest(PartitionLog):
+    suffix = ".manifest"
+
+    def __init__(self, path, fernet):
+        super().__init__(path, fernet)
+        self.partitions = {}
+
+    def clear(self):
+        self.partitions = {}
+
+    def payload(self, date_str):
+        stats = self.partitions[date_str]
+        return {k: stats[k] for k in ("rows", "zones", "totals", "revisions")}
+
+    def describe(self, frames):
+        records = [record for _, frame in frames for record in frame]
+        return {
+            "rows": len(records),
+            "zones": zone_maps(records),
+            "totals": field_totals(records),
+            "revisions": sum(1 for record in records if storage.REVISION in record),
+        }
+
+    def apply_payload(self, date_str, replace, end, payload):
+        if replace and date_str not in self.coverage:
+            self.partitions.pop(date_str, None)
+            return
+        stats = self.partitions.get(date_str)
+        if replace or stats is None:
+            stats = self.partitions[date_str] = {
+                "rows": 0, "bytes": 0, "zones": {}, "totals": {}, "revisions": 0,
+            }
+        stats["rows"] += payload["rows"]
+        stats["revisions"] += payload.get("revisions", 0)
+        stats["bytes"] = max(stats["bytes"], end or 0)
+        for field, (lo, hi) in payload["zones"].items():
+            zone_maps([{field: lo}, {field: hi}], stats["zones"])
+        totals = payload.get("totals")
+        if totals is None:
+            stats["totals"] = None
+        elif stats["totals"] is not None:
+            for field, (count, total) in totals.items():
+                mine = stats["totals"].setdefault(field, [0, 0])
+                mine[0] += count
+                mine[1] = None if mine[1] is None or total is None else mine[1] + total
+
+    def key_bounds(self, date_str, field):
+        """Return the smallest and largest :func:`sort_key` of ``field`` in a
+        partition, or ``None`` when the stats cannot tell."""
+        stats = self.partitions.get(date_str)
+        if stats is None or stats["totals"] is None:
+            return None
+        zone = stats["zones"].get(field)
+        if zone is None:
+            return (0,), (0,)
+        # a row without a value sorts first, as None
+        count = stats["totals"].get(field, [0])[0]
+        first = sort_key(zone[0]) if count == stats["rows"] else (0,)
+        return first, sort_key(zone[1])
+
+    def dates(self, date_range=None):
+        """Return the partitions, newest first, limited to ``date_range``."""
+        self.load()
+        dates = sorted(self.partitions, reverse=True)
+        if date_range:
+            date_range = storage.normalize_range(date_range)
+            start, end = date_range
+            dates = [
+                d for d in dates
+                if start <= d <= end
+                or storage.is_monthly(d) and storage.month_overlaps(d, date_range)
+            ]
+        return dates
+
+    def may_match(self, date_str, filters):
+        """Whether the zone maps leave room for a row matching ``filters``."""
+        zones = self.partitions.get(date_str, {}).get("zones", {})
+        for raw_key, value in filters.items():
+            field, op = split_lookup(raw_key)
+            zone = zones.get(field)
+            if zone is None or value is None:
+                continue
+            if op == "in" and isinstance(value, (list, tuple, set, frozenset)):
+                if all(v is not None and _outside(zone, "exact", v) for v in value):
+                    return False
+            elif op == "range" and isinstance(value, (list, tuple)) and len(value) == 2:
+                if _outside(zone, "gte", value[0]) or _outside(zone, "lte", value[1]):
+                    return False
+            elif _outside(zone, op, value):
+                return False
+        return True
@@ -1,4 +1,6 @@
-import json
+import heapq
+from contextlib import closing
+from itertools import islice
 import os
 from datetime import datetime
 from typing import Optional
@@ -6,15 +8,23 @@ import uuid
 from .auth import AuthManager
 import re
 
+from poutay.conf import settings
+
+from . import aio, field_index, index_snapshot, scan, session, storage, transaction, writer
+from .aggregates import Avg, Count, Max, Min, Sum
+from .locator import Locator
+from .lookups import Q, compile_filters, split_lookup
+from .manifest import Manifest
 from .encryption import get_fernet_key
 from .queryset import QuerySet
-from .tree_index import TreeNode
 
 
 class Field:
-    def __init__(self, label=None, default=None):
+    def __init__(self, label=None, default=None, index=None):
         self.label = label
         self.default = default
+        # index="sorted" keeps an ordered index for range lookups and order_by
+        self.index = index
 
 
 class RelatedField:
@@ -97,53 +107,89 @@ class BaseModelMeta(type):
 
 
 class M2MQuerySetWrapper:
-    def __init__(self, instance, through, to_model, from_field, to_field):
+    def __init__(self, instance, through, to_model, from_field, to_field, name=None):
         self.instance = instance
         self.through = through
         self.to_model = to_model
         self.from_field = from_field
         self.to_field = to_field
+        # prefetch_related() leaves the related objects in _<name>_cache
+        self._cache_name = f"_{name}_cache"
+        self._queryset = instance.__dict__.get(self._cache_name)
+
+    def _reset(self):
         self._queryset = None
+        self.instance.__dict__.pop(self._cache_name, None)
 
     def _fetch_queryset(self):
         if self._queryset is None:
             # گرفتن رکوردهای پیوند خورده از جدول میانی
-            links = self.through.objects().filter(**{
-                self.from_field: self.instance.id
-            }).all()
-            ids = [getattr(link, self.to_field) for link in links]
+            ids = list(self._linked_ids())
             self._queryset = self.to_model.objects().filter(id__in=ids)
         return self._queryset
 
+    def _links(self):
+        return self.through.objects().filter(**{self.from_field: self.instance.id})
+
+    def _linked_ids(self):
+        """Ids linked to the instance, read from the through table once.
+
+        Inside ``atomic()`` links still waiting in the batch count too.
+        """
+        links = dict(self._links().values_list("id", self.to_field))
+        uow = transaction.current()
+        if uow is not None:
+            for record in uow.buffered(self.through):
+                if record.get(storage.DELETED) or record.get(self.from_field) != self.instance.id:
+                    links.pop(record.get("id"), None)
+                else:
+                    links[record.get("id")] = record.get(self.to_field)
+        return dict.fromkeys(links.values())
+
+    @staticmethod
+    def _ids(objs):
+        return dict.fromkeys(getattr(obj, "id", obj) for obj in objs)
+
+    def _link(self, ids):
+        self.through.bulk_create([
+            self.through(**{self.from_field: self.instance.id, self.to_field: i})
+            for i in ids
+        ])
+
+    def _unlink(self, ids):
+        self._links().filter(**{f"{self.to_field}__in": list(ids)}).delete()
+
     def add(self, *objs):
-        for obj in objs:
-            # جلوگیری از دوباره اضافه شدن
-            existing = self.through.objects().filter(
-                **{
-                    self.from_field: self.instance.id,
-                    self.to_field: obj.id
-                }
-            ).first()
-            if not existing:
-                link = self.through(**{
-                    self.from_field: self.instance.id,
-                    self.to_field: obj.id
-                })
-                link.save()
-        self._queryset = None  # کش را پاک کن
-
-    def remove(self, obj):
-        self.through.delete(**{
-            self.from_field: self.instance.id,
-            self.to_field: obj.id
-        })
-        self._queryset = None
+        """Link ``objs`` (instances or ids); existing links are kept once."""
+        existing = self._linked_ids()
+        new = [i for i in self._ids(objs) if i not in existing]
+        if new:
+            self._link(new)
+        self._reset()  # کش را پاک کن
+
+    def remove(self, *objs):
+        existing = self._linked_ids()
+        gone = [i for i in self._ids(objs) if i in existing]
+        if gone:
+            self._unlink(gone)
+        self._reset()
+
+    def set(self, objs):
+        """Link exactly ``objs``, writing only the links that change."""
+        existing = self._linked_ids()
+        wanted = self._ids(objs)
+        with self.through.atomic():
+            gone = [i for i in existing if i not in wanted]
+            if gone:
+                self._unlink(gone)
+            new = [i for i in wanted if i not in existing]
+            if new:
+                self._link(new)
+        self._reset()
 
     def clear(self):
-        self.through.delete(**{
-            self.from_field: self.instance.id
-        })
-        self._queryset = None
+        self._links().delete()
+        self._reset()
 
     def all(self):
         return self._fetch_queryset()
@@ -161,24 +207,43 @@ class M2MQuerySetWrapper:
         return getattr(self._fetch_queryset(), item)
 
 
+class _Descending:
+    """A sort key that orders in reverse, for max-heaps built on ``heapq``."""
+
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __le__(self, other):
+        return other.key <= self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
 class BaseModel(metaclass=BaseModelMeta):
     base_model = None
     _auth = None
     _password = None
     _db_root = 'mydb'
-    _indexes = {}
-    _cache_loaded_dates = set()
+    # (database, model) -> partition logs; partition path -> IndexSnapshot
+    _locators = {}
+    _manifests = {}
+    _snapshots = {}
 
     def __init__(self, **kwargs):
         if "id" in self._declared_fields and "id" not in kwargs:
             kwargs["id"] = str(uuid.uuid4())
 
         for field in self._declared_fields:
-            setattr(self, field, kwargs.get(field))
+            if field not in self._declared_relations:
+                setattr(self, field, kwargs.get(field))
         for rel_field in self._declared_relations:
-            value = kwargs.get(rel_field)
-            setattr(self, f"_{rel_field}_id", value)  # فقط id ذخیره می‌کنیم
-            setattr(self, f"_{rel_field}_cache", None)
+            setattr(self, rel_field, kwargs.get(rel_field))
         for m2m_field in getattr(self.__class__, '_declared_m2m_fields', []):
             setattr(self, f"_{m2m_field}_ids", [])
 
@@ -201,13 +266,36 @@ class BaseModel(metaclass=BaseModelMeta):
                 through=field.through,
                 to_model=field.to_model,
                 from_field="from_model",
-                to_field="to_model"
+                to_field="to_model",
+                name=name
             )
+        elif name in cls._declared_relations:
+            if name in self.__dict__.get("_deferred", ()):
+                self._load_deferred()
+            # the class attribute is the field itself; resolve the related object
+            return self.__getattr__(name)
         else:
-            return super().__getattribute__(name)
+            value = super().__getattribute__(name)
+            if isinstance(value, Field) and name in cls._declared_fields:
+                # a field only() left out: the instance has no value for it yet
+                self._load_deferred()
+                return super().__getattribute__(name)
+            return value
         # اگر هیچ چیز پیدا نشد
         raise AttributeError(f"{name} not found in {cls.__name__}")
 
+    def __setattr__(self, name, value):
+        if name in self._declared_relations:
+            # فقط id ذخیره می‌کنیم؛ خود شیء با اولین دسترسی خوانده می‌شود
+            if isinstance(value, BaseModel):
+                rel_id, cache = value.id, value
+            else:
+                rel_id, cache = value, None
+            super().__setattr__(f"_{name}_id", rel_id)
+            super().__setattr__(f"_{name}_cache", cache)
+            return
+        super().__setattr__(name, value)
+
     def __getattr__(self, name):
         if name in self._declared_relations:
             rel_field = self._declared_relations[name]
@@ -230,6 +318,9 @@ class BaseModel(metaclass=BaseModelMeta):
                 related_obj = model_cls.objects().filter(id=rel_id).first()
                 setattr(self, f"_{name}_cache", related_obj)
                 return related_obj
+        if f"_{name}_cache" in self.__dict__:
+            # reverse relation filled by prefetch_related()
+            return self.__dict__[f"_{name}_cache"]
         if hasattr(self.__class__, '_reverse_m2m'):
             m2m_map = self.__class__._reverse_m2m
             if name in m2m_map:
@@ -239,7 +330,7 @@ class BaseModel(metaclass=BaseModelMeta):
                 to_model = conf["to_model"] or None  # در صورت نیاز قابل تنظیم
 
                 links = through.objects().filter(**{from_field: self.id}).all()
-                ids = [link.from_model for link in links]
+                ids = [link._from_model_id for link in links]
                 return conf["to_model"].objects().filter(id__in=ids)
         if hasattr(self.__class__, "_reverse_relations"):
             reverse_map = self.__class__._reverse_relations
@@ -270,7 +361,7 @@ class BaseModel(metaclass=BaseModelMeta):
 
                 def all(self):
                     links = through.objects().filter(from_model=self.instance.id).all()
-                    ids = [link.to_model for link in links]
+                    ids = [link._to_model_id for link in links]
                     return to_model.objects().filter(id__in=ids)
 
                 def remove(self, obj):
@@ -283,6 +374,8 @@ class BaseModel(metaclass=BaseModelMeta):
     def to_dict(self):
         data = {}
         for f in self._declared_fields :
+            if f in self._declared_relations:
+                continue
             val = getattr(self, f)
             if not val:
                 val = getattr(self._declared_fields[f], "default")
@@ -295,198 +388,706 @@ class BaseModel(metaclass=BaseModelMeta):
 
     @classmethod
     def from_dict(cls, data):
+        identity = session.current()
+        if identity is not None:
+            held = identity.get(cls, data.get("id"))
+            if held is not None:
+                return held
         kwargs = {}
         for f in cls._declared_fields:
             kwargs[f] = data.get(f)
         for r in cls._declared_relations:
             kwargs[r] = data.get(r)
-        return cls(**kwargs)
+        obj = cls(**kwargs)
+        if identity is not None and obj.id is not None:
+            identity.add(obj)
+        return obj
+
+    @classmethod
+    def _partial(cls, data, fields):
+        """Build an instance from ``fields`` of ``data`` without ``__init__``.
+
+        The other fields are loaded from the stored row on first access.
+        """
+        obj = cls.__new__(cls)
+        for field in fields:
+            setattr(obj, field, data.get(field))
+        for m2m_field in cls._declared_m2m_fields:
+            setattr(obj, f"_{m2m_field}_ids", [])
+        obj._deferred = frozenset(cls._declared_fields).difference(fields)
+        return obj
+
+    def _load_deferred(self):
+        deferred = self.__dict__.pop("_deferred", ())
+        if not deferred:
+            return
+        found = type(self)._search_records({"id": self.id}, limit=1)
+        record = found[0] if found else {}
+        for field in deferred:
+            setattr(self, field, record.get(field))
+
+    @classmethod
+    def _relation_kind(cls, name):
+        """Return how ``name`` relates this model to another, or ``None``."""
+        if name in cls._declared_relations:
+            return "forward"
+        if name in cls._declared_m2m_fields:
+            return "m2m"
+        if name in getattr(cls, "_reverse_m2m", {}):
+            return "reverse_m2m"
+        if name in getattr(cls, "_reverse_relations", {}):
+            return "reverse"
+        return None
+
+    @classmethod
+    def _prefetch(cls, instances, name):
+        """Resolve relation ``name`` of all ``instances`` in one batched query.
+
+        The related objects are left in each instance's ``_<name>_cache``
+        slot, which attribute access returns before querying anything.
+        """
+        instances = [
+            obj for obj in instances if name not in obj.__dict__.get("_deferred", ())
+        ]
+        if not instances:
+            return
+        kind = cls._relation_kind(name)
+        slot = f"_{name}_cache"
+        if kind == "forward":
+            ids = {obj.__dict__.get(f"_{name}_id") for obj in instances}
+            ids = [i for i in ids if isinstance(i, str)]
+            to_model = cls._declared_relations[name].to_model
+            related = {o.id: o for o in to_model.objects().filter(id__in=ids)} if ids else {}
+            for obj in instances:
+                rel_id = obj.__dict__.get(f"_{name}_id")
+                if isinstance(rel_id, str):
+                    obj.__dict__[slot] = related.get(rel_id)
+        elif kind == "reverse":
+            model_name, field_name, rel_type = cls._reverse_relations[name][0]
+            model_cls = cls.base_model._registry[model_name]
+            rows = model_cls.objects().filter(**{f"{field_name}__in": [o.id for o in instances]})
+            grouped = {}
+            for row in rows:
+                grouped.setdefault(row.__dict__.get(f"_{field_name}_id"), []).append(row)
+            for obj in instances:
+                found = grouped.get(obj.id, [])
+                if rel_type is OneToOne:
+                    obj.__dict__[slot] = found[0] if found else None
+                else:
+                    obj.__dict__[slot] = model_cls.objects().filter(**{field_name: obj.id})
+                    obj.__dict__[slot]._result_cache = found
+        elif kind in ("m2m", "reverse_m2m"):
+            if kind == "m2m":
+                through = getattr(cls, name).through
+                from_field, to_field, target = "from_model", "to_model", getattr(cls, name).to_model
+            else:
+                conf = cls._reverse_m2m[name]
+                through, target = conf["through"], conf["to_model"]
+                from_field, to_field = conf["from_field"], conf["to_field"]
+            links = through.objects().filter(
+                **{f"{from_field}__in": [o.id for o in instances]}
+            ).values_list(from_field, to_field)
+            linked = {}
+            for source, dest in links:
+                linked.setdefault(source, set()).add(dest)
+            ids = set().union(*linked.values())
+            targets = list(target.objects().filter(id__in=list(ids))) if ids else []
+            for obj in instances:
+                mine = linked.get(obj.id, set())
+                qs = target.objects().filter(id__in=list(mine))
+                # same order as the query the relation would run
+                qs._result_cache = [t for t in targets if t.id in mine]
+                obj.__dict__[slot] = qs
+        else:
+            raise ValueError(f"{cls.__name__} has no relation '{name}'")
 
     @classmethod
     def objects(cls):
         return QuerySet(cls)
 
     @classmethod
-    def _get_file_path(cls, date_str):
+    def _partition_path(cls, date_str):
         y, m, d = date_str.split("-")
-        path = os.path.join(cls._db_root, y, m, d)
-        os.makedirs(path, exist_ok=True)
-        return os.path.join(path, f"{cls.__name__}.pu")
+        return os.path.join(cls._db_root, y, m, d, f"{cls.__name__}.pu")
 
-    def save(self):
-        if not self.__class__._auth or not self.__class__._auth.is_authenticated():
-            raise PermissionError("Login required")
+    @classmethod
+    def _get_file_path(cls, date_str):
+        path = cls._partition_path(date_str)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
 
-        now = datetime.now()
-        date_str = now.strftime("%Y-%m-%d")
-        file_path = self._get_file_path(date_str)
-        fernet = get_fernet_key(self.__class__._password)
-        data = []
+    @classmethod
+    def _walk_partitions(cls):
+        """Find the model's partition files by walking ``_db_root``."""
+        filename = f"{cls.__name__}.pu"
+        for root, _, files in os.walk(cls._db_root):
+            if filename not in files:
+                continue
+            date_str = "-".join(root.split(os.sep)[-3:])
+            try:
+                # day 00 holds a month merged by compact()
+                datetime.strptime(date_str.replace("-00", "-01", 1) if storage.is_monthly(date_str) else date_str, "%Y-%m-%d")
+            except ValueError:
+                continue
+            yield date_str, os.path.join(root, filename)
 
-        if os.path.exists(file_path):
-            with open(file_path, 'rb') as f:
-                try:
-                    decrypted = fernet.decrypt(f.read())
-                    data = json.loads(decrypted.decode())
-                except:
-                    pass
+    @classmethod
+    def _manifest(cls):
+        key = (os.path.abspath(cls._db_root), cls.__name__)
+        if key not in cls._manifests:
+            manifest = Manifest.for_model(cls._db_root, cls.__name__, get_fernet_key(cls._password))
+            if not manifest.exists():
+                # database written before manifests existed: describe it once
+                for date_str, file_path in cls._walk_partitions():
+                    manifest.refresh(date_str, file_path)
+                manifest.create()
+            cls._manifests[key] = manifest
+        return cls._manifests[key]
 
+    @classmethod
+    def _partitions(cls, date_range=None, filters=None):
+        """Return ``(date_str, path)`` for each partition, newest first.
+
+        Partitions come from the manifest; with ``filters`` those whose zone
+        maps rule out every row are skipped without being opened.
+        """
+        manifest = cls._manifest()
+        partitions = []
+        for date_str in manifest.dates(date_range):
+            file_path = cls._partition_path(date_str)
+            if filters and not manifest.may_match(date_str, filters):
+                # zone maps only prove something about the file they describe
+                if manifest.is_current(date_str, file_path):
+                    continue
+                manifest.refresh(date_str, file_path)
+                if date_str not in manifest.partitions or not manifest.may_match(date_str, filters):
+                    continue
+            partitions.append((date_str, file_path))
+        return partitions
+
+    @classmethod
+    def _partition_stats(cls, date_range=None):
+        """Return the manifest stats of every partition, newest first.
+
+        Frames the manifest does not cover yet are described first, so only
+        those are decrypted.  Returns ``None`` when ``date_range`` selects
+        part of a merged month, which the stats cannot tell apart.
+        """
+        writer.writer.sync(cls)
+        manifest = cls._manifest()
+        stats = []
+        for date_str in manifest.dates(date_range):
+            if date_range and storage.is_monthly(date_str) and not storage.month_within(date_str, date_range):
+                # only some days of a merged month are selected
+                return None
+            file_path = cls._partition_path(date_str)
+            if not manifest.is_current(date_str, file_path):
+                manifest.refresh(date_str, file_path)
+            if date_str in manifest.partitions:
+                stats.append(manifest.partitions[date_str])
+        return stats
+
+    @classmethod
+    def _check_auth(cls):
+        if not cls._auth or not cls._auth.is_authenticated():
+            raise PermissionError("Login required")
+
+    def save(self):
+        self._check_auth()
         record = self.to_dict()
-        data.append(record)
+        self._append_records(self._version(record), [record])
+        identity = session.current()
+        if identity is not None:
+            identity.add(self)
+
+    def _version(self, record):
+        """Mark ``record`` as a new version of a stored one; return its partition."""
+        home = self._locator().locate(self.id)
+        if home is not None:
+            # a new version of a stored record replaces it in its partition
+            date_str = home[0]
+            record[storage.REVISION] = 1
+            if storage.is_monthly(date_str):
+                stored = self._read_located(self.id, get_fernet_key(self._password))
+                if stored is not None and storage.DATE in stored[3]:
+                    record[storage.DATE] = stored[3][storage.DATE]
+            return date_str
+        uow = transaction.current()
+        if uow is not None and uow.pending(type(self), self.id):
+            record[storage.REVISION] = 1
+        elif writer.writer.pending(type(self), self.id):
+            record[storage.REVISION] = 1
+        return datetime.now().strftime("%Y-%m-%d")
+
+    async def asave(self):
+        """``save()`` on the pudb thread pool, for asyncio code."""
+        return await aio.run(self.save)
 
-        with open(file_path, 'wb') as f:
-            f.write(fernet.encrypt(json.dumps(data).encode()))
+    @classmethod
+    def bulk_create(cls, objs, batch_size=1000):
+        """Save ``objs`` writing one frame per partition file per batch."""
+        cls._check_auth()
+        objs = list(objs)
+        for start in range(0, len(objs), batch_size):
+            # new records land in today's partition, so a batch is usually a
+            # single frame appended to a single file; objects already stored
+            # are written as new versions in their own partitions
+            batches = {}
+            for obj in objs[start:start + batch_size]:
+                record = obj.to_dict()
+                batches.setdefault(obj._version(record), []).append(record)
+            for date_str, records in batches.items():
+                cls._append_records(date_str, records)
+        identity = session.current()
+        if identity is not None:
+            for obj in objs:
+                identity.add(obj)
+        return objs
 
-        self._update_index(record, date_str)
+    @classmethod
+    def atomic(cls):
+        """Batch writes issued inside the block into one flush per file."""
+        return transaction.Atomic()
 
     @classmethod
-    def _update_index(cls, item, date_str):
-        clsname = cls.__name__
-        if clsname not in cls._indexes:
-            cls._indexes[clsname] = {f: TreeNode() for f in cls._declared_fields}
-        for field, value in item.items():
-            cls._indexes[clsname][field].insert([str(value)], item)
-        cls._cache_loaded_dates.add(date_str)
+    def flush(cls):
+        """Write the records the write-behind queue still holds."""
+        return writer.flush()
 
     @classmethod
-    def _build_index(cls, date_range=None):
-        clsname = cls.__name__
-        if clsname not in cls._indexes:
-            cls._indexes[clsname] = {f: TreeNode() for f in cls._declared_fields}
-        fernet = get_fernet_key(cls._password)
+    def session(cls):
+        """Share one instance per stored record inside the block."""
+        return session.Session()
 
-        for root, _, files in os.walk(cls._db_root):
-            for file in files:
-                if not file.endswith('.pu') or not file.startswith(clsname):
-                    continue
-                parts = root.split(os.sep)[-3:]
-                date_str = "-".join(parts)
-                if date_range:
-                    start, end = map(lambda d: datetime.strptime(d, "%Y-%m-%d"), date_range)
-                    current = datetime.strptime(date_str, "%Y-%m-%d")
-                    if not (start <= current <= end):
-                        continue
-                if date_str in cls._cache_loaded_dates:
-                    continue
+    @classmethod
+    def _append_records(cls, date_str, records):
+        uow = transaction.current()
+        if uow is not None:
+            uow.add_append(cls, date_str, records)
+            return
+        if writer.enabled():
+            writer.writer.enqueue(cls, date_str, records)
+            return
+        file_path = cls._get_file_path(date_str)
+        offset, end = transaction.append_records(cls._db_root, cls._password, file_path, records)
+        cls._after_append(date_str, records, offset, end)
 
-                file_path = os.path.join(root, file)
-                with open(file_path, 'rb') as f:
-                    try:
-                        data = json.loads(fernet.decrypt(f.read()).decode())
-                        for item in data:
-                            for field, value in item.items():
-                                cls._indexes[clsname][field].insert([str(value)], item)
-                    except:
-                        continue
-                cls._cache_loaded_dates.add(date_str)
+    @classmethod
+    def _after_append(cls, date_str, records, offset, end):
+        file_path = cls._partition_path(date_str)
+        cls._update_index(records, date_str, offset, end)
+        cls._manifest().record_append(date_str, file_path, offset, end, records)
+        cls._locator().record_append(date_str, file_path, offset, end, records)
+        if cls._use_snapshots():
+            cls._snapshot(date_str).record_append(date_str, file_path, offset, end, records)
 
     @classmethod
-    def _search_with_index(cls, filters, date_range=None, limit: Optional[int] = None):
-        clsname = cls.__name__
+    def _after_rewrite(cls, date_str):
+        file_path = cls._partition_path(date_str)
+        cls._drop_partition_index(date_str)
+        cls._manifest().refresh(date_str, file_path)
+        cls._locator().refresh(date_str, file_path)
 
-        if clsname not in cls._indexes:
-            cls._indexes[clsname] = {f: TreeNode() for f in cls._declared_fields}
-        fernet = get_fernet_key(cls._password)
+    @classmethod
+    def _locator(cls):
+        key = (os.path.abspath(cls._db_root), cls.__name__)
+        if key not in cls._locators:
+            cls._locators[key] = Locator.for_model(
+                cls._db_root, cls.__name__, get_fernet_key(cls._password)
+            )
+        return cls._locators[key]
+
+    @staticmethod
+    def _use_snapshots():
+        return bool(getattr(settings, "PUDB_INDEX_SNAPSHOTS", True))
+
+    @classmethod
+    def _snapshot(cls, date_str):
+        key = os.path.abspath(cls._partition_path(date_str))
+        if key not in cls._snapshots:
+            cls._snapshots[key] = index_snapshot.IndexSnapshot(
+                date_str, key, get_fernet_key(cls._password), cls._declared_fields
+            )
+        return cls._snapshots[key]
+
+    @classmethod
+    def _read_located(cls, record_id, fernet):
+        hit = cls._locator().locate(record_id)
+        if hit is None:
+            return None
+        date_str, offset = hit
+        frame = storage.read_frame(cls._partition_path(date_str), fernet, offset) or []
+        for position, item in reversed(list(enumerate(frame))):
+            if item.get("id") == record_id:
+                return date_str, offset, position, item
+        return None
 
-        def parse_lookup(key):
-            if "__" in key:
-                field, op = key.split("__", 1)
+    @classmethod
+    def _search_by_id(cls, ids, date_range, fernet):
+        """Fetch ``(partition, record)`` by primary key, one frame per record.
+
+        The locator points at the latest version of every id, so a deleted
+        id resolves to its tombstone and is left out.
+        """
+        hits = []
+        missing = []
+        for record_id in dict.fromkeys(ids):
+            hit = cls._read_located(record_id, fernet)
+            if hit is None:
+                missing.append(record_id)
             else:
-                field, op = key, "exact"
-            return field, op
-
-        def match_item(item, filters):
-            for raw_key, value in filters.items():
-                field, op = parse_lookup(raw_key)
-                field_val = item.get(field)
-
-                if op == "exact":
-                    if str(field_val) != str(value): return False
-                elif op == "contains":
-                    if str(value) not in str(field_val): return False
-                elif op == "icontains":
-                    if str(value).lower() not in str(field_val).lower(): return False
-                elif op == "gt":
-                    if not (field_val > value): return False
-                elif op == "lt":
-                    if not (field_val < value): return False
-                elif op == "in":
-                    if field_val not in value: return False
-                else:
-                    return False
-            return True
+                hits.append(hit)
+        if missing:
+            # unknown or stale ids: locate whatever the log does not cover yet
+            locator = cls._locator()
+            partitions = dict(cls._partitions())
+            for date_str in set(locator.coverage) | set(partitions):
+                locator.refresh(date_str, partitions.get(date_str) or cls._partition_path(date_str))
+            for record_id in missing:
+                hit = cls._read_located(record_id, fernet)
+                if hit is not None:
+                    hits.append(hit)
+        if date_range:
+            start, end = date_range
+            hits = [hit for hit in hits if start <= hit[3].get(storage.DATE, hit[0]) <= end]
+        # newest partition first, then file order, like a scan
+        hits.sort(key=lambda hit: (hit[1], hit[2]))
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        return [(hit[0], hit[3]) for hit in hits if not hit[3].get(storage.DELETED)]
 
-        matched_files = []
-        for root, _, files in os.walk(cls._db_root):
-            for file in files:
-                if not file.endswith(".pu") or not file.startswith(clsname):
-                    continue
-                path_parts = root.split(os.sep)[-3:]
-                date_str = "-".join(path_parts)
-                if date_range:
-                    start, end = map(lambda d: datetime.strptime(d, "%Y-%m-%d"), date_range)
-                    current = datetime.strptime(date_str, "%Y-%m-%d")
-                    if not (start <= current <= end):
-                        continue
-                matched_files.append((date_str, os.path.join(root, file)))
-
-        matched_files.sort(key=lambda x: x[0], reverse=True)
-
-        results = []
-        for date_str, file_path in matched_files:
-            try:
-                with open(file_path, "rb") as f:
-                    decrypted = fernet.decrypt(f.read())
-                    items = json.loads(decrypted.decode())
-            except:
+    @classmethod
+    def _index_store(cls):
+        return field_index.store_for(cls._db_root)
+
+    @classmethod
+    def _sorted_fields(cls):
+        return [
+            name for name, field in cls._declared_fields.items()
+            if getattr(field, "index", None) == "sorted"
+        ]
+
+    @classmethod
+    def _drop_partition_index(cls, date_str):
+        cls._index_store().drop(cls.__name__, date_str)
+
+    @classmethod
+    def _update_index(cls, items, date_str, offset, end):
+        """Index records this process just appended to a partition."""
+        store = cls._index_store()
+        index = store.get(cls.__name__, date_str)
+        if index is None:
+            # never indexed: the next lookup reads the whole partition
+            return
+        if index.end != offset:
+            # someone else appended in between; catch up lazily on lookup
+            return
+        index.add(items)
+        index.end = index.size = end
+        store.put(cls.__name__, date_str, index)
+
+    @classmethod
+    def _ensure_indexed(cls, date_str, file_path, fernet):
+        """Return the index of one partition, brought up to date with its file.
+
+        Appended frames are indexed incrementally; a partition that was
+        rewritten (new inode, shrunk, or a legacy blob) is indexed again from
+        scratch.  The index is returned even when the store has no room left
+        to keep it.
+        """
+        store = cls._index_store()
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            store.drop(cls.__name__, date_str)
+            return field_index.PartitionIndex(cls._declared_fields, cls._sorted_fields())
+        index = store.get(cls.__name__, date_str)
+        if index is not None:
+            if index.inode == st.st_ino and index.size == st.st_size:
+                return index
+            if index.inode != st.st_ino or index.end is None or st.st_size < index.size:
+                index = None
+        if index is None:
+            index = field_index.PartitionIndex(cls._declared_fields, cls._sorted_fields(), st.st_ino)
+            items, end = storage.load_partition(file_path, fernet)
+        else:
+            items, end = storage.read_partition(file_path, fernet, index.end)
+        index.add(items)
+        index.end, index.size = end, st.st_size
+        store.put(cls.__name__, date_str, index)
+        return index
+
+    @classmethod
+    def _build_index(cls, date_range=None):
+        fernet = get_fernet_key(cls._password)
+        for date_str, file_path in cls._partitions(date_range):
+            cls._ensure_indexed(date_str, file_path, fernet)
+
+    @classmethod
+    def _id_lookup(cls, filters):
+        """Return the ids to fetch through the locator, or ``None``."""
+        for key in ("id", "id__exact"):
+            if isinstance(filters.get(key), str):
+                return [filters[key]]
+        ids = filters.get("id__in")
+        if isinstance(ids, (list, tuple, set, frozenset)) and all(isinstance(i, str) for i in ids):
+            return list(ids)
+        return None
+
+    @classmethod
+    def _plan_lookup(cls, filters):
+        """Pick the index that can narrow ``filters`` down, if any.
+
+        Returns a function mapping a partition's index to its candidate
+        records in file order: an ``exact``/``in`` filter uses the hash index, range
+        filters on a ``Field(index="sorted")`` use the sorted index.  Hash
+        lookups carry ``hashed = (field, values)`` so partitions that are not
+        indexed yet can be answered from their index snapshot.
+        """
+        ranges = {}
+        for raw_key, value in filters.items():
+            field, op = split_lookup(raw_key)
+            if field not in cls._declared_fields:
+                continue
+            if op == "exact" and str(value) != "None":
+                # a record missing the field compares as str(None), and
+                # has no posting to be found by
+                values = [value]
+            elif op == "in" and isinstance(value, (list, tuple, set, frozenset)) and all(
+                type(v) is str for v in value
+            ):
+                # the index is keyed by str(); `in` compares raw values, so
+                # 1 must also find 1.0 and is left to the predicate
+                values = value
+            else:
+                values = None
+            if values is not None:
+                def hashed(index, field=field, values=values):
+                    return index.lookup(field, values)
+                hashed.hashed = (field, values)
+                return hashed
+            if op in ("gt", "gte", "lt", "lte"):
+                ranges.setdefault(field, {})[op] = value
+            if op == "range":
+                low, high = value
+                ranges.setdefault(field, {}).update(gte=low, lte=high)
+
+        sorted_fields = cls._sorted_fields()
+        for field, ops in ranges.items():
+            if field not in sorted_fields:
                 continue
+            lower = upper = None
+            if "gt" in ops or "gte" in ops:
+                lower = (ops["gt"], False) if "gt" in ops else (ops["gte"], True)
+            if "lt" in ops or "lte" in ops:
+                upper = (ops["lt"], False) if "lt" in ops else (ops["lte"], True)
 
-            for item in items:
-                if match_item(item, filters):
-                    results.append(cls.from_dict(item))
-                    if limit and len(results) >= limit:
-                        return results
+            def candidates(index, field=field, lower=lower, upper=upper):
+                return index.range(field, lower, upper)
+            return candidates
+        return None
 
-                if date_str not in cls._cache_loaded_dates:
-                    for field, value in item.items():
-                        cls._indexes[clsname][field].insert([str(value)], item)
+    @classmethod
+    def _search_with_index(cls, filters, date_range=None, limit: Optional[int] = None, order=None, where=None):
+        records = cls._search_records(filters, date_range, limit, order, where)
+        return [cls.from_dict(item) for item in records]
 
-            cls._cache_loaded_dates.add(date_str)
+    @classmethod
+    def _search_records(cls, filters, date_range=None, limit: Optional[int] = None, order=None, where=None):
+        # closing the search cancels read-ahead a satisfied limit skips
+        with closing(cls._iter_search(filters, date_range, order, where=where)) as rows:
+            return list(islice(rows, limit or None))
 
-        return results
+    @classmethod
+    def _iter_search(cls, filters, date_range=None, order=None, stream=False, where=None, index=True):
+        """Yield the records matching ``filters``, newest partition first.
+
+        ``where`` is the predicate compiled from ``filters`` and any ``Q``
+        conditions; indexes and zone maps are only planned from ``filters``.
+
+        With ``stream`` partitions that are not indexed yet are decoded and
+        let go instead of being indexed and cached, so memory stays bounded
+        by one partition however much history is read.  Without ``index``
+        they are read through the partition cache but not indexed, for
+        one-off passes such as aggregates.
+        """
+        located = cls._iter_located(filters, date_range, order, stream, where, index)
+        with closing(located):
+            for _, item in located:
+                yield item
+
+    @classmethod
+    def _iter_located(cls, filters, date_range=None, order=None, stream=False, where=None, index=True):
+        """Like :meth:`_iter_search`, yielding ``(partition, record)`` pairs.
+
+        Only the live version of every record is yielded: superseded
+        versions and tombstones are left out.
+        """
+        # read your writes: records still queued for this model go first
+        writer.writer.sync(cls)
+        fernet = get_fernet_key(cls._password)
+
+        match = where or compile_filters(filters)
+
+        ids = cls._id_lookup(filters)
+        if ids is not None and not order:
+            for date_str, item in cls._search_by_id(ids, date_range, fernet):
+                if match(item):
+                    yield date_str, item
+            return
+
+        partitions = cls._partitions(date_range, filters)
+        store = cls._index_store()
+        lookup = None if order else cls._plan_lookup(filters)
+        hashed = getattr(lookup, "hashed", None) if index and cls._use_snapshots() else None
+
+        def cold(date_str):
+            # the first hash lookup of a partition not indexed in memory is
+            # answered from its snapshot, if one covers the partition; later
+            # ones index it
+            if hashed and store.get(cls.__name__, date_str) is None:
+                snapshot = cls._snapshot(date_str)
+                if not snapshot.answered and snapshot.can_answer(hashed[0]):
+                    return snapshot
+            return None
+
+        def decode(partition):
+            # read ahead what the loop below would have to decrypt: whole
+            # partitions for scans, partitions not indexed yet otherwise
+            date_str, file_path = partition
+            if cold(date_str) is not None:
+                return
+            if lookup is None or store.get(cls.__name__, date_str) is None:
+                try:
+                    too_big = os.path.getsize(file_path) > storage.partition_cache.max_bytes
+                except OSError:
+                    return
+                if not too_big:
+                    storage.load_partition(file_path, fernet)
+
+        if order:
+            field, reverse = order.lstrip("-"), order.startswith("-")
+            for date_str, item in cls._merge_ordered(partitions, field, reverse, fernet):
+                if match(item) and cls._in_range(date_str, item, date_range):
+                    yield date_str, item
+            return
+
+        with closing(scan.prefetched(partitions, decode, workers=1 if stream else None)) as ahead:
+            for date_str, file_path in ahead:
+                indexed = store.get(cls.__name__, date_str) is not None
+                snapshot = None if indexed else cold(date_str)
+                if snapshot is not None:
+                    # decrypts only the frames holding hits
+                    items = snapshot.lookup(*hashed)
+                    if items is None:
+                        items = lookup(cls._ensure_indexed(date_str, file_path, fernet))
+                elif stream and not indexed:
+                    items = storage.live_records(storage.read_records(file_path, fernet))
+                elif not index and not indexed:
+                    items, _ = storage.load_partition(file_path, fernet)
+                    items = storage.live_records(items)
+                elif lookup:
+                    # index hits are candidates; match still checks them
+                    items = lookup(cls._ensure_indexed(date_str, file_path, fernet))
+                else:
+                    items = cls._ensure_indexed(date_str, file_path, fernet).live()
+
+                if date_range and storage.is_monthly(date_str):
+                    # a merged month may reach outside the requested days
+                    start, end = date_range
+                    items = [item for item in items if start <= item.get(storage.DATE, "") <= end]
+                for item in items:
+                    if match(item):
+                        yield date_str, item
+
+    @classmethod
+    def _merge_ordered(cls, partitions, field, reverse, fernet):
+        """Yield ``(partition, record)`` of ``partitions`` in ``field`` order.
+
+        Walks the sorted index of every partition in merged key order, so a
+        consumer that stops early skips the rest.  A partition is indexed
+        only once the merge reaches the first key its zone map allows, so
+        partitions a short ``order_by()`` never reaches stay unindexed.
+        Ties keep the order of ``partitions``.
+        """
+        manifest = cls._manifest()
+        wrap = _Descending if reverse else tuple
+        heap, pending = [], []
+        for position, (date_str, file_path) in enumerate(partitions):
+            bounds = None
+            if manifest.is_current(date_str, file_path):
+                bounds = manifest.key_bounds(date_str, field)
+            if bounds is None:
+                start = None
+            else:
+                start = wrap(bounds[1] if reverse else bounds[0])
+            pending.append((start, position, date_str, file_path))
+        # partitions still to index, the next one to reach last
+        pending.sort(key=lambda entry: (entry[0] is not None, entry[0] or ()), reverse=True)
+
+        def push(position, hits):
+            for key, hit in hits:
+                heapq.heappush(heap, (wrap(key), position, hit, hits))
+                return
+
+        while pending or heap:
+            while pending and (not heap or pending[-1][0] is None or pending[-1][0] <= heap[0][0]):
+                _, position, date_str, file_path = pending.pop()
+                index = cls._ensure_indexed(date_str, file_path, fernet)
+                push(position, ((key, (date_str, item)) for key, item in index.ordered(field, reverse)))
+            if heap:
+                _, position, hit, hits = heapq.heappop(heap)
+                yield hit
+                push(position, hits)
+
+    @staticmethod
+    def _in_range(date_str, item, date_range):
+        if not date_range or not storage.is_monthly(date_str):
+            return True
+        start, end = date_range
+        return start <= item.get(storage.DATE, "") <= end
+
+    @classmethod
+    def _revise(cls, located, changes=None):
+        """Append a new version, or a tombstone, of every located record.
+
+        Versions go to the partition the record already lives in, so
+        readers resolve them without looking at other partitions.
+        """
+        by_partition = {}
+        for date_str, record in located:
+            if record.get("id") is None:
+                continue
+            if changes is None:
+                revised = {"id": record["id"], storage.DELETED: True}
+            else:
+                revised = {k: v for k, v in record.items() if k != storage.REVISION}
+                revised.update(changes)
+            revised[storage.REVISION] = 1
+            by_partition.setdefault(date_str, []).append(revised)
+        if transaction.current() is None and writer.enabled():
+            # queued like save(); the writer flushes them as one batch
+            for date_str, records in by_partition.items():
+                cls._append_records(date_str, records)
+        else:
+            with cls.atomic():
+                for date_str, records in by_partition.items():
+                    cls._append_records(date_str, records)
+        identity = session.current()
+        if identity is not None:
+            for _, record in located:
+                if changes is None:
+                    identity.evict(cls, record.get("id"))
+                else:
+                    identity.update(cls, record.get("id"), changes)
+        return sum(len(records) for records in by_partition.values())
 
     @classmethod
     def update(cls, match_filters, **update_fields):
-        objs = cls.objects().filter(**match_filters).all()
-        for obj in objs:
-            for k, v in update_fields.items():
-                setattr(obj, k, v)
-            obj.save()
-        return len(objs)
+        return cls.objects().filter(**match_filters).update(**update_fields)
 
     @classmethod
     def delete(cls, **filters):
-        removed = 0
-        fernet = get_fernet_key(cls._password)
-        for root, _, files in os.walk(cls._db_root):
-            for file in files:
-                if not file.endswith('.pu') or not file.startswith(cls.__name__):
-                    continue
-                file_path = os.path.join(root, file)
-                with open(file_path, 'rb') as f:
-                    try:
-                        data = json.loads(fernet.decrypt(f.read()).decode())
-                    except:
-                        continue
-                new_data = []
-                for item in data:
-                    if all(item.get(k) == v for k, v in filters.items()):
-                        removed += 1
-                        continue
-                    new_data.append(item)
-                with open(file_path, 'wb') as f:
-                    f.write(fernet.encrypt(json.dumps(new_data).encode()))
-        return removed
+        return cls.objects().filter(**filters).delete()
 
 
 def create_base_model(connection_string: str):
@@ -507,5 +1108,6 @@ def create_base_model(connection_string: str):
         _password = password
         _db_root = path
     CustomBaseModel.base_model = CustomBaseModel
+    transaction.recover(path, password)
 
     return CustomBaseModel
\ No newline at end of file
@@ -0,0 +1,185 @@
+"""Append-only logs describing the partitions of one model.
+
+pudb keeps per-model metadata (the id locator, the partition manifest) in
+``<db_root>/_pudb/``.  Each of them is an append-only segment like the
+``.pu`` files, holding entries of the form::
+
+    [partition, inode, start, end, payload]
+
+An entry describes the frames found between ``start`` and ``end`` of one
+partition file.  ``start`` is ``None`` when the whole partition was
+re-scanned, which replaces everything previously known about it, and an
+``inode`` of ``None`` records that the partition file is gone.
+
+Appending instead of rewriting means concurrent writers never lose each
+other's updates.  Besides the payload, a log tracks how much of every
+partition it covers, so frames written by someone who did not update it
+are picked up by :meth:`PartitionLog.refresh`.
+"""
+import os
+
+from . import storage
+from .locking import locked
+
+LOG_DIR = "_pudb"
+# a log holding more entries than this, and more than twice one per
+# partition, is rewritten as a snapshot by the next entry logged
+COMPACT_ENTRIES = 1024
+
+
+class PartitionLog:
+    suffix = ""
+
+    def __init__(self, path, fernet):
+        self.path = path
+        self.fernet = fernet
+        # partition -> (inode, covered end) of the partition file
+        self.coverage = {}
+        self._log_end = None
+        self._log_generation = None
+        # entries in the log file, as far as it was replayed
+        self._log_entries = 0
+
+    @classmethod
+    def for_model(cls, db_root, model_name, fernet):
+        return cls(os.path.join(db_root, LOG_DIR, f"{model_name}{cls.suffix}"), fernet)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def create(self):
+        """Create an empty log unless one exists already."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            with open(self.path, "xb") as f:
+                f.write(storage.MAGIC)
+        except FileExistsError:
+            pass
+
+    def describe(self, frames):
+        """Return the payload for ``(offset, records)`` frames of a partition."""
+        raise NotImplementedError
+
+    def apply_payload(self, date_str, replace, end, payload):
+        """Fold ``payload`` into memory; ``replace`` drops what was known."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Forget every payload folded in so far."""
+        raise NotImplementedError
+
+    def payload(self, date_str):
+        """Return a payload describing everything known about a partition."""
+        raise NotImplementedError
+
+    def _generation(self):
+        """Identify the current log file across rewrites.
+
+        Inodes are reused once a replaced file is gone, so the start of the
+        first frame, whose Fernet token is random, is part of it too.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                return os.fstat(f.fileno()).st_ino, f.read(len(storage.MAGIC) + 64)
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        """Replay log entries appended since the last call."""
+        generation = self._generation()
+        if generation != self._log_generation:
+            # the log was rewritten by compact(); replay it from the start
+            self.coverage = {}
+            self._log_end = None
+            self._log_entries = 0
+            self._log_generation = generation
+            self.clear()
+        entries, end = storage.read_partition(self.path, self.fernet, self._log_end)
+        for entry in entries:
+            self._apply(*entry)
+        self._log_end = end
+        self._log_entries += len(entries)
+
+    def _apply(self, date_str, inode, start, end, payload):
+        if start is None:
+            if inode is None:
+                self.coverage.pop(date_str, None)
+            else:
+                self.coverage[date_str] = (inode, end)
+        else:
+            covered = self.coverage.get(date_str)
+            if covered != (inode, start) and not (covered is None and start == len(storage.MAGIC)):
+                # frames before this one are not described yet; refresh()
+                # will describe this one again together with them
+                return
+            self.coverage[date_str] = (inode, end)
+        self.apply_payload(date_str, start is None, end, payload)
+
+    def _log(self, entry):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.load()
+        offset, end = storage.append_records(self.path, self.fernet, [entry])
+        if offset == self._log_end:
+            self._log_end = end
+            self._log_entries += 1
+            self._apply(*entry)
+        else:
+            # another process logged in between; replay both in order
+            self.load()
+        if self._log_entries > max(COMPACT_ENTRIES, 2 * len(self.coverage)):
+            # keep replaying the log from scratch cheap
+            self.compact()
+
+    def compact(self):
+        """Rewrite the log as one full entry per partition it covers."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # no entry may be appended between reading the log and replacing it
+        with locked(self.path):
+            self.load()
+            entries = [
+                [date_str, inode, None, end, self.payload(date_str)]
+                for date_str, (inode, end) in sorted(self.coverage.items())
+            ]
+            storage.write_records(self.path, self.fernet, entries)
+            self.load()
+
+    def is_current(self, date_str, path):
+        """Whether the log covers everything currently in ``path``."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return date_str not in self.coverage
+        covered = self.coverage.get(date_str)
+        return bool(covered) and covered[0] == st.st_ino and covered[1] >= st.st_size
+
+    def record_append(self, date_str, path, offset, end, records):
+        """Log a frame this process just appended to a partition."""
+        inode = os.stat(path).st_ino
+        self._log([date_str, inode, offset, end, self.describe([(offset, records)])])
+
+    def refresh(self, date_str, path):
+        """Describe whatever part of ``path`` the log does not cover yet."""
+        self.load()
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            if date_str in self.coverage:
+                self._log([date_str, None, None, None, self.describe([])])
+            return
+        covered = self.coverage.get(date_str)
+        if covered and covered[0] == st.st_ino and covered[1] >= st.st_size:
+            return
+        if covered and covered[0] == st.st_ino and storage.is_segment(path):
+            start = covered[1]
+        else:
+            start = None
+
+        frames = []
+        end = len(storage.MAGIC) if start is None else start
+        for offset, frame_end, records in storage.iter_frames(path, self.fernet, start):
+            frames.append((offset, records))
+            # legacy blobs have no frame end; they are covered up to their size
+            end = st.st_size if frame_end is None else frame_end
+        if start is not None and end == start:
+            return
+        self._log([date_str, st.st_ino, start, end, self.describe(frames)])
@@ -1,6 +1,13 @@
+from contextlib import closing
 from datetime import datetime
+from itertools import islice
 from typing import List, Optional, Tuple, Union
 
+from . import aio, session, storage, transaction
+from .aggregates import UNKNOWN, Aggregate, Count
+from .lookups import Q, compile_filters
+from .field_index import sort_key
+
 class QuerySet:
     def __init__(
         self,
@@ -8,34 +15,165 @@ class QuerySet:
         filters: Optional[dict] = None,
         date_range: Optional[Tuple[str, str]] = None,
         order: Optional[str] = None,
-        limit: Optional[int] = None
+        limit: Optional[int] = None,
+        conditions: Tuple[Q, ...] = (),
+        projection: Optional[tuple] = None,
+        related: Tuple[str, ...] = ()
     ):
         self.model_cls = model_cls
         self.filters = filters or {}
         self.date_range = date_range
         self.order = order
         self.limit = limit
+        # Q objects; unlike ``filters`` they are not used to pick an index
+        self.conditions = conditions
+        # ("values", fields), ("values_list", fields, flat) or ("only", fields)
+        self.projection = projection
+        # relations resolved in batches for the objects returned
+        self.related = related
         self._result_cache = None
+        self._where = None
 
-    def fetch(self):
-        if self._result_cache is not None:
-            return
+    def _clone(self, **changes):
+        state = {
+            "filters": self.filters,
+            "date_range": self.date_range,
+            "order": self.order,
+            "limit": self.limit,
+            "conditions": self.conditions,
+            "projection": self.projection,
+            "related": self.related,
+        }
+        state.update(changes)
+        return QuerySet(self.model_cls, **state)
 
-        if self.limit == 1:
-            # فقط یک نتیجه می‌خوایم، می‌تونیم از ایندکس استفاده کنیم
-            result = self.model_cls._search_with_index(self.filters, self.date_range, limit=1)
-            self._result_cache = result
-        else:
-            results = self.model_cls._search_with_index(self.filters, self.date_range)
+    @property
+    def where(self):
+        """The filters and conditions compiled into a single predicate."""
+        if self._where is None:
+            self._where = compile_filters(self.filters, *self.conditions)
+        return self._where
+
+    def _build(self):
+        """Return the function turning a stored record into a result row."""
+        model_cls = self.model_cls
+        if self.projection is None:
+            return model_cls.from_dict
+        kind, fields = self.projection[:2]
+        if kind == "values":
+            return lambda record: {f: record.get(f) for f in fields}
+        if kind == "values_list":
+            if self.projection[2]:
+                (field,) = fields
+                return lambda record: record.get(field)
+            return lambda record: tuple([record.get(f) for f in fields])
+        return lambda record: model_cls._partial(record, fields)
+
+    def _records(self, limit=None):
+        if not self.order:
+            return self.model_cls._search_records(
+                self.filters, self.date_range, limit=limit, where=self.where
+            )
+
+        field = self.order.lstrip("-")
+        if field in self.model_cls._sorted_fields():
+            # rows come straight from the sorted index, already in order
+            return self.model_cls._search_records(
+                self.filters, self.date_range, limit=limit, order=self.order, where=self.where
+            )
+        records = self.model_cls._search_records(self.filters, self.date_range, where=self.where)
+        records.sort(key=lambda r: sort_key(r.get(field)), reverse=self.order.startswith("-"))
+        return records[:limit] if limit else records
+
+    def _fetch(self, limit=None):
+        if self.projection and self.projection[0] == "group":
+            rows = self._groups()
             if self.order:
-                reverse = False
-                field = self.order
-                if field.startswith("-"):
-                    reverse = True
-                    field = field[1:]
-                results.sort(key=lambda x: getattr(x, field, None), reverse=reverse)
+                field = self.order.lstrip("-")
+                rows.sort(key=lambda r: sort_key(r.get(field)), reverse=self.order.startswith("-"))
+            return rows[:limit] if limit else rows
+        build = self._build()
+        return self._with_related([build(record) for record in self._records(limit)])
 
-            self._result_cache = results
+    def _with_related(self, objs):
+        """Fill the relation caches of the objects in ``objs``."""
+        if self.related and objs and (self.projection is None or self.projection[0] == "only"):
+            for name in self.related:
+                self.model_cls._prefetch(objs, name)
+        return objs
+
+    def _scan(self):
+        """Yield the matching records once, without indexing what is read."""
+        search = self.model_cls._iter_search(
+            self.filters, self.date_range, where=self.where, index=False
+        )
+        with closing(search):
+            yield from islice(search, self.limit or None)
+
+    def _exact_stats(self):
+        """Manifest stats of the selected partitions, if they describe the result.
+
+        That needs every row of the partitions to match and no updated
+        versions or tombstones in them, which the stats would count too.
+        """
+        if self.filters or self.conditions or self.limit:
+            return None
+        stats = self.model_cls._partition_stats(self.date_range)
+        if stats is None or any(p.get("revisions") for p in stats):
+            return None
+        return stats
+
+    def _groups(self):
+        _, fields, aggregates = self.projection
+        groups = {}
+        for record in self._scan():
+            key = tuple([record.get(f) for f in fields])
+            states = groups.get(key)
+            if states is None:
+                states = groups[key] = [agg.initial() for _, agg in aggregates]
+            for i, (_, agg) in enumerate(aggregates):
+                states[i] = agg.step(states[i], record.get(agg.field))
+        rows = []
+        for key, states in groups.items():
+            row = dict(zip(fields, key))
+            for (alias, agg), state in zip(aggregates, states):
+                row[alias] = agg.final(state)
+            rows.append(row)
+        return rows
+
+    def iterator(self, chunk_size: int = 1000):
+        """Yield matching objects without building the full result list.
+
+        Partitions are decoded one at a time and nothing is kept in the
+        result cache, so memory stays bounded by a partition plus
+        ``chunk_size`` rows, which are read ahead of the consumer and built
+        together.  Breaking out of the loop stops reading.  Ordering by a
+        field without a sorted index still needs every row before the first
+        one can be yielded.
+        """
+        if self._result_cache is not None:
+            yield from self._result_cache
+            return
+        grouped = self.projection and self.projection[0] == "group"
+        if grouped or self.order and self.order.lstrip("-") not in self.model_cls._sorted_fields():
+            yield from self._fetch(self.limit)
+            return
+        build = self._build()
+        search = self.model_cls._iter_search(
+            self.filters, self.date_range, order=self.order, stream=True, where=self.where
+        )
+        with closing(search):
+            rows = islice(search, self.limit or None)
+            while True:
+                chunk = self._with_related([build(record) for record in islice(rows, chunk_size)])
+                if not chunk:
+                    return
+                yield from chunk
+
+    def fetch(self):
+        if self._result_cache is not None:
+            return
+        self._result_cache = self._fetch(self.limit)
 
     def __len__(self):
         self.fetch()
@@ -46,51 +184,291 @@ class QuerySet:
         return iter(self._result_cache)
 
     def __getitem__(self, item: Union[int, slice]):
+        if (
+            self._result_cache is None
+            and self.order
+            and isinstance(item, slice)
+            and item.stop is not None
+            and item.stop >= 0
+            and (item.start or 0) >= 0
+        ):
+            # qs.order_by(...)[:n] only needs the first n rows in order
+            return self._fetch(item.stop)[item]
         self.fetch()
         return self._result_cache[item]
 
-    def filter(self, **kwargs):
+    def filter(self, *conditions: Q, **kwargs):
         combined = self.filters.copy()
         combined.update(kwargs)
-        return QuerySet(
-            self.model_cls,
-            combined,
-            self.date_range,
-            self.order,
-            self.limit
-        )
+        return self._clone(filters=combined, conditions=self.conditions + conditions)
+
+    def exclude(self, *conditions: Q, **kwargs):
+        """Drop the rows matching all of ``conditions`` and ``kwargs``."""
+        return self._clone(conditions=self.conditions + (~Q(*conditions, **kwargs),))
 
     def between(self, start_date: str, end_date: str):
-        return QuerySet(
-            self.model_cls,
-            self.filters,
-            (start_date, end_date),
-            self.order,
-            self.limit
-        )
+        return self._clone(date_range=storage.normalize_range((start_date, end_date)))
 
     def order_by(self, field_name: str):
-        return QuerySet(
-            self.model_cls,
-            self.filters,
-            self.date_range,
-            order=field_name,
-            limit=self.limit
+        return self._clone(order=field_name)
+
+    def select_related(self, *fields: str):
+        """Load the objects of foreign keys ``fields`` along with the rows.
+
+        Each relation costs one ``id__in`` lookup for all rows fetched,
+        instead of one query per row on first access.
+        """
+        for field in fields:
+            if field not in self.model_cls._declared_relations:
+                raise ValueError(
+                    f"{self.model_cls.__name__} has no foreign key '{field}'"
+                )
+        return self._clone(related=self.related + fields)
+
+    def prefetch_related(self, *names: str):
+        """Load relations ``names`` of the fetched objects in batches.
+
+        Besides foreign keys this takes reverse relations and many-to-many
+        fields in both directions; each needs one query for all rows, two
+        for many-to-many, whose links are read in the same pass.
+        """
+        for name in names:
+            if self.model_cls._relation_kind(name) is None:
+                raise ValueError(f"{self.model_cls.__name__} has no relation '{name}'")
+        return self._clone(related=self.related + names)
+
+    def _project(self, kind, fields, *options):
+        declared = self.model_cls._declared_fields
+        unknown = [f for f in fields if f not in declared]
+        if unknown:
+            raise ValueError(
+                f"{self.model_cls.__name__} has no field(s) {', '.join(unknown)}"
+            )
+        return self._clone(projection=(kind, tuple(fields or declared)) + options)
+
+    def values(self, *fields: str):
+        """Return rows as dicts of ``fields`` (all fields by default)."""
+        return self._project("values", fields)
+
+    def values_list(self, *fields: str, flat: bool = False):
+        """Return rows as tuples of ``fields``, or bare values with ``flat``."""
+        if flat and len(fields) != 1:
+            raise TypeError("'flat' is only valid with a single field")
+        return self._project("values_list", fields, flat)
+
+    def only(self, *fields: str):
+        """Return objects holding just ``fields``; the others load on access."""
+        fields = ("id",) + tuple(f for f in fields if f != "id")
+        return self._project("only", fields)
+
+    def annotate(self, *aggregates: Aggregate, **named: Aggregate):
+        """Group ``values(...)`` rows and compute ``aggregates`` per group."""
+        if not self.projection or self.projection[0] != "values":
+            raise TypeError("annotate() needs values() to name the fields to group by")
+        named = {**{agg.default_alias: agg for agg in aggregates}, **named}
+        return self._clone(projection=("group", self.projection[1], tuple(named.items())))
+
+    def aggregate(self, *aggregates: Aggregate, **named: Aggregate) -> dict:
+        """Compute ``aggregates`` over the matching rows in a single pass.
+
+        Without filters they are answered from the partition manifest where
+        it has the statistics, which decrypts nothing.
+        """
+        named = {**{agg.default_alias: agg for agg in aggregates}, **named}
+        result = {}
+        stats = self._exact_stats()
+        if stats is not None:
+            for alias, agg in named.items():
+                value = agg.from_stats(stats)
+                if value is not UNKNOWN:
+                    result[alias] = value
+        pending = [(alias, agg) for alias, agg in named.items() if alias not in result]
+        if pending:
+            states = [agg.initial() for _, agg in pending]
+            for record in self._scan():
+                for i, (_, agg) in enumerate(pending):
+                    states[i] = agg.step(states[i], record.get(agg.field))
+            for (alias, agg), state in zip(pending, states):
+                result[alias] = agg.final(state)
+        return {alias: result[alias] for alias in named}
+
+    def to_columns(self, fields, dtypes: Optional[dict] = None, chunk_size: int = 65536) -> dict:
+        """Return ``{field: numpy array}`` for the matching rows.
+
+        Arrays are built from the decoded records ``chunk_size`` rows at a
+        time, without model instances.  ``dtypes`` maps fields to NumPy
+        dtypes; other fields get whatever NumPy infers.  Needs ``numpy``.
+        """
+        try:
+            import numpy as np
+        except ImportError as exc:
+            raise ImportError("QuerySet.to_columns() requires numpy") from exc
+        fields = [fields] if isinstance(fields, str) else list(fields)
+        unknown = [f for f in fields if f not in self.model_cls._declared_fields]
+        if unknown:
+            raise ValueError(
+                f"{self.model_cls.__name__} has no field(s) {', '.join(unknown)}"
+            )
+        dtypes = dtypes or {}
+
+        if self.order:
+            records = iter(self._records(self.limit))
+        else:
+            records = self._scan()
+        chunks = {f: [] for f in fields}
+        while True:
+            rows = list(islice(records, chunk_size))
+            if not rows:
+                break
+            for field in fields:
+                chunks[field].append(np.array([r.get(field) for r in rows], dtype=dtypes.get(field)))
+        return {
+            field: np.concatenate(parts) if parts else np.array([], dtype=dtypes.get(field))
+            for field, parts in chunks.items()
+        }
+
+    def _located(self):
+        return self.model_cls._iter_located(
+            self.filters, self.date_range, where=self.where, index=False
         )
 
+    def update(self, **fields) -> int:
+        """Write a new version of every matching record; returns how many.
+
+        Versions are appended to the partitions the records live in.
+        Inside ``atomic()`` matching records still waiting in the batch are
+        changed in it instead.
+        """
+        self.model_cls._check_auth()
+        changes = {
+            k: v.id if hasattr(v, "to_dict") else v for k, v in fields.items()
+        }
+        changed, buffered = [], set()
+        uow = transaction.current()
+        if uow is not None:
+            changed = uow.update(self.model_cls, self.where, changes)
+            buffered = uow.buffered_ids(self.model_cls)
+            identity = session.current()
+            if identity is not None:
+                for record_id in changed:
+                    identity.update(self.model_cls, record_id, changes)
+        with closing(self._located()) as located:
+            # what is stored of a buffered record is an older version
+            located = [hit for hit in located if hit[1].get("id") not in buffered]
+            return len(changed) + self.model_cls._revise(located, changes)
+
+    def delete(self) -> int:
+        """Append a tombstone for every matching record; returns how many.
+
+        Inside ``atomic()`` matching records still waiting in the batch are
+        dropped from it as well.
+        """
+        dropped, buffered = set(), set()
+        uow = transaction.current()
+        if uow is not None:
+            dropped = set(uow.discard(self.model_cls, self.where))
+            # records whose latest version stays in the batch did not match
+            buffered = uow.buffered_ids(self.model_cls)
+            dropped -= buffered
+        with closing(self._located()) as located:
+            located = [hit for hit in located if hit[1].get("id") not in buffered]
+        # the stored version of a dropped record needs its tombstone too,
+        # matching or not
+        stored = {record.get("id") for _, record in located}
+        locator = self.model_cls._locator()
+        for record_id in dropped - stored:
+            home = locator.locate(record_id)
+            if home is not None:
+                located.append((home[0], {"id": record_id}))
+        self.model_cls._revise(located)
+        return len(dropped | stored)
+
+    def count(self) -> int:
+        """Number of matching rows, without building any of them."""
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        if self.projection and self.projection[0] == "group":
+            return len(self._fetch(self.limit))
+        return self.aggregate(rows=Count())["rows"]
+
+    def exists(self) -> bool:
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        stats = self._exact_stats()
+        if stats is not None:
+            return any(p["rows"] for p in stats)
+        return bool(self.model_cls._search_records(
+            self.filters, self.date_range, limit=1, where=self.where
+        ))
+
     def all(self) -> List:
         # self.fetch()
         return self
 
+    def _held(self):
+        """The instance a plain id lookup resolves to in the current session."""
+        identity = session.current()
+        if (
+            identity is None
+            or self.conditions
+            or self.date_range
+            or self.projection
+            or len(self.filters) != 1
+        ):
+            return None
+        (key, value), = self.filters.items()
+        if key not in ("id", "id__exact"):
+            return None
+        return identity.get(self.model_cls, value)
+
     def first(self):
+        held = self._held()
+        if held is not None:
+            return held
         if self._result_cache is None:
             # اگر هنوز cache نیست، فقط یکی بخون
-            result = self.model_cls._search_with_index(self.filters, self.date_range, limit=1)
-            self._result_cache = result
+            result = self._fetch(1)
+            return result[0] if result else None
         return self._result_cache[0] if self._result_cache else None
 
+    def get(self, *conditions: Q, **kwargs):
+        """Return the single object matching ``kwargs``, or ``None``."""
+        return self.filter(*conditions, **kwargs).first()
+
+    def aiterator(self, chunk_size: int = 1000):
+        """``iterator()`` for ``async for``; chunks are read on the pool."""
+        if self._result_cache is not None:
+            return aio.iterate(iter(self._result_cache), chunk_size)
+        return aio.iterate(self.iterator(chunk_size), chunk_size)
+
+    def __aiter__(self):
+        return self.aiterator()
+
+    async def aall(self) -> List:
+        """Fetch the results without blocking the event loop."""
+        if self._result_cache is None:
+            self._result_cache = [row async for row in self.aiterator()]
+        return self._result_cache
+
+    async def afirst(self):
+        return await aio.run(self.first)
+
+    async def aget(self, *conditions: Q, **kwargs):
+        return await aio.run(self.get, *conditions, **kwargs)
+
+    async def acount(self) -> int:
+        return await aio.run(self.count)
+
+    async def aupdate(self, **fields) -> int:
+        return await aio.run(self.update, **fields)
+
+    async def adelete(self) -> int:
+        return await aio.run(self.delete)
+
     def paginate(self, page=1, per_page=10):
-        self.fetch()
         start = (page - 1) * per_page
         end = start + per_page
+        if self._result_cache is None:
+            # only the rows up to the requested page are read
+            return list(islice(self.iterator(chunk_size=end), start, end))
         return self._result_cache[start:end]
@@ -0,0 +1,70 @@
+"""Decode partitions ahead of a scan on a shared thread pool.
+
+Decrypting and parsing a partition dominates a scan over many days.
+:func:`prefetched` lets a query walk its partitions in order while the next
+few are decoded into the partition cache in the background, so the query
+itself mostly finds them there.  Only a bounded window runs ahead of the
+consumer and closing the generator cancels what has not started, so a
+satisfied ``limit`` stops the I/O.
+
+The pool size is the ``PUDB_SCAN_WORKERS`` setting; ``None`` uses every
+core and ``1`` disables read-ahead.
+"""
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from poutay.conf import settings
+
+_lock = threading.Lock()
+_pool = None
+_pool_workers = 0
+
+
+def scan_workers():
+    workers = getattr(settings, "PUDB_SCAN_WORKERS", None)
+    return max(1, workers or os.cpu_count() or 1)
+
+
+def _executor(workers):
+    global _pool, _pool_workers
+    with _lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ThreadPoolExecutor(workers, thread_name_prefix="pudb-scan")
+            _pool_workers = workers
+        return _pool
+
+
+def prefetched(items, load, workers=None):
+    """Yield ``items`` in order after ``load(item)`` has run for each.
+
+    Up to ``workers`` items are loaded ahead of the consumer.  Without
+    read-ahead nothing is loaded and the consumer does its own reads.
+    """
+    items = list(items)
+    workers = scan_workers() if workers is None else workers
+    if workers <= 1 or len(items) <= 1:
+        yield from items
+        return
+
+    pool = _executor(workers)
+    queue = iter(items)
+    pending = deque()
+    try:
+        for item in queue:
+            pending.append((item, pool.submit(load, item)))
+            if len(pending) >= workers:
+                break
+        while pending:
+            item, future = pending.popleft()
+            future.result()
+            for following in queue:
+                pending.append((following, pool.submit(load, following)))
+                break
+            yield item
+    finally:
+        for _, future in pending:
+            future.cancel()
@@ -0,0 +1,75 @@
+"""Identity map for model instances.
+
+Inside ``with Model.session():`` every stored record is turned into at most
+one instance per ``(model, id)``: later queries returning the same row hand
+back the instance built first, and ``get(id=...)``, ``first()`` on an id
+filter and foreign key access return it without reading anything.  Saving,
+updating or deleting through the ORM keeps the map in step with what was
+written; changes made by other processes while the session is open are not
+seen for instances it already holds.
+
+Sessions are per thread and nest: an inner block joins the outer one.  With
+``PUDB_SESSION_PER_ACTION`` set, every ``UIMain`` action handler runs in its
+own session.
+"""
+import threading
+from contextlib import ContextDecorator
+
+_local = threading.local()
+
+
+def current():
+    """Return the identity map active on this thread, if any."""
+    return getattr(_local, "identity", None)
+
+
+class IdentityMap:
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, model_cls, record_id):
+        return self.objects.get((model_cls, record_id))
+
+    def add(self, obj):
+        """Register ``obj``, or copy its fields onto the instance held already.
+
+        Returns the instance the map holds afterwards.
+        """
+        key = (type(obj), obj.id)
+        held = self.objects.setdefault(key, obj)
+        if held is not obj:
+            for field in type(obj)._declared_fields:
+                if field in type(obj)._declared_relations:
+                    setattr(held, field, obj.__dict__.get(f"_{field}_id"))
+                elif field in obj.__dict__:
+                    setattr(held, field, obj.__dict__[field])
+        return held
+
+    def update(self, model_cls, record_id, changes):
+        held = self.get(model_cls, record_id)
+        if held is not None:
+            for field, value in changes.items():
+                setattr(held, field, value)
+
+    def evict(self, model_cls, record_id):
+        self.objects.pop((model_cls, record_id), None)
+
+    def __len__(self):
+        return len(self.objects)
+
+
+class Session(ContextDecorator):
+    """Share model instances by ``(model, id)`` on this thread until exit."""
+
+    def __enter__(self):
+        if current() is None:
+            _local.identity = IdentityMap()
+            _local.depth = 0
+        _local.depth += 1
+        return _local.identity
+
+    def __exit__(self, exc_type, exc, tb):
+        _local.depth -= 1
+        if not _local.depth:
+            _local.identity = None
+        return False
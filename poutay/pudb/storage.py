@@ -0,0 +1,331 @@
+"""On-disk layout of ``.pu`` partition files.
+
+A partition is an append-only segment: a short magic header followed by
+frames.  Every frame is a 4 byte big-endian length prefix and an encrypted
+list of records, so a ``save`` only has to encrypt and append its own frame
+instead of rewriting the whole day file.
+
+The header carries the segment version.  Version 2 (``MAGIC``) stores the
+Fernet token as raw bytes rather than base64 text, a third smaller, around
+a payload produced by :mod:`.codec` (orjson or msgpack when installed,
+optionally compressed).  Version 1 segments (``MAGIC_V1``) hold base64
+tokens over JSON; they stay readable and frames appended to them keep that
+format, so a file never mixes the two.  Rewriting a partition (compaction,
+say) produces version 2.
+
+Files written before segments existed are a single Fernet token over a JSON
+list; they are still readable and are converted to a segment the first time
+something is appended to them.
+
+Partitions are never rewritten to change a record.  An update appends a new
+version of it to the same partition and a delete appends a tombstone; both
+carry the ``REVISION`` key, and readers keep only the last record per id
+(see :func:`live_records`).
+"""
+import base64
+import json
+import os
+import struct
+from datetime import datetime
+
+from . import codec
+from .cache import estimate_bytes, partition_cache
+from .locking import locked
+
+MAGIC = b"PUSEG2\n"
+MAGIC_V1 = b"PUSEG1\n"
+# header -> segment version; every header is as long as MAGIC
+VERSIONS = {MAGIC_V1: 1, MAGIC: 2}
+_LENGTH = struct.Struct(">I")
+
+# set on records that supersede an earlier record with the same id
+REVISION = "__rev__"
+# set on tombstones, which end the life of their id
+DELETED = "__deleted__"
+# day of a record in a monthly partition (see poutay.pudb.compact)
+DATE = "__date__"
+
+
+def is_monthly(date_str):
+    """Whether ``date_str`` names a monthly partition, ``YYYY-MM-00``."""
+    return date_str.endswith("-00")
+
+
+def normalize_range(date_range):
+    """Return ``date_range`` with both bounds as ``YYYY-MM-DD``.
+
+    Partition names are compared as strings, so ``"2024-1-2"`` has to
+    become ``"2024-01-02"`` first.
+    """
+    return tuple(
+        datetime.strptime(bound, "%Y-%m-%d").date().isoformat() for bound in date_range
+    )
+
+
+def month_overlaps(date_str, date_range):
+    """Whether the month of a monthly partition overlaps ``date_range``."""
+    start, end = date_range
+    return start[:7] <= date_str[:7] <= end[:7]
+
+
+def month_within(date_str, date_range):
+    """Whether ``date_range`` covers the whole month of a monthly partition."""
+    start, end = date_range
+    return start <= date_str[:8] + "01" and end >= date_str[:8] + "31"
+
+
+def segment_version(path):
+    """Return the segment version of ``path``, ``None`` for a legacy blob."""
+    try:
+        with open(path, "rb") as f:
+            return VERSIONS.get(f.read(len(MAGIC)))
+    except FileNotFoundError:
+        return None
+
+
+def is_segment(path):
+    return segment_version(path) is not None
+
+
+def _encode_frame(fernet, records, version=2):
+    if version == 1:
+        token = fernet.encrypt(json.dumps(records).encode())
+    else:
+        token = base64.urlsafe_b64decode(fernet.encrypt(codec.encode(records)))
+    return _LENGTH.pack(len(token)) + token
+
+
+def _decode_frame(fernet, body, version):
+    if version == 1:
+        return json.loads(fernet.decrypt(body).decode())
+    return codec.decode(fernet.decrypt(base64.urlsafe_b64encode(body)))
+
+
+def iter_frames(path, fernet, start=None):
+    """Yield ``(offset, end, records)`` for every readable frame in ``path``.
+
+    A legacy whole-file blob is reported as a single frame at offset 0 with
+    ``end`` set to ``None``.  A truncated trailing frame (an interrupted
+    append) ends the iteration and frames that fail to decrypt are skipped.
+    """
+    try:
+        with locked(path, exclusive=False), open(path, "rb") as f:
+            head = f.read(len(MAGIC))
+            version = VERSIONS.get(head)
+            if version:
+                base = len(MAGIC) if start is None else start
+                f.seek(base)
+            data = f.read()
+    except FileNotFoundError:
+        return
+    if not version:
+        try:
+            records = json.loads(fernet.decrypt(head + data).decode())
+        except Exception:
+            return
+        yield 0, None, records
+        return
+
+    pos = 0
+    end = len(data)
+    while pos + _LENGTH.size <= end:
+        (size,) = _LENGTH.unpack_from(data, pos)
+        body_start = pos + _LENGTH.size
+        if body_start + size > end:
+            break
+        try:
+            records = _decode_frame(fernet, data[body_start:body_start + size], version)
+        except codec.MissingCodecError:
+            raise
+        except Exception:
+            records = None
+        if records is not None:
+            yield base + pos, base + body_start + size, records
+        pos = body_start + size
+
+
+def read_records(path, fernet):
+    """Return every record stored in ``path`` in write order."""
+    records = []
+    for _, _, frame in iter_frames(path, fernet):
+        records.extend(frame)
+    return records
+
+
+def read_partition(path, fernet, start=None):
+    """Return ``(records, end)`` for the frames of ``path`` from ``start``.
+
+    ``end`` is the offset just past the last complete frame, so a later call
+    with ``start=end`` picks up exactly what was appended in between.  It is
+    ``None`` for legacy blobs, which can only be re-read as a whole.
+    """
+    records = []
+    end = len(MAGIC) if start is None else start
+    for _, frame_end, frame in iter_frames(path, fernet, start):
+        records.extend(frame)
+        end = frame_end
+    return records, end
+
+
+def live_records(records):
+    """Return ``records`` without superseded versions and tombstones."""
+    if not any(REVISION in record for record in records):
+        return records
+    last = {record.get("id"): row for row, record in enumerate(records)}
+    return [
+        record for row, record in enumerate(records)
+        if (record.get("id") is None or last[record["id"]] == row)
+        and not record.get(DELETED)
+    ]
+
+
+def _signature(st):
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def load_partition(path, fernet):
+    """Like :func:`read_partition` from the start, through the shared cache.
+
+    The returned list is a copy and may be modified by the caller; the
+    records themselves are shared and must not be.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        partition_cache.invalidate(path)
+        return [], len(MAGIC)
+    signature = _signature(st)
+    cached = partition_cache.get(path, signature)
+    if cached is not None and cached[0] == signature:
+        return list(cached[1]), cached[2]
+    old_signature, old_records, old_end = cached or (None, None, None)
+    if (
+        old_end is not None
+        and old_signature[0] == st.st_ino
+        and old_signature[1] < st.st_size
+    ):
+        # the file only grew: decode the new frames and keep the rest
+        tail, end = read_partition(path, fernet, old_end)
+        records = old_records + tail
+    else:
+        records, end = read_partition(path, fernet)
+    partition_cache.put(path, signature, records, end, estimate_bytes(records))
+    return list(records), end
+
+
+def read_frame(path, fernet, offset):
+    """Return the records of the single frame starting at ``offset``.
+
+    Returns ``None`` when there is no readable frame at that position.
+    """
+    try:
+        with locked(path, exclusive=False), open(path, "rb") as f:
+            head = f.read(len(MAGIC))
+            version = VERSIONS.get(head)
+            if not version:
+                if offset != 0:
+                    return None
+                data = head + f.read()
+            else:
+                f.seek(offset)
+                prefix = f.read(_LENGTH.size)
+                if len(prefix) < _LENGTH.size:
+                    return None
+                (size,) = _LENGTH.unpack(prefix)
+                data = f.read(size)
+                if len(data) < size:
+                    return None
+        if not version:
+            return json.loads(fernet.decrypt(data).decode())
+        return _decode_frame(fernet, data, version)
+    except codec.MissingCodecError:
+        raise
+    except Exception:
+        return None
+
+
+def write_records(path, fernet, records):
+    """Replace ``path`` with a fresh segment holding ``records``.
+
+    The segment is written to a temporary file and renamed over ``path``,
+    so readers see either the old file or the complete new one.
+    """
+    with locked(path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC)
+            if records:
+                f.write(_encode_frame(fernet, records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        partition_cache.invalidate(path)
+
+
+def upgrade(path, fernet):
+    """Rewrite a legacy whole-file blob at ``path`` as a segment."""
+    with locked(path):
+        if os.path.exists(path) and not is_segment(path):
+            write_records(path, fernet, read_records(path, fernet))
+
+
+def append_records(path, fernet, records):
+    """Append ``records`` to ``path`` as one frame.
+
+    Returns ``(offset, end)``: where the frame starts and where it stops.
+    Writers to the same file take turns on its exclusive lock, so their
+    frames never interleave.
+    """
+    with locked(path):
+        upgrade(path, fernet)
+        with open(path, "a+b") as f:
+            f.seek(0)
+            # frames follow the format of the segment they are appended to
+            version = VERSIONS.get(f.read(len(MAGIC)), 2)
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                f.write(MAGIC)
+            offset = f.tell()
+            frame = _encode_frame(fernet, records, version)
+            f.write(frame)
+        st = os.stat(path)
+    end = offset + len(frame)
+    partition_cache.extend(path, offset, _signature(st), records, end, estimate_bytes(records))
+    return offset, end
+
+
+def _whole_frames_end(f, start):
+    """Return the offset just past the last complete frame from ``start``."""
+    size = f.seek(0, os.SEEK_END)
+    pos = start
+    while pos + _LENGTH.size <= size:
+        f.seek(pos)
+        (length,) = _LENGTH.unpack(f.read(_LENGTH.size))
+        if pos + _LENGTH.size + length > size:
+            break
+        pos += _LENGTH.size + length
+    return pos
+
+
+def replay_append(path, fernet, records, size):
+    """Redo an append that was logged when ``path`` was ``size`` bytes long.
+
+    A frame of ``records`` already at that position is left alone and
+    ``None`` returned.  Otherwise only a partial frame at the end of the
+    file is cut, so frames appended by others since are kept, and the
+    records are appended at the end; returns ``(offset, end)``.
+    """
+    with locked(path):
+        upgrade(path, fernet)
+        if os.path.exists(path):
+            offset = max(size, len(MAGIC))
+            if read_frame(path, fernet, offset) == records:
+                return None
+            with open(path, "r+b") as f:
+                if f.seek(0, os.SEEK_END) < len(MAGIC):
+                    # the crash hit before the header was complete
+                    f.truncate(0)
+                else:
+                    f.truncate(_whole_frames_end(f, offset))
+            partition_cache.invalidate(path)
+        return append_records(path, fernet, records)
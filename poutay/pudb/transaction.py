@@ -0,0 +1,272 @@
+"""Unit-of-work batching for pudb writes.
+
+Inside ``with Model.atomic():`` every ``save``, ``update`` and ``delete`` is
+buffered instead of hitting the disk; all of them append records (new rows,
+new versions or tombstones).  When the outermost block exits the
+buffered operations are turned into one plan per ``.pu`` file, the plan is
+written to ``pudb.wal`` in the database root and only then applied, so every
+file is touched once and an interrupted flush is replayed by
+:func:`recover` the next time the database is opened.
+
+Flushes from different processes take turns on a lock of the write-ahead
+log and hold the locks of the files they append to from planning until the
+appends are done (see :mod:`.locking`).  Plain ``save()`` calls take the
+log's lock too, so a log left behind is replayed before anything else is
+appended; the replay skips frames that made it to disk and only cuts a
+partial frame at the end of a file.
+"""
+import json
+import os
+import threading
+from contextlib import ContextDecorator, ExitStack, contextmanager
+
+from . import storage
+from .encryption import get_fernet_key
+from .locking import locked
+from .locator import Locator
+from .manifest import Manifest
+
+WAL_NAME = "pudb.wal"
+
+_local = threading.local()
+
+
+def current():
+    """Return the unit of work active on this thread, if any."""
+    return getattr(_local, "uow", None)
+
+
+class UnitOfWork:
+    def __init__(self):
+        self.ops = []
+
+    def add_append(self, model_cls, date_str, records):
+        self.ops.append(("append", model_cls, date_str, records))
+
+    def pending(self, model_cls, record_id):
+        """Whether a record with ``record_id`` is buffered for ``model_cls``."""
+        return any(
+            record.get("id") == record_id
+            for _, op_cls, _, records in self.ops if op_cls is model_cls
+            for record in records
+        )
+
+    def discard(self, model_cls, predicate):
+        """Drop buffered records of ``model_cls`` matching ``predicate``.
+
+        Returns the ids of the records dropped.
+        """
+        dropped = []
+        for i, (kind, op_cls, date_str, records) in enumerate(self.ops):
+            if op_cls is not model_cls:
+                continue
+            kept = []
+            for record in records:
+                if not record.get(storage.DELETED) and predicate(record):
+                    dropped.append(record.get("id"))
+                else:
+                    kept.append(record)
+            self.ops[i] = (kind, op_cls, date_str, kept)
+        return dropped
+
+    def update(self, model_cls, predicate, changes):
+        """Apply ``changes`` to buffered records of ``model_cls`` matching
+        ``predicate``; returns the ids of the records changed.
+        """
+        changed = []
+        for i, (kind, op_cls, date_str, records) in enumerate(self.ops):
+            if op_cls is not model_cls:
+                continue
+            revised = []
+            for record in records:
+                if not record.get(storage.DELETED) and predicate(record):
+                    record = {**record, **changes}
+                    changed.append(record.get("id"))
+                revised.append(record)
+            self.ops[i] = (kind, op_cls, date_str, revised)
+        return changed
+
+    def buffered(self, model_cls):
+        """Yield the buffered records of ``model_cls`` in write order."""
+        for _, op_cls, _, records in self.ops:
+            if op_cls is model_cls:
+                yield from records
+
+    def buffered_ids(self, model_cls):
+        """Ids of ``model_cls`` whose latest version is still buffered."""
+        return {record.get("id") for record in self.buffered(model_cls)}
+
+    def commit(self):
+        databases = {}
+        for op in self.ops:
+            model_cls = op[1]
+            databases.setdefault((model_cls._db_root, model_cls._password), []).append(op)
+        for (db_root, password), ops in databases.items():
+            _commit_database(db_root, password, ops)
+
+
+def _plan(db_root, fernet, ops, hold):
+    """Turn buffered ``ops`` into one append per partition file.
+
+    Every file is locked on ``hold`` before its size is taken, so nobody
+    appends to it between planning and applying.
+    """
+    targets = {}
+    for _, model_cls, date_str, records in ops:
+        if records:
+            path = model_cls._get_file_path(date_str)
+            targets.setdefault(path, (model_cls, date_str, []))[2].extend(records)
+
+    plan = []
+    for path, (model_cls, date_str, records) in sorted(targets.items()):
+        hold.enter_context(locked(path))
+        storage.upgrade(path, fernet)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        plan.append({
+            "path": os.path.relpath(path, db_root), "mode": "append", "size": size,
+            "records": records, "model": model_cls.__name__, "date": date_str,
+        })
+    return plan
+
+
+def _apply(db_root, fernet, plan, replay=False):
+    """Execute ``plan``; returns the ``(offset, end)`` of each append.
+
+    With ``replay`` appends that already made it to disk are skipped and
+    only partial frames are cut (see :func:`storage.replay_append`).
+    """
+    frames = []
+    for entry in plan:
+        path = os.path.join(db_root, entry["path"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if entry["mode"] == "append" and replay:
+            frames.append(storage.replay_append(path, fernet, entry["records"], entry["size"]))
+        elif entry["mode"] == "append":
+            frames.append(storage.append_records(path, fernet, entry["records"]))
+        else:
+            # logs written before deletes became tombstones may still
+            # replace whole partitions
+            storage.write_records(path, fernet, entry["records"])
+            frames.append(None)
+    return frames
+
+
+def _fsync(path):
+    """Flush ``path``, a file or a directory, to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def wal_locked(db_root, password):
+    """Hold the lock of the write-ahead log, with any pending log replayed."""
+    wal_path = os.path.join(db_root, WAL_NAME)
+    with locked(wal_path):
+        _recover(db_root, password, wal_path)
+        yield
+
+
+def append_records(db_root, password, path, records):
+    """Append ``records`` to the partition at ``path`` outside any batch.
+
+    Returns ``(offset, end)`` like :func:`storage.append_records`.  Only the
+    partition is locked: a flush locks the files it touches before logging
+    them, so while ours is held no log can be describing it unless the
+    flush that wrote it died.  That log is replayed first, under the lock
+    of the log, so nothing lands between an interrupted flush and its
+    replay.
+    """
+    fernet = get_fernet_key(password)
+    wal_path = os.path.join(db_root, WAL_NAME)
+    while True:
+        with locked(path):
+            if not os.path.exists(wal_path):
+                return storage.append_records(path, fernet, records)
+        recover(db_root, password)
+
+
+def _commit_database(db_root, password, ops):
+    fernet = get_fernet_key(password)
+    wal_path = os.path.join(db_root, WAL_NAME)
+    # one flush per database at a time: they share the write-ahead log
+    with wal_locked(db_root, password), ExitStack() as hold:
+        plan = _plan(db_root, fernet, ops, hold)
+        if not plan:
+            return
+
+        os.makedirs(db_root, exist_ok=True)
+        tmp_path = f"{wal_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(fernet.encrypt(json.dumps(plan).encode()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, wal_path)
+
+        frames = _apply(db_root, fernet, plan)
+        # the log may only go once what it describes is on disk
+        paths = {os.path.join(db_root, entry["path"]) for entry in plan}
+        for path in paths:
+            _fsync(path)
+        for directory in {os.path.dirname(path) for path in paths} | {db_root}:
+            _fsync(directory)
+        os.remove(wal_path)
+
+    models = {op[1].__name__: op[1] for op in ops}
+    for entry, frame in zip(plan, frames):
+        models[entry["model"]]._after_append(entry["date"], entry["records"], *frame)
+
+
+def recover(db_root, password):
+    """Replay a write-ahead log left behind by an interrupted flush."""
+    wal_path = os.path.join(db_root, WAL_NAME)
+    with locked(wal_path):
+        return _recover(db_root, password, wal_path)
+
+
+def _recover(db_root, password, wal_path):
+    tmp_path = f"{wal_path}.tmp"
+    if os.path.exists(tmp_path):
+        # the log never became durable, so nothing was applied
+        os.remove(tmp_path)
+    if not os.path.exists(wal_path):
+        return False
+    fernet = get_fernet_key(password)
+    with open(wal_path, "rb") as f:
+        plan = json.loads(fernet.decrypt(f.read()).decode())
+    _apply(db_root, fernet, plan, replay=True)
+    for entry in plan:
+        # the crash may have hit before the model's logs were updated
+        path = os.path.join(db_root, entry["path"])
+        for log_cls in (Manifest, Locator):
+            log_cls.for_model(db_root, entry["model"], fernet).refresh(entry["date"], path)
+    os.remove(wal_path)
+    return True
+
+
+class Atomic(ContextDecorator):
+    """Buffer pudb writes on this thread and flush them on exit.
+
+    Blocks nest: only the outermost one flushes, and an exception escaping
+    it discards the whole batch.  Reads issued inside the block do not
+    see the buffered writes.
+    """
+
+    def __enter__(self):
+        if current() is None:
+            _local.uow = UnitOfWork()
+            _local.depth = 0
+        _local.depth += 1
+        return _local.uow
+
+    def __exit__(self, exc_type, exc, tb):
+        _local.depth -= 1
+        if _local.depth:
+            return False
+        uow = _local.uow
+        _local.uow = None
+        if exc_type is None:
+            uow.commit()
+        return False
@@ -0,0 +1,132 @@
+"""Write-behind: ``save()`` queues its record and returns at once.
+
+With ``PUDB_WRITE_BEHIND`` enabled, writes made outside ``atomic()`` are
+queued instead of written.  A background thread flushes the queue every
+``PUDB_FLUSH_INTERVAL`` seconds, or as soon as ``PUDB_FLUSH_ROWS`` records
+are waiting; each flush is one unit of work, so the queued records are
+coalesced into one append per partition file and go through the
+write-ahead log like an ``atomic()`` block.
+
+Reads stay consistent with the writes made before them: a query first
+flushes whatever is queued for its model.  :func:`flush` writes everything
+now, :func:`close` also stops the thread, and the queue is flushed when the
+interpreter exits.  A background flush that fails is logged and retried on
+the next one; :func:`flush` raises.
+"""
+import atexit
+import logging
+import threading
+
+from poutay.conf import settings
+
+from . import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def enabled():
+    return bool(getattr(settings, "PUDB_WRITE_BEHIND", False))
+
+
+class WriteBehind:
+    def __init__(self):
+        self._cond = threading.Condition()
+        # held while a batch is written, so readers can wait for it
+        self._flushing = threading.Lock()
+        self._queue = transaction.UnitOfWork()
+        self._inflight = None
+        self._rows = 0
+        self._thread = None
+        self._closed = False
+
+    def enqueue(self, model_cls, date_str, records):
+        with self._cond:
+            self._queue.add_append(model_cls, date_str, records)
+            self._rows += len(records)
+            if self._thread is None or not self._thread.is_alive():
+                self._closed = False
+                self._thread = threading.Thread(
+                    target=self._run, name="pudb-writer", daemon=True
+                )
+                self._thread.start()
+            if self._rows >= getattr(settings, "PUDB_FLUSH_ROWS", 1000):
+                self._cond.notify()
+
+    def _batches(self):
+        return [uow for uow in (self._inflight, self._queue) if uow is not None]
+
+    def pending(self, model_cls, record_id):
+        """Whether a record with ``record_id`` is queued for ``model_cls``."""
+        with self._cond:
+            return any(uow.pending(model_cls, record_id) for uow in self._batches())
+
+    def has_pending(self, model_cls):
+        with self._cond:
+            return any(op[1] is model_cls for uow in self._batches() for op in uow.ops)
+
+    def flush(self):
+        """Write everything queued so far; returns how many records."""
+        with self._flushing:
+            with self._cond:
+                batch, self._queue = self._queue, transaction.UnitOfWork()
+                rows, self._rows = self._rows, 0
+                self._inflight = batch
+            try:
+                batch.commit()
+            except BaseException:
+                with self._cond:
+                    # put the batch back in front of what arrived since
+                    batch.ops.extend(self._queue.ops)
+                    self._queue = batch
+                    self._rows += rows
+                raise
+            finally:
+                with self._cond:
+                    self._inflight = None
+        return rows
+
+    def sync(self, model_cls):
+        """Flush before ``model_cls`` is read, if it has queued writes."""
+        if self.has_pending(model_cls):
+            self.flush()
+
+    def close(self):
+        """Flush the queue and stop the writer thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(getattr(settings, "PUDB_FLUSH_INTERVAL", 0.5))
+                closed = self._closed
+                idle = not self._queue.ops
+            if not idle:
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("pudb write-behind flush failed; retrying")
+            if closed:
+                return
+
+
+writer = WriteBehind()
+
+
+def flush():
+    """Write every queued record now."""
+    return writer.flush()
+
+
+def close():
+    """Flush the queue and stop the writer thread."""
+    writer.close()
+
+
+atexit.register(close)
@@ -0,0 +1,75 @@
+"""Microbenchmark: compiled filter predicates against per-row interpretation.
+
+Run with ``python poutay/tests/bench_lookups.py [rows]``.  The interpreted
+matcher is the one pudb used before filters were compiled: it splits every
+``field__op`` key and walks the lookup chain for every row.
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from poutay.pudb.lookups import compile_filters
+
+
+def interpreted(item, filters):
+    for raw_key, value in filters.items():
+        if "__" in raw_key:
+            field, op = raw_key.split("__", 1)
+        else:
+            field, op = raw_key, "exact"
+        field_val = item.get(field)
+        if op == "exact":
+            if str(field_val) != str(value): return False
+        elif op == "contains":
+            if str(value) not in str(field_val): return False
+        elif op == "icontains":
+            if str(value).lower() not in str(field_val).lower(): return False
+        elif op == "gt":
+            if not (field_val > value): return False
+        elif op == "gte":
+            if not (field_val >= value): return False
+        elif op == "lt":
+            if not (field_val < value): return False
+        elif op == "lte":
+            if not (field_val <= value): return False
+        elif op == "in":
+            if field_val not in value: return False
+        else:
+            return False
+    return True
+
+
+CASES = {
+    "exact": {"customer": "c7"},
+    "icontains": {"customer__icontains": "C7"},
+    "exact+range": {"customer": "c7", "amount__gte": 100, "amount__lt": 900},
+    "in": {"status__in": ["open", "paid"]},
+}
+
+
+def main(rows=1_000_000):
+    records = [
+        {"id": str(i), "customer": f"c{i % 10}", "amount": i % 1000,
+         "status": ("open", "paid", "void")[i % 3]}
+        for i in range(rows)
+    ]
+    print(f"{rows} rows")
+    for name, filters in CASES.items():
+        start = time.perf_counter()
+        before = sum(1 for r in records if interpreted(r, filters))
+        interpreted_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        match = compile_filters(filters)
+        after = sum(1 for r in records if match(r))
+        compiled_s = time.perf_counter() - start
+
+        assert before == after, name
+        print(f"{name:12} interpreted {interpreted_s:6.3f}s  compiled {compiled_s:6.3f}s"
+              f"  x{interpreted_s / compiled_s:.1f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -3,6 +3,8 @@ from pathlib import Path
 from unittest import mock
 import subprocess
 
+import pytest
+
 # Ensure the project root is on the path so that ``import poutay`` resolves to
 # the CLI module defined at the repository root rather than the ``poutay``
 # package directory. ``parents[2]`` points to the repository root.
@@ -48,3 +50,35 @@ def test_module_execution_via_dash_m(tmp_path):
     assert "usage:" in result.stdout.lower()
 
 
+def test_dbcompact_parses_options():
+    from poutay import DbCompactCommand
+
+    parser = poutay.build_parser()
+    args = parser.parse_args(["dbcompact", "db://u:p@/tmp/db", "--monthly", "--model", "Order"])
+    assert isinstance(args.command, DbCompactCommand)
+    assert args.monthly and args.models == ["Order"]
+
+
+def test_dbcompact_compacts_a_database(tmp_path, monkeypatch, capsys):
+    pytest.importorskip("cryptography")
+    pytest.importorskip("bcrypt")
+    from poutay.pudb.auth import AuthManager
+    from poutay.pudb.orm import Field, create_base_model
+
+    monkeypatch.chdir(tmp_path)
+    AuthManager().signup("admin", "secret")
+    connection = f"db://admin:secret@{tmp_path / 'db'}"
+    base = create_base_model(connection)
+
+    class Order(base):
+        customer = Field("customer")
+
+    Order._append_records("2024-05-01", [{"id": "a", "customer": "old"}])
+    Order._append_records("2024-05-02", [{"id": "a", "customer": "new"}])
+
+    args = poutay.build_parser().parse_args(["dbcompact", connection, "--monthly"])
+    args.command.run(args)
+    out = capsys.readouterr().out
+    assert "Rows dropped:         1" in out and "Months merged:        1" in out
+    assert [o.customer for o in Order.objects().all()] == ["new"]
+    assert sorted(p.name for p in (tmp_path / "db" / "2024" / "05").iterdir()) == ["00"]
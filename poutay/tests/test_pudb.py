@@ -0,0 +1,1233 @@
+import json
+import os
+import sys
+from array import array
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+pytest.importorskip("cryptography")
+pytest.importorskip("bcrypt")
+
+from poutay.pudb import field_index, storage, transaction
+from poutay.pudb.cache import PartitionCache, estimate_bytes
+from poutay.pudb.auth import AuthManager
+from poutay.pudb.encryption import get_fernet_key
+from poutay.pudb.storage import read_frame
+from poutay.pudb.orm import (
+    Avg, BaseModel, Count, Field, ForeignKey, ManyToManyField, Max, Min, Q, Sum,
+    create_base_model,
+)
+
+
+@pytest.fixture
+def base(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    AuthManager().signup("admin", "secret")
+    BaseModel._locators.clear()
+    BaseModel._manifests.clear()
+    BaseModel._snapshots.clear()
+    return create_base_model(f"db://admin:secret@{tmp_path / 'db'}")
+
+
+@pytest.fixture
+def Order(base):
+    class Order(base):
+        customer = Field("customer")
+        amount = Field("amount")
+
+    return Order
+
+
+def partition_files(base, name):
+    return sorted(Path(base._db_root).rglob(f"{name}.pu"))
+
+
+def test_save_appends_one_frame_per_record(base, Order):
+    Order(customer="Ali", amount=1).save()
+    (path,) = partition_files(base, "Order")
+    head = path.read_bytes()
+    assert head.startswith(storage.MAGIC)
+
+    Order(customer="Sara", amount=2).save()
+    assert path.read_bytes().startswith(head)
+    fernet = get_fernet_key("secret")
+    assert len(list(storage.iter_frames(path, fernet))) == 2
+    assert [o.customer for o in Order.objects().filter(amount=2)] == ["Sara"]
+
+
+def test_legacy_blob_is_read_and_upgraded_on_append(base, Order):
+    fernet = get_fernet_key("secret")
+    path = Path(Order._get_file_path("2024-01-02"))
+    legacy = [{"id": "1", "customer": "Old", "amount": 5}]
+    path.write_bytes(fernet.encrypt(json.dumps(legacy).encode()))
+
+    assert [o.customer for o in Order.objects().filter(customer="Old")] == ["Old"]
+
+    storage.append_records(str(path), fernet, [{"id": "2", "customer": "New", "amount": 6}])
+    assert storage.is_segment(path)
+    assert [r["customer"] for r in storage.read_records(path, fernet)] == ["Old", "New"]
+
+
+def test_truncated_trailing_frame_is_ignored(base, Order):
+    Order(customer="Ali", amount=1).save()
+    Order(customer="Sara", amount=2).save()
+    (path,) = partition_files(base, "Order")
+    path.write_bytes(path.read_bytes()[:-10])
+    assert [o.customer for o in Order.objects().all()] == ["Ali"]
+
+
+def test_delete_removes_only_matching_rows(base, Order):
+    Order(customer="Ali", amount=1).save()
+    Order(customer="Sara", amount=2).save()
+    assert Order.delete(customer="Ali") == 1
+    assert [o.customer for o in Order.objects().all()] == ["Sara"]
+
+
+def test_bulk_create_writes_one_frame_per_batch(base, Order):
+    objs = Order.bulk_create(
+        [Order(customer=f"c{i}", amount=i) for i in range(25)], batch_size=10
+    )
+    assert len(objs) == 25
+    (path,) = partition_files(base, "Order")
+    fernet = get_fernet_key("secret")
+    assert [len(frame) for _, _, frame in storage.iter_frames(path, fernet)] == [10, 10, 5]
+    assert len(Order.objects().all()) == 25
+    assert Order.objects().filter(customer="c7").first().amount == 7
+
+
+def test_bulk_create_replaces_stored_objects(base, Order):
+    first = Order(customer="a", amount=1)
+    first.save()
+    first.amount = 5
+    Order.bulk_create([first, Order(customer="b", amount=2)])
+    assert sorted((o.customer, o.amount) for o in Order.objects().all()) == [("a", 5), ("b", 2)]
+    assert Order.objects().filter(customer="a").count() == 1
+
+def test_atomic_flushes_each_file_once(base, Order):
+    with Order.atomic():
+        for i in range(5):
+            Order(customer=f"c{i}", amount=i).save()
+        assert partition_files(base, "Order") == []
+        Order.delete(customer="c0")
+
+    (path,) = partition_files(base, "Order")
+    fernet = get_fernet_key("secret")
+    assert len(list(storage.iter_frames(path, fernet))) == 1
+    assert sorted(o.customer for o in Order.objects().all()) == ["c1", "c2", "c3", "c4"]
+    assert not Path(base._db_root, transaction.WAL_NAME).exists()
+
+
+def test_update_inside_atomic_changes_buffered_records(base, Order):
+    Order(customer="stored", amount=1).save()
+    with Order.atomic():
+        Order(customer="new", amount=1).save()
+        assert Order.objects().filter(amount=1).update(amount=2) == 2
+        assert Order.objects().filter(customer="stored").update(customer="renamed") == 1
+    assert sorted((o.customer, o.amount) for o in Order.objects().all()) == [("new", 2), ("renamed", 2)]
+
+
+def test_delete_inside_atomic_counts_each_record_once(base, Order):
+    kept = Order(customer="kept", amount=1)
+    kept.save()
+    Order(customer="stored", amount=1).save()
+    with Order.atomic():
+        Order(customer="new", amount=1).save()
+        Order.objects().filter(customer="stored").update(amount=3)
+        kept.amount = 2
+        kept.save()
+        assert Order.delete(amount=1) == 1
+        assert Order.delete(amount=3) == 1
+    assert [(o.customer, o.amount) for o in Order.objects().all()] == [("kept", 2)]
+
+def test_atomic_discards_batch_on_error_and_works_as_decorator(base, Order):
+    with pytest.raises(RuntimeError):
+        with Order.atomic():
+            Order(customer="lost", amount=1).save()
+            raise RuntimeError
+
+    @Order.atomic()
+    def handler():
+        Order(customer="kept", amount=2).save()
+        Order(customer="kept", amount=3).save()
+
+    handler()
+    assert [o.customer for o in Order.objects().all()] == ["kept", "kept"]
+
+
+def test_interrupted_flush_is_replayed_from_wal(base, Order, monkeypatch):
+    Order(customer="before", amount=0).save()
+    (path,) = partition_files(base, "Order")
+
+    def crash(db_root, fernet, plan):
+        # half of a frame made it to disk before the process died
+        with open(path, "ab") as f:
+            f.write(b"\x00\x00\x10\x00partial")
+        raise SystemExit
+
+    with monkeypatch.context() as m:
+        m.setattr(transaction, "_apply", crash)
+        with pytest.raises(SystemExit):
+            with Order.atomic():
+                Order(customer="after", amount=1).save()
+
+    assert Path(base._db_root, transaction.WAL_NAME).exists()
+    assert transaction.recover(base._db_root, "secret")
+    assert sorted(o.customer for o in Order.objects().all()) == ["after", "before"]
+    assert not transaction.recover(base._db_root, "secret")
+
+
+def test_flush_syncs_partitions_before_dropping_wal(base, Order, monkeypatch):
+    wal_path = os.path.join(base._db_root, transaction.WAL_NAME)
+    synced = []
+    fsync = transaction._fsync
+
+    def record(path):
+        assert os.path.exists(wal_path)
+        synced.append(path)
+        fsync(path)
+
+    monkeypatch.setattr(transaction, "_fsync", record)
+    with Order.atomic():
+        Order(customer="a", amount=1).save()
+    (path,) = partition_files(base, "Order")
+    assert str(path) in synced
+    assert os.path.dirname(path) in synced and base._db_root in synced
+
+def test_plain_saves_lock_only_their_partition(base, Order, monkeypatch):
+    Order(customer="first", amount=1).save()
+    locked = []
+    lock = transaction.locked
+
+    def record(path, *args, **kwargs):
+        locked.append(os.path.basename(path))
+        return lock(path, *args, **kwargs)
+
+    monkeypatch.setattr(transaction, "locked", record)
+    Order(customer="second", amount=2).save()
+    assert locked == ["Order.pu"]
+
+def test_recovery_keeps_appends_made_after_the_crash(base, Order, monkeypatch):
+    Order(customer="before", amount=0).save()
+    (path,) = partition_files(base, "Order")
+    fernet = get_fernet_key("secret")
+    apply = transaction._apply
+
+    def crash_after_apply(db_root, fernet, plan):
+        apply(db_root, fernet, plan)
+        raise SystemExit
+
+    def crash_mid_frame(db_root, fernet, plan):
+        with open(path, "ab") as f:
+            f.write(b"\x00\x00\x10\x00partial")
+        raise SystemExit
+
+    with monkeypatch.context() as m:
+        m.setattr(transaction, "_apply", crash_after_apply)
+        with pytest.raises(SystemExit):
+            with Order.atomic():
+                Order(customer="batched", amount=1).save()
+    # a writer that does not look at the log appends before recovery
+    storage.append_records(str(path), fernet, [{"id": "x", "customer": "unrelated", "amount": 2}])
+    assert transaction.recover(base._db_root, "secret")
+    assert sorted(o.customer for o in Order.objects().all()) == ["batched", "before", "unrelated"]
+
+    with monkeypatch.context() as m:
+        m.setattr(transaction, "_apply", crash_mid_frame)
+        with pytest.raises(SystemExit):
+            with Order.atomic():
+                Order(customer="after", amount=3).save()
+    # a plain save replays the log before appending
+    Order(customer="other-process", amount=4).save()
+    assert not Path(base._db_root, transaction.WAL_NAME).exists()
+    assert sorted(o.customer for o in Order.objects().all()) == [
+        "after", "batched", "before", "other-process", "unrelated",
+    ]
+
+
+def count_decrypts(monkeypatch):
+    calls = []
+    original = storage.iter_frames
+
+    def counting(path, fernet, start=None):
+        if str(path).endswith(".pu"):
+            calls.append(path)
+        return original(path, fernet, start)
+
+    monkeypatch.setattr(storage, "iter_frames", counting)
+    return calls
+
+
+def count_frame_reads(monkeypatch):
+    calls = []
+    original = storage.read_frame
+
+    def counting(path, fernet, offset):
+        if str(path).endswith(".pu"):
+            calls.append(offset)
+        return original(path, fernet, offset)
+
+    monkeypatch.setattr(storage, "read_frame", counting)
+    return calls
+
+
+def test_exact_lookups_are_answered_from_the_index(base, Order, monkeypatch):
+    Order.bulk_create([Order(customer=f"c{i % 3}", amount=i) for i in range(1, 10)])
+    calls = count_decrypts(monkeypatch)
+    frames = count_frame_reads(monkeypatch)
+    # the first lookup reads the snapshot, the next one indexes the partition
+    assert [o.amount for o in Order.objects().filter(customer="c1")] == [1, 4, 7]
+    assert [o.amount for o in Order.objects().filter(customer="c1")] == [1, 4, 7]
+    del calls[:], frames[:]
+
+    for _ in range(3):
+        assert [o.amount for o in Order.objects().filter(customer__in=["c2", "c0"])] == [2, 3, 5, 6, 8, 9]
+        assert [o.amount for o in Order.objects().filter(customer="c1", amount__gt=3)] == [4, 7]
+    assert calls == [] and frames == []
+
+    Order(customer="c1", amount=10).save()
+    assert [o.amount for o in Order.objects().filter(customer="c1")] == [1, 4, 7, 10]
+    assert calls == []
+
+
+def test_exact_none_matches_records_missing_the_field(base, Order):
+    Order(customer="old", amount=1).save()
+
+    class Order(base):
+        customer = Field("customer")
+        amount = Field("amount")
+        note = Field("note")
+
+    Order(customer="new", amount=2).save()
+    Order(customer="noted", amount=3, note="x").save()
+    expected = [o.customer for o in Order.objects().filter(Q(note=None))]
+    assert expected == ["old", "new"]
+    assert [o.customer for o in Order.objects().filter(note=None)] == expected
+
+def test_in_lookups_compare_numbers_like_q(base, Order):
+    Order.bulk_create([Order(customer="a", amount=1.0), Order(customer="b", amount=2), Order(customer="c", amount="1")])
+    assert [o.customer for o in Order.objects().filter(amount__in=[1, 2])] == ["a", "b"]
+    assert [o.customer for o in Order.objects().filter(Q(amount__in=[1, 2]))] == ["a", "b"]
+    assert [o.customer for o in Order.objects().filter(amount__in=["1"])] == ["c"]
+
+
+def test_index_catches_up_with_appends_from_elsewhere(base, Order):
+    Order(customer="Ali", amount=1).save()
+    assert len(Order.objects().filter(customer="Ali")) == 1
+
+    (path,) = partition_files(base, "Order")
+    fernet = get_fernet_key("secret")
+    storage.append_records(str(path), fernet, [{"id": "x", "customer": "Ali", "amount": 2}])
+    assert [o.amount for o in Order.objects().filter(customer="Ali")] == [1, 2]
+
+    Order.delete(amount=1)
+    assert [o.amount for o in Order.objects().filter(customer="Ali")] == [2]
+
+
+def test_indexes_are_per_database_and_bounded(base, Order, tmp_path, monkeypatch):
+    from poutay.conf import settings
+
+    monkeypatch.setattr(settings, "PUDB_INDEX_SNAPSHOTS", False)
+    for n, day in enumerate(["2024-05-01", "2024-05-02", "2024-05-03"]):
+        Order._append_records(day, [{"id": f"{day}-{i}", "customer": f"c{i % 2}", "amount": n} for i in range(4)])
+    assert [o.amount for o in Order.objects().filter(customer="c1")] == [2, 2, 1, 1, 0, 0]
+
+    store = Order._index_store()
+    index = store.get("Order", "2024-05-01")
+    assert isinstance(index.postings["customer"]["c1"], array)
+    assert list(index.postings["customer"]["c1"]) == [1, 3]
+
+    # the least recently used partitions go once the budget is exceeded
+    store.configure(2 * index.nbytes + index.nbytes // 2)
+    assert len(store) == 2 and store.get("Order", "2024-05-03") is None
+    monkeypatch.setattr(storage, "partition_cache", PartitionCache())
+    calls = count_decrypts(monkeypatch)
+    assert [o.amount for o in Order.objects().between("2024-05-03", "2024-05-03").filter(customer="c0")] == [2, 2]
+    assert len(calls) == 1 and len(store) == 2
+
+    other = create_base_model(f"db://admin:secret@{tmp_path / 'other'}")
+
+    class Order(other):
+        customer = Field("customer")
+
+    Order(customer="c1").save()
+    assert [o.customer for o in Order.objects().filter(customer="c1")] == ["c1"]
+    assert Order._index_store() is not store
+
+
+def forget_indexes(model):
+    # what a freshly started process knows
+    model._index_store().clear()
+    BaseModel._snapshots.clear()
+
+
+def test_cold_lookups_read_the_index_snapshot(base, Order, monkeypatch):
+    for chunk in range(3):
+        Order.bulk_create([Order(customer=f"c{i % 3}", amount=i) for i in range(3 * chunk, 3 * chunk + 3)])
+    assert [o.amount for o in Order.objects().filter(customer="c1")] == [1, 4, 7]
+    (path,) = partition_files(base, "Order")
+    assert path.with_suffix(".idx").exists()
+
+    forget_indexes(Order)
+    calls = count_decrypts(monkeypatch)
+    frames = count_frame_reads(monkeypatch)
+    assert [o.amount for o in Order.objects().filter(customer__in=["c2"])] == [2, 5, 8]
+    assert calls == [] and len(frames) == 3
+    # the postings were read for that lookup only
+    (snapshot,) = BaseModel._snapshots.values()
+    assert snapshot.covered >= {"customer"}
+    assert not any(isinstance(v, (dict, list)) for k, v in vars(snapshot).items() if k != "coverage")
+    # later lookups index the partition in memory once
+    assert [o.amount for o in Order.objects().filter(customer="c1")] == [1, 4, 7]
+    assert [o.amount for o in Order.objects().filter(customer="c2")] == [2, 5, 8]
+    assert len(calls) == 1 and len(frames) == 3
+    del calls[:]
+
+    # saves extend the snapshot; one that missed an append is not used, and
+    # the next save catches it up
+    Order(customer="c2", amount=9).save()
+    storage.append_records(str(path), get_fernet_key("secret"), [{"id": "x", "customer": "c2", "amount": 10}])
+    forget_indexes(Order)
+    del frames[:]
+    assert [o.amount for o in Order.objects().filter(customer="c2")] == [2, 5, 8, 9, 10]
+    assert frames == []
+    Order(customer="c2", amount=11).save()
+    forget_indexes(Order)
+    del calls[:], frames[:]
+    assert [o.amount for o in Order.objects().filter(customer="c2")] == [2, 5, 8, 9, 10, 11]
+    assert calls == [] and len(frames) == 6
+
+    # lookups never describe a partition themselves
+    path.with_suffix(".idx").unlink()
+    forget_indexes(Order)
+    assert [o.amount for o in Order.objects().filter(customer="c2")] == [2, 5, 8, 9, 10, 11]
+    assert not path.with_suffix(".idx").exists()
+
+    # updated versions need every row, so the partition is decoded again
+    Order.objects().filter(amount=2).update(customer="c0")
+    forget_indexes(Order)
+    assert [o.amount for o in Order.objects().filter(customer="c2")] == [5, 8, 9, 10, 11]
+
+
+@pytest.fixture
+def Sale(base):
+    class Sale(base):
+        item = Field("item")
+        price = Field("price", index="sorted")
+
+    return Sale
+
+
+def test_range_lookups_use_the_sorted_index(base, Sale, monkeypatch):
+    Sale.bulk_create([Sale(item=f"i{p}", price=p) for p in [5, 1, 9, 3, 7]])
+    Sale(item="free", price=None).save()
+    assert [s.price for s in Sale.objects().filter(price__gt=3)] == [5, 9, 7]
+
+    calls = count_decrypts(monkeypatch)
+    assert [s.price for s in Sale.objects().filter(price__gte=3, price__lt=9)] == [5, 3, 7]
+    assert [s.price for s in Sale.objects().filter(price__lte=3)] == [1, 3]
+    assert calls == []
+
+
+def test_order_by_with_limit_reads_index_order(base, Sale):
+    Sale.bulk_create([Sale(item=f"i{p}", price=p) for p in [5, 1, 9, 3, 7]])
+    Sale.bulk_create([Sale(item="dup", price=9)], batch_size=1)
+
+    assert Sale.objects().order_by("-price").first().item == "i9"
+    assert [s.price for s in Sale.objects().order_by("price")[:3]] == [1, 3, 5]
+    assert [s.item for s in Sale.objects().order_by("-price")[:2]] == ["i9", "dup"]
+    assert [s.price for s in Sale.objects().filter(price__gt=4).order_by("price")] == [5, 7, 9, 9]
+
+    plain = sorted(Sale.objects().all(), key=lambda s: s.price, reverse=True)
+    assert [s.item for s in Sale.objects().order_by("-price")] == [s.item for s in plain]
+
+
+def test_order_by_indexes_only_partitions_it_reaches(base, Sale):
+    Sale._append_records("2024-01-01", [{"id": "a", "item": "a", "price": 1}, {"id": "b", "item": "b", "price": 2}])
+    Sale._append_records("2024-01-02", [{"id": "c", "item": "c", "price": 5}, {"id": "d", "item": "d", "price": 6}])
+    Sale._append_records("2024-01-03", [{"id": "e", "item": "e", "price": 3}, {"id": "f", "item": "f"}])
+    forget_indexes(Sale)
+    store = Sale._index_store()
+
+    assert [s.item for s in Sale.objects().order_by("price")[:3]] == ["f", "a", "b"]
+    assert sorted(date for _, date in store._entries) == ["2024-01-01", "2024-01-03"]
+    assert [s.item for s in Sale.objects().order_by("-price")[:1]] == ["d"]
+    assert len(store) == 3
+    assert [s.item for s in Sale.objects().order_by("-price")] == ["d", "c", "e", "b", "a", "f"]
+
+@pytest.fixture
+def library(base):
+    class Author1(base):
+        name = Field("name")
+
+    class Book1(base):
+        title = Field("title")
+        author = ForeignKey(to_model=Author1, related_name="books")
+
+    return Author1, Book1
+
+
+def test_foreign_keys_resolve_through_the_locator(base, library, monkeypatch):
+    Author1, Book1 = library
+    orwell = Author1(name="Orwell")
+    orwell.save()
+    Author1.bulk_create([Author1(name=f"a{i}") for i in range(50)])
+    Book1(title="1984", author=orwell).save()
+
+    book = Book1.objects().get(title="1984")
+    frames = []
+    monkeypatch.setattr(storage, "read_frame", lambda *a: frames.append(a) or read_frame(*a))
+    calls = count_decrypts(monkeypatch)
+    assert book.author.name == "Orwell"
+    assert Author1.objects().get(id=orwell.id).name == "Orwell"
+    assert calls == []
+    assert len(frames) == 2
+    assert [b.title for b in orwell.books] == ["1984"]
+
+
+def test_locator_survives_rewrites_and_restarts(base, library):
+    Author1, _ = library
+    a, b = Author1(name="a"), Author1(name="b")
+    Author1.bulk_create([a, b])
+    Author1.delete(name="a")
+    assert Author1.objects().get(id=a.id) is None
+    assert Author1.objects().get(id=b.id).name == "b"
+
+    # a fresh process replays the persisted log
+    BaseModel._locators.clear()
+    BaseModel._manifests.clear()
+    fernet = get_fernet_key("secret")
+    (path,) = partition_files(base, "Author1")
+    storage.append_records(str(path), fernet, [{"id": "late", "name": "late"}])
+    assert Author1.objects().get(id="late").name == "late"
+    assert Author1.objects().filter(id__in=[b.id, "late"]).first().name == "b"
+
+
+def test_locator_replaces_only_the_rescanned_partition(base, Order):
+    Order._append_records("2024-01-01", [{"id": "a", "customer": "a"}, {"id": "b", "customer": "b"}])
+    Order._append_records("2024-01-02", [{"id": "c", "customer": "c"}])
+    locator = Order._locator()
+    assert sorted(record_id for record_id, _ in locator.payload("2024-01-01")) == ["a", "b"]
+
+    fernet = get_fernet_key("secret")
+    storage.write_records(Order._partition_path("2024-01-01"), fernet, [{"id": "b", "customer": "b"}])
+    locator.refresh("2024-01-01", Order._partition_path("2024-01-01"))
+    assert locator.locate("a") is None
+    assert [locator.locate(i)[0] for i in ("b", "c")] == ["2024-01-01", "2024-01-02"]
+    assert [record_id for record_id, _ in locator.payload("2024-01-02")] == ["c"]
+
+def test_partition_logs_are_rewritten_once_they_grow(base, Order, monkeypatch):
+    from poutay.pudb import partition_log
+
+    monkeypatch.setattr(partition_log, "COMPACT_ENTRIES", 4)
+    ids = []
+    for i in range(12):
+        order = Order(customer=f"c{i}", amount=i + 1)
+        order.save()
+        ids.append(order.id)
+    fernet = get_fernet_key("secret")
+    for log in (Order._manifest(), Order._locator()):
+        assert len(list(storage.iter_frames(log.path, fernet))) <= 5
+
+    BaseModel._locators.clear()
+    BaseModel._manifests.clear()
+    assert Order.objects().count() == 12
+    assert Order.objects().get(id=ids[3]).customer == "c3"
+
+def test_partitions_of_similarly_named_models_stay_apart(base):
+    class Book(base):
+        title = Field("title")
+
+    class Book1(base):
+        title = Field("title")
+
+    Book(title="b").save()
+    Book1(title="b1").save()
+    assert [b.title for b in Book.objects().all()] == ["b"]
+    assert Book.delete(title="b1") == 0
+    assert [b.title for b in Book1.objects().all()] == ["b1"]
+
+
+def test_manifest_prunes_partitions_by_zone_maps(base, Order, monkeypatch):
+    for day, amounts in [("2024-01-01", [1, 2]), ("2024-01-02", [10, 20]), ("2024-01-03", [5])]:
+        Order._append_records(day, [{"id": f"{day}-{a}", "customer": "c", "amount": a} for a in amounts])
+
+    stats = Order._manifest().partitions["2024-01-02"]
+    assert stats["rows"] == 2 and stats["zones"]["amount"] == [10, 20]
+
+    def no_walk(*args, **kwargs):
+        raise AssertionError("query walked the database directory")
+
+    monkeypatch.setattr("os.walk", no_walk)
+    calls = count_decrypts(monkeypatch)
+    assert [o.amount for o in Order.objects().filter(amount__gt=8)] == [10, 20]
+    assert [Path(p).parts[-2] for p in calls] == ["02"]
+    assert [o.id for o in Order.objects().filter(amount=5).between("2024-01-01", "2024-01-02")] == []
+    assert [o.amount for o in Order.objects().between("2024-1-1", "2024-1-2")] == [10, 20, 1, 2]
+
+    # rows appended behind the manifest's back are not pruned away
+    fernet = get_fernet_key("secret")
+    storage.append_records(Order._partition_path("2024-01-01"), fernet, [{"id": "x", "amount": 99}])
+    assert [o.id for o in Order.objects().filter(amount=99)] == ["x"]
+
+
+def test_manifest_is_built_for_existing_databases(base, Order):
+    Order(customer="Ali", amount=1).save()
+    Order(customer="Sara", amount=2).save()
+    for path in Path(base._db_root, "_pudb").iterdir():
+        path.unlink()
+    BaseModel._manifests.clear()
+    BaseModel._locators.clear()
+
+    (date_str,) = Order._manifest().dates()
+    assert Order._manifest().partitions[date_str]["rows"] == 2
+    assert [o.customer for o in Order.objects().filter(amount__lt=2)] == ["Ali"]
+
+
+def test_scans_reuse_cached_partitions(base, Order, monkeypatch):
+    Order.bulk_create([Order(customer=f"c{i}", amount=i) for i in range(1, 6)])
+    monkeypatch.setattr(storage, "partition_cache", PartitionCache())
+    calls = count_decrypts(monkeypatch)
+
+    assert len(Order.objects().filter(customer__contains="c")) == 5
+    # the cache outlives the partition's in-memory index
+    Order._index_store().clear()
+    assert len(Order.objects().filter(customer__icontains="C")) == 5
+    assert len(calls) == 1
+    assert storage.partition_cache.hits == 1
+
+    # saves and deletes append, which extends the cached partition
+    Order(customer="d", amount=9).save()
+    Order._index_store().clear()
+    assert len(Order.objects().filter(customer__contains="d")) == 1
+    assert len(calls) == 1 and storage.partition_cache.hits == 2
+    Order.delete(customer="c1")
+    Order._index_store().clear()
+    assert len(Order.objects().filter(customer__contains="c")) == 4
+    assert len(calls) == 1 and storage.partition_cache.misses == 1
+
+
+def test_partition_cache_evicts_least_recently_used():
+    cache = PartitionCache(max_bytes=10)
+    cache.put("a", 1, [{"id": "a"}], 20, 4)
+    cache.put("b", 1, [{"id": "b"}], 20, 4)
+    cache.get("a")
+    cache.put("c", 1, [{"id": "c"}], 20, 4)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["bytes"] == 8
+
+    cache.put("huge", 1, [], 20, 11)
+    assert cache.get("huge") is None
+    assert cache.get("a", signature=2) is not None
+    assert (cache.hits, cache.misses) == (3, 3)
+
+
+def test_memory_budgets_charge_decoded_size(base, Sale):
+    import tracemalloc
+
+    Sale.bulk_create([Sale(item=f"item number {i}", price=i * 1.5) for i in range(3000)])
+    (path,) = partition_files(base, "Sale")
+    fernet = get_fernet_key("secret")
+    tracemalloc.start()
+    try:
+        records = storage.read_records(path, fernet)
+        decoded = tracemalloc.get_traced_memory()[0]
+        index = field_index.PartitionIndex(Sale._declared_fields, Sale._sorted_fields())
+        index.add(records)
+        indexed = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert 0.5 < estimate_bytes(records) / decoded < 2
+    assert 0.5 < index.nbytes / indexed < 2
+    # many times what the compressed file takes
+    assert index.nbytes > 5 * path.stat().st_size
+
+
+def test_parallel_scans_keep_order_and_stop_at_limit(base, Order, monkeypatch):
+    from poutay.conf import settings
+
+    days = [f"2024-02-{d:02d}" for d in range(1, 9)]
+    for n, day in enumerate(days):
+        Order._append_records(day, [{"id": f"{day}-{i}", "customer": f"c{n}", "amount": i} for i in (1, 2)])
+    sequential = [o.id for o in Order.objects().filter(customer__contains="c")]
+    assert sequential[0].startswith("2024-02-08")
+
+    monkeypatch.setattr(settings, "PUDB_SCAN_WORKERS", 3)
+    monkeypatch.setattr(storage, "partition_cache", PartitionCache())
+    Order._index_store().clear()
+    calls = count_decrypts(monkeypatch)
+    assert [o.id for o in Order.objects().filter(customer__contains="c")] == sequential
+    assert len(calls) == len(days)
+
+    storage.partition_cache.clear()
+    Order._index_store().clear()
+    calls.clear()
+    assert Order.objects().filter(customer__contains="c").first().id == sequential[0]
+    assert len(calls) <= 1 + 3
+
+
+def test_iterator_streams_partitions_without_caching(base, Order, monkeypatch):
+    days = [f"2024-03-{d:02d}" for d in range(1, 6)]
+    for day in days:
+        Order._append_records(day, [{"id": f"{day}-{i}", "customer": "c", "amount": i} for i in (1, 2, 3)])
+    expected = [o.id for o in Order.objects().filter(amount__gte=2)]
+    Order._index_store().clear()
+    calls = count_decrypts(monkeypatch)
+
+    qs = Order.objects().filter(amount__gte=2)
+    assert [o.id for o in qs.iterator(chunk_size=2)] == expected
+    assert qs._result_cache is None and not len(Order._index_store())
+
+    calls.clear()
+    rows = Order.objects().between(days[2], days[4]).iterator(chunk_size=1)
+    assert next(rows).id == f"{days[4]}-1"
+    rows.close()
+    assert len(calls) == 1
+
+    calls.clear()
+    page = Order.objects().paginate(page=2, per_page=3)
+    assert [o.id for o in page] == [f"{days[3]}-{i}" for i in (1, 2, 3)]
+    assert len(calls) == 2
+
+
+def test_compiled_lookups_and_q_objects(base, Order):
+    Order.bulk_create([
+        Order(id="a", customer="Ali", amount=5),
+        Order(id="b", customer="Sara", amount=50),
+        Order(id="c", customer="Alex", amount=None),
+    ])
+
+    def ids(qs):
+        return sorted(o.id for o in qs)
+
+    objects = Order.objects()
+    assert ids(objects.filter(customer__startswith="Al")) == ["a", "c"]
+    assert ids(objects.filter(amount__range=(1, 10))) == ["a"]
+    assert ids(objects.filter(amount__isnull=True)) == ["c"]
+    assert ids(objects.filter(amount__gte=5)) == ["a", "b"]
+    assert ids(objects.filter(Q(customer="Sara") | Q(amount__lte=5))) == ["a", "b"]
+    assert ids(objects.filter(~Q(customer__startswith="Al"))) == ["b"]
+    assert ids(objects.filter(Q(amount__isnull=False), customer__contains="a")) == ["b"]
+    assert ids(objects.exclude(customer="Ali")) == ["b", "c"]
+    with pytest.raises(ValueError):
+        objects.filter(customer__like="A%").first()
+
+
+def test_projections_skip_model_instances(base, library):
+    Author1, Book1 = library
+    ali = Author1(name="Ali")
+    ali.save()
+    Book1(title="Python", author=ali).save()
+
+    assert Book1.objects().values("title", "author")[0] == {"title": "Python", "author": ali.id}
+    assert Book1.objects().values_list("title", flat=True)[0] == "Python"
+    assert Author1.objects().values_list("id", "name").first() == (ali.id, "Ali")
+    with pytest.raises(TypeError):
+        Book1.objects().values_list("title", "author", flat=True)
+    with pytest.raises(ValueError):
+        Book1.objects().values("isbn")
+
+    book = Book1.objects().only("title").first()
+    assert book.__dict__["title"] == "Python" and "_deferred" in book.__dict__
+    assert book.author.name == "Ali"
+    assert "_deferred" not in book.__dict__
+
+
+def test_counts_and_aggregates_come_from_the_manifest(base, Order, monkeypatch):
+    for day, amounts in [("2024-04-01", [1, 2, None]), ("2024-04-02", [10, 20])]:
+        Order._append_records(day, [{"id": f"{day}-{a}", "customer": "c", "amount": a} for a in amounts])
+    calls = count_decrypts(monkeypatch)
+
+    objects = Order.objects()
+    assert objects.count() == 5 and objects.exists()
+    assert objects.aggregate(Sum("amount"), Max("amount"), n=Count("amount"), low=Min("amount")) == {
+        "amount__sum": 33, "amount__max": 20, "n": 4, "low": 1,
+    }
+    assert objects.between("2024-04-01", "2024-04-01").aggregate(Avg("amount")) == {"amount__avg": 1.5}
+    assert calls == []
+
+    assert objects.filter(amount__gte=2).count() == 3
+    assert objects.filter(amount__gte=2).aggregate(Sum("amount"))["amount__sum"] == 32
+    assert not objects.filter(customer="nobody").exists()
+    assert objects.filter(amount__gt=1).values().count() == 3
+
+
+def test_values_annotate_groups_rows(base, Order):
+    Order.bulk_create([
+        Order(customer="Ali", amount=5),
+        Order(customer="Sara", amount=7),
+        Order(customer="Ali", amount=10),
+    ])
+    rows = Order.objects().values("customer").annotate(total=Sum("amount"), orders=Count()).order_by("-total")
+    assert list(rows) == [
+        {"customer": "Ali", "total": 15, "orders": 2},
+        {"customer": "Sara", "total": 7, "orders": 1},
+    ]
+    assert rows.count() == 2
+    with pytest.raises(TypeError):
+        Order.objects().annotate(Sum("amount"))
+
+
+def test_to_columns_builds_numpy_arrays(base, Order):
+    np = pytest.importorskip("numpy")
+    Order.bulk_create([Order(customer=f"c{i}", amount=i) for i in range(1, 6)])
+    columns = Order.objects().filter(amount__gt=2).order_by("amount").to_columns(
+        ["customer", "amount"], dtypes={"amount": "float64"}, chunk_size=2,
+    )
+    assert columns["amount"].dtype == np.float64
+    assert columns["amount"].tolist() == [3.0, 4.0, 5.0]
+    assert columns["customer"].tolist() == ["c3", "c4", "c5"]
+
+
+def test_to_columns_needs_numpy(base, Order, monkeypatch):
+    monkeypatch.setitem(sys.modules, "numpy", None)
+    with pytest.raises(ImportError):
+        Order.objects().to_columns(["amount"])
+
+
+def test_update_and_delete_append_versions_and_tombstones(base, Order, monkeypatch):
+    Order._append_records("2024-05-01", [
+        {"id": "a", "customer": "Ali", "amount": 5},
+        {"id": "b", "customer": "Sara", "amount": 7},
+    ])
+    Order._append_records("2024-05-02", [{"id": "c", "customer": "Reza", "amount": 9}])
+    (old, new) = sorted(partition_files(base, "Order"))
+    untouched = new.stat()
+
+    assert Order.update({"amount__gte": 5, "customer__startswith": "S"}, amount=70) == 1
+    assert Order.objects().filter(Q(customer="Ali") | Q(amount__gt=100)).delete() == 1
+    assert new.stat().st_mtime_ns == untouched.st_mtime_ns
+
+    assert [(o.id, o.amount) for o in Order.objects().all()] == [("c", 9), ("b", 70)]
+    assert Order.objects().get(id="a") is None and Order.objects().get(id="b").amount == 70
+    assert [o.id for o in Order.objects().filter(amount=7)] == []
+    assert Order.objects().count() == 2
+    assert Order.objects().aggregate(Sum("amount")) == {"amount__sum": 79}
+
+    # saving a stored object writes its new version next to the old one
+    b = Order.objects().get(id="b")
+    b.amount = 71
+    b.save()
+    assert len(partition_files(base, "Order")) == 2
+    fresh = [o.amount for o in Order.objects().filter(id="b")]
+    forget_indexes(Order)
+    assert fresh == [o.amount for o in Order.objects().iterator()][1:] == [71]
+
+
+def test_compact_drops_dead_rows_and_merges_months(base, Order):
+    from poutay.pudb.compact import compact_database
+
+    for day, ids in [("2024-03-01", "ab"), ("2024-03-02", "cd"), ("2024-04-01", "e")]:
+        Order._append_records(day, [{"id": i, "customer": i, "amount": n} for n, i in enumerate(ids)])
+    Order._append_records("2024-03-01", [{"id": "x", "customer": "x", "amount": 9}])
+    Order.update({"id": "a"}, amount=50)
+    Order.delete(id="c")
+
+    report = compact_database(base._db_root, "secret")
+    assert report.rewritten == 2 and report.rows_dropped == 3
+    assert report.bytes_after < report.bytes_before
+    fernet = get_fernet_key("secret")
+    path = Path(Order._partition_path("2024-03-01"))
+    assert [r["id"] for _, _, frame in storage.iter_frames(path, fernet) for r in frame] == ["b", "x", "a"]
+    assert compact_database(base._db_root, "secret").rewritten == 0
+
+    report = compact_database(base._db_root, "secret", monthly=True)
+    assert report.months_merged == 2
+    assert [p.parts[-2] for p in partition_files(base, "Order")] == ["00", "00"]
+    assert [o.id for o in Order.objects().between("2024-03-02", "2024-03-31")] == ["d"]
+    assert [o.id for o in Order.objects().between("2024-03-01", "2024-03-01")] == ["b", "x", "a"]
+    assert Order.objects().get(id="a").amount == 50
+    assert Order.objects().between("2024-03-02", "2024-04-30").count() == 2
+    assert Order.objects().aggregate(Sum("amount")) == {"amount__sum": 61}
+
+    # an update after the merge keeps the record on its day
+    a = Order.objects().get(id="a")
+    a.amount = 51
+    a.save()
+    assert [o.amount for o in Order.objects().between("2024-03-01", "2024-03-01").filter(id="a")] == [51]
+
+
+def test_compact_keeps_the_newest_copy_of_duplicated_ids(base, Order, monkeypatch):
+    from poutay.pudb.compact import compact_database
+
+    # older versions saved an id again in whatever partition was current
+    Order._append_records("2024-05-01", [{"id": "a", "customer": "a", "amount": 1}])
+    Order._append_records("2024-05-02", [{"id": "a", "customer": "a", "amount": 2}])
+    Order._append_records("2024-05-02", [{"id": "b", "customer": "b", "amount": 3}])
+    Order._append_records("2024-05-02", [{"id": "b", "customer": "b", "amount": 4}])
+    assert sorted((o.customer, o.amount) for o in Order.objects().all())[:2] == [("a", 1), ("a", 2)]
+
+    report = compact_database(base._db_root, "secret")
+    assert report.rows_dropped == 2
+    assert sorted((o.customer, o.amount) for o in Order.objects().all()) == [("a", 2), ("b", 4)]
+    assert [p.parts[-2] for p in partition_files(base, "Order")] == ["02"]
+    assert not Path(base._db_root, "2024", "05", "01").exists()
+
+    # the rewritten partition's snapshot is described by compaction
+    forget_indexes(Order)
+    calls = count_decrypts(monkeypatch)
+    frames = count_frame_reads(monkeypatch)
+    assert [o.amount for o in Order.objects().filter(customer="b")] == [4]
+    assert calls == [] and len(frames) == 1
+
+
+def test_monthly_merge_leaves_no_daily_leftovers(base, Order):
+    from poutay.pudb.compact import compact_database
+
+    Order._append_records("2024-07-01", [{"id": "a", "customer": "a", "amount": 1}])
+    Order._append_records("2024-07-02", [{"id": "b", "customer": "b", "amount": 2}])
+    assert [o.customer for o in Order.objects().filter(customer="a")] == ["a"]
+
+    compact_database(base._db_root, "secret", monthly=True)
+    month = Path(base._db_root, "2024", "07")
+    assert sorted(p.name for p in month.iterdir()) == ["00"]
+    assert sorted(o.customer for o in Order.objects().all()) == ["a", "b"]
+
+def test_interrupted_monthly_merge_is_finished_on_the_next_run(base, Order, monkeypatch):
+    from poutay.pudb import compact
+
+    Order._append_records("2024-06-01", [{"id": "a", "amount": 1}])
+    Order._append_records("2024-06-02", [{"id": "b", "amount": 2}])
+
+    def crash(self, monthly, days):
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as patch:
+        patch.setattr(compact._ModelCompactor, "finish_merge", crash)
+        with pytest.raises(KeyboardInterrupt):
+            compact.compact_database(base._db_root, "secret", monthly=True)
+    assert Path(base._db_root, "_pudb", compact.JOURNAL).exists()
+
+    report = compact.compact_database(base._db_root, "secret", monthly=True)
+    assert report.months_merged == 1
+    assert not Path(base._db_root, "_pudb", compact.JOURNAL).exists()
+    assert [p.parts[-2] for p in partition_files(base, "Order")] == ["00"]
+    assert sorted(o.id for o in Order.objects().all()) == ["a", "b"]
+
+
+def test_related_objects_are_fetched_in_batches(base, library, monkeypatch):
+    Author1, Book1 = library
+
+    class Shelf(base):
+        name = Field("name")
+        books = ManyToManyField(Book1, related_name="shelves")
+
+    authors = [Author1(name=f"a{i}") for i in range(3)]
+    Author1.bulk_create(authors)
+    books = Book1.bulk_create(
+        [Book1(title=f"b{i}", author=authors[i % 2]) for i in range(6)]
+    )
+    shelf, empty = Shelf(name="s"), Shelf(name="e")
+    Shelf.bulk_create([shelf, empty])
+    shelf.books.add(books[0], books[3])
+
+    queries = []
+    real = BaseModel._search_records.__func__
+
+    def counting(cls, *args, **kwargs):
+        queries.append(cls.__name__)
+        return real(cls, *args, **kwargs)
+
+    monkeypatch.setattr(BaseModel, "_search_records", classmethod(counting))
+    rows = list(Book1.objects().select_related("author"))
+    assert {b.title: b.author.name for b in rows}["b3"] == "a1"
+    assert queries == ["Book1", "Author1"]
+
+    del queries[:]
+    rows = Author1.objects().prefetch_related("books").all()
+    assert sorted((a.name, len(a.books)) for a in rows) == [("a0", 3), ("a1", 3), ("a2", 0)]
+    assert queries == ["Author1", "Book1"]
+
+    del queries[:]
+    shelves = list(Shelf.objects().prefetch_related("books"))
+    assert {s.name: sorted(b.title for b in s.books) for s in shelves} == {
+        "s": ["b0", "b3"], "e": [],
+    }
+    assert len(queries) == 3
+    del queries[:]
+    titles = Book1.objects().filter(title__in=["b0", "b1"]).prefetch_related("shelves")
+    assert {b.title: [s.name for s in b.shelves] for b in titles} == {"b0": ["s"], "b1": []}
+    assert len(queries) == 3
+
+    # changing a relation drops what was prefetched
+    shelf = [s for s in shelves if s.name == "s"][0]
+    shelf.books.remove(books[0])
+    assert [b.title for b in shelf.books] == ["b3"]
+    with pytest.raises(ValueError):
+        Book1.objects().select_related("title")
+
+
+def test_many_to_many_add_remove_and_set_write_in_batches(base, library, monkeypatch):
+    _, Book1 = library
+
+    class Shelf(base):
+        name = Field("name")
+        books = ManyToManyField(Book1)
+
+    books = Book1.bulk_create([Book1(title=f"b{i}") for i in range(4)])
+    shelf = Shelf(name="s")
+    shelf.save()
+
+    appends = []
+    real = storage.append_records
+
+    def counting(path, *args, **kwargs):
+        if str(path).endswith(".pu"):
+            appends.append(Path(path).name)
+        return real(path, *args, **kwargs)
+
+    monkeypatch.setattr(storage, "append_records", counting)
+    shelf.books.add(books[0], books[1], books[1].id)
+    shelf.books.add(books[1], books[2])
+    assert sorted(b.title for b in shelf.books) == ["b0", "b1", "b2"]
+    assert len(appends) == 2
+
+    del appends[:]
+    shelf.books.set([books[2], books[3]])
+    assert sorted(b.title for b in shelf.books) == ["b2", "b3"]
+    assert len(appends) == 1
+
+    shelf.books.remove(books[2], books[0])
+    assert [b.title for b in shelf.books] == ["b3"]
+    shelf.books.clear()
+    assert len(shelf.books) == 0
+
+    # links still waiting in an atomic() block are not written twice
+    with Shelf.atomic():
+        shelf.books.add(books[0])
+        shelf.books.add(books[0], books[1])
+        shelf.books.remove(books[1])
+        shelf.books.add(books[1])
+    assert sorted(b.title for b in shelf.books) == ["b0", "b1"]
+    assert len(shelf.books.through.objects().all()) == 2
+
+
+def test_session_shares_instances_and_skips_id_lookups(base, library, monkeypatch):
+    Author1, Book1 = library
+    orwell = Author1(name="Orwell")
+    orwell.save()
+    Book1.bulk_create([Book1(title=t, author=orwell) for t in ("1984", "Animal Farm")])
+
+    with Author1.session():
+        books = list(Book1.objects().all())
+        first = books[0].author
+        assert first is not orwell
+        lookups = []
+        real = BaseModel._search_records.__func__
+        monkeypatch.setattr(BaseModel, "_search_records", classmethod(
+            lambda cls, *a, **kw: lookups.append(cls) or real(cls, *a, **kw)
+        ))
+        assert books[1].author is first
+        assert Author1.objects().get(id=orwell.id) is first
+        assert lookups == []
+        assert list(Book1.objects().all()) == books
+
+        Author1.objects().filter(id=orwell.id).update(name="Blair")
+        assert first.name == "Blair"
+        renamed = Author1(id=orwell.id, name="Eric")
+        renamed.save()
+        assert Author1.objects().get(id=orwell.id) is first and first.name == "Eric"
+        Author1.delete(id=orwell.id)
+        assert Author1.objects().get(id=orwell.id) is None
+
+    assert Book1.objects().first() is not books[0]
+
+
+def test_version_1_segments_stay_readable_and_keep_their_format(base, Order):
+    from poutay.pudb.compact import compact_database
+
+    fernet = get_fernet_key("secret")
+    path = Path(Order._get_file_path("2024-02-01"))
+    old = [{"id": "1", "customer": "Old", "amount": 5}]
+    token = fernet.encrypt(json.dumps(old).encode())
+    path.write_bytes(storage.MAGIC_V1 + storage._LENGTH.pack(len(token)) + token)
+
+    Order._append_records("2024-02-01", [{"id": "2", "customer": "New", "amount": 6}])
+    assert path.read_bytes().startswith(storage.MAGIC_V1)
+    assert [o.customer for o in Order.objects().all()] == ["Old", "New"]
+    assert Order.objects().get(id="1").amount == 5
+
+    assert compact_database(base._db_root, "secret").rewritten == 1
+    assert storage.segment_version(path) == 2
+    assert [r["customer"] for r in storage.read_records(path, fernet)] == ["Old", "New"]
+
+
+def test_frames_are_compressed_and_need_their_codec(base, Order, monkeypatch):
+    from poutay.conf import settings
+    from poutay.pudb import codec
+
+    monkeypatch.setattr(settings, "PUDB_COMPRESSION", "zlib", raising=False)
+    monkeypatch.setattr(settings, "PUDB_SERIALIZER", "json", raising=False)
+    records = [{"id": str(i), "customer": "same customer", "amount": i} for i in range(200)]
+    plain = codec.encode(records)
+    assert plain[:2] == bytes((0, 1)) and len(plain) < len(json.dumps(records)) / 4
+    assert codec.decode(plain) == records
+    assert codec.decode(codec.encode(records[:1])) == records[:1]
+    assert codec.decode(bytes((0, 0)) + b'[{"a": 1}]') == [{"a": 1}]
+
+    Order._append_records("2024-02-02", records)
+    (path,) = partition_files(base, "Order")
+    legacy_size = len(storage.MAGIC_V1) + 4 + len(get_fernet_key("secret").encrypt(json.dumps(records).encode()))
+    assert path.stat().st_size < legacy_size / 4
+    assert Order.objects().count() == 200
+
+    monkeypatch.delitem(codec.COMPRESSORS, 1)
+    storage.partition_cache.clear()
+    with pytest.raises(codec.MissingCodecError):
+        list(Order.objects().all())
+
+
+STRESS_WORKER = """
+import sys
+sys.path.insert(0, {root!r})
+from poutay.pudb.orm import Field, create_base_model
+
+base = create_base_model({connection!r})
+
+class Order(base):
+    customer = Field("customer")
+    amount = Field("amount")
+
+worker = int(sys.argv[1])
+for i in range(40):
+    if i % 10 == 9:
+        with Order.atomic():
+            for j in range(5):
+                Order(customer=f"w{{worker}}", amount=1000 + i * 10 + j).save()
+    else:
+        Order(customer=f"w{{worker}}", amount=i).save()
+"""
+
+
+def test_concurrent_writers_in_several_processes_lose_nothing(base, Order, tmp_path):
+    import subprocess
+
+    script = tmp_path / "worker.py"
+    script.write_text(STRESS_WORKER.format(
+        root=str(Path(__file__).resolve().parents[2]),
+        connection=f"db://admin:secret@{base._db_root}",
+    ))
+    workers = [
+        subprocess.Popen([sys.executable, str(script), str(n)], cwd=tmp_path)
+        for n in range(4)
+    ]
+    assert [w.wait(timeout=120) for w in workers] == [0] * 4
+
+    rows = Order.objects().all()
+    assert len(rows) == 4 * (36 + 4 * 5)
+    assert len({o.id for o in rows}) == len(rows)
+    for n in range(4):
+        assert Order.objects().filter(customer=f"w{n}").count() == 56
+    assert Order.objects().count() == len(rows)
+    assert not Path(base._db_root, transaction.WAL_NAME).exists()
+
+
+def test_async_api_runs_off_the_event_loop(base, Order, monkeypatch):
+    import asyncio
+    import time
+
+    from poutay.pudb.queryset import QuerySet
+
+    async def scenario():
+        await Order(customer="Ali", amount=1).asave()
+        with Order.atomic():
+            await Order(customer="Sara", amount=2).asave()
+            assert await Order.objects().acount() == 1
+        assert [o.customer for o in await Order.objects().order_by("amount").aall()] == ["Ali", "Sara"]
+        assert (await Order.objects().afirst()).customer in ("Ali", "Sara")
+        assert [o.amount async for o in Order.objects().filter(customer="Sara")] == [2]
+
+        Order.bulk_create([Order(customer="c", amount=i) for i in range(10, 30)])
+        seen = []
+        async for o in Order.objects().filter(customer="c").aiterator(chunk_size=5):
+            seen.append(o.amount)
+            if len(seen) == 7:
+                break
+        assert len(seen) == 7
+
+        real_first = QuerySet.first
+        monkeypatch.setattr(QuerySet, "first", lambda qs: time.sleep(0.3) or real_first(qs))
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0.01)
+
+        beat = asyncio.ensure_future(ticker())
+        assert (await Order.objects().filter(customer="Ali").afirst()).amount == 1
+        beat.cancel()
+        assert len(ticks) > 5
+
+        slow = asyncio.ensure_future(Order.objects().afirst())
+        await asyncio.sleep(0.05)
+        slow.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await slow
+
+    asyncio.run(scenario())
+
+
+def test_write_behind_queues_saves_and_reads_see_them(base, Order, monkeypatch):
+    import time
+
+    from poutay.conf import settings
+    from poutay.pudb import writer
+
+    monkeypatch.setattr(settings, "PUDB_WRITE_BEHIND", True, raising=False)
+    monkeypatch.setattr(settings, "PUDB_FLUSH_INTERVAL", 60, raising=False)
+    fernet = get_fernet_key("secret")
+    try:
+        objs = [Order(customer=f"c{i}", amount=i) for i in range(20)]
+        for obj in objs:
+            obj.save()
+        assert partition_files(base, "Order") == []
+        objs[3].amount = 33
+        objs[3].save()
+
+        # a query flushes the model's queue first, as one frame per file
+        assert Order.objects().get(id=objs[3].id).amount == 33
+        (path,) = partition_files(base, "Order")
+        assert len(list(storage.iter_frames(path, fernet))) == 1
+        assert Order.objects().count() == 20
+
+        Order(customer="late", amount=99).save()
+        assert Order.flush() == 1
+        assert len(list(storage.iter_frames(path, fernet))) == 2
+
+        # the writer thread flushes on its own once enough rows wait
+        monkeypatch.setattr(settings, "PUDB_FLUSH_ROWS", 5, raising=False)
+        Order.bulk_create([Order(customer="bulk", amount=i) for i in range(5)])
+        for _ in range(200):
+            if len(list(storage.iter_frames(path, fernet))) == 3:
+                break
+            time.sleep(0.01)
+        assert len(list(storage.iter_frames(path, fernet))) == 3
+    finally:
+        writer.close()
+    assert Order.objects().filter(customer="bulk").count() == 5
+
+
+def test_write_behind_queues_updates_and_deletes(base, Order, monkeypatch):
+    from poutay.conf import settings
+    from poutay.pudb import writer
+
+    Order.bulk_create([Order(customer=f"c{i}", amount=i + 1) for i in range(3)])
+    (path,) = partition_files(base, "Order")
+    size = path.stat().st_size
+    monkeypatch.setattr(settings, "PUDB_WRITE_BEHIND", True, raising=False)
+    monkeypatch.setattr(settings, "PUDB_FLUSH_INTERVAL", 60, raising=False)
+    try:
+        assert Order.objects().filter(customer="c0").update(amount=10) == 1
+        assert path.stat().st_size == size and writer.writer.has_pending(Order)
+        # finding what to delete reads, which flushes the queued update
+        assert Order.delete(customer="c1") == 1
+        size = path.stat().st_size
+        assert writer.writer.has_pending(Order)
+    finally:
+        writer.close()
+    assert path.stat().st_size > size
+    assert sorted((o.customer, o.amount) for o in Order.objects().all()) == [("c0", 10), ("c2", 3)]
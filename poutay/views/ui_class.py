@@ -113,8 +113,15 @@ class UIMainMeta(type):
             valid = True
             if hasattr(action_instance, "validate"):
                 valid = action_instance.validate(func.__name__, ui)
-            if valid:
-                getattr(action_instance, func.__name__)(ui)
+            if not valid:
+                return
+            handler = getattr(action_instance, func.__name__)
+            if getattr(settings, "PUDB_SESSION_PER_ACTION", False):
+                from poutay.pudb.session import Session
+
+                # records fetched repeatedly by one action share an instance
+                handler = Session()(handler)
+            handler(ui)
 
         return wrap
 
@@ -15,6 +15,10 @@ setup(
         "bcrypt",
         "beautifulsoup4",
     ],
+    extras_require={
+        "analytics": ["numpy"],
+        "speedups": ["orjson", "msgpack", "zstandard"],
+    },
     entry_points={
         "console_scripts": ["poutay=poutay:main"],
     },